@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Benchmarks band math throughput and memory use on synthetic level1b lines.
+
+Generates ENVI BIL cubes and matching mask cubes at the sizes of each sensor,
+then times scops_bandmath.bandmath and scops_bandmath.bandmath_mask_gen on them
+for equations of increasing complexity and a range of line lengths. Each case
+is run in its own process so the peak RSS recorded is for that case alone.
+Results are written out as JSON to compare between releases.
+
+Available functions
+write_synthetic_cube: writes a random ENVI BIL cube and header
+benchmark_equations: returns the test equations scaled to a band count
+run_case: times a single benchmark case in a child process
+run_benchmarks: runs all the cases and returns the results
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import scops_bandmath
+from scops import scops_common
+from scops import band_expressions
+
+#samples per line and band counts for each sensor
+SENSORS = {"fenix": {"cols": 384, "bands": 622},
+           "eagle": {"cols": 1024, "bands": 253},
+           "hawk": {"cols": 320, "bands": 256},
+           "owl": {"cols": 384, "bands": 100}}
+
+#ENVI data type codes for the cubes we write
+ENVI_TYPE_CODES = {numpy.dtype(numpy.uint8): 1,
+                   numpy.dtype(numpy.uint16): 12}
+
+#line lengths to benchmark by default
+DEFAULT_ROWS = [1000, 5000, 20000]
+
+def write_synthetic_cube(filename, rows, cols, bands, dtype, maximum, blocksize=512):
+    """
+    Writes a BIL cube of random values below maximum with an ENVI header,
+    a block of rows at a time so memory doesn't depend on the size of the cube.
+
+    :param filename: string
+    :param rows: int
+    :param cols: int
+    :param bands: int
+    :param dtype: numpy dtype
+    :param maximum: int
+    :return: None
+    """
+    dtype = numpy.dtype(dtype)
+    random_state = numpy.random.RandomState(0)
+    with open(filename, 'wb') as cube:
+        for first_row in range(0, rows, blocksize):
+            nrows = min(blocksize, rows - first_row)
+            random_state.randint(0, maximum, size=(nrows, bands, cols)).astype(dtype).tofile(cube)
+    with open(filename + ".hdr", 'w') as header:
+        header.write("ENVI\n"
+                     "description = {{synthetic benchmark cube}}\n"
+                     "samples = {}\n"
+                     "lines = {}\n"
+                     "bands = {}\n"
+                     "header offset = 0\n"
+                     "file type = ENVI Standard\n"
+                     "data type = {}\n"
+                     "interleave = bil\n"
+                     "byte order = 0\n".format(cols, rows, bands, ENVI_TYPE_CODES[dtype]))
+
+def benchmark_equations(bands):
+    """
+    Returns (name, equation) pairs of increasing complexity, using bands spread
+    across a file of the given number of bands.
+
+    :param bands: int
+    :return: equations
+    :rtype: list
+    """
+    blue, green, red, nir = [max(1, int(bands * fraction)) for fraction in (0.1, 0.2, 0.3, 0.6)]
+    return [("ratio", "band{} / band{}".format(nir, red)),
+            ("ndvi", "(band{0} - band{1}) / (band{0} + band{1})".format(nir, red)),
+            ("evi", "2.5 * ((band{0} - band{1}) / (band{0} + 6 * band{1} - 7.5 * band{2} + 1))".format(nir, red, blue)),
+            ("conditional", "where((band{0} - band{1}) / (band{0} + band{1}) > 0.3, sqrt(band{0} * band{2}), band{3} / (band{1} + 1))".format(nir, red, green, blue))]
+
+def _measure(function, args, kwargs, connection):
+    """
+    Runs function in a child process and sends back its wall time and the
+    peak resident memory of the process.
+    """
+    try:
+        start = time.time()
+        function(*args, **kwargs)
+        wall_time = time.time() - start
+        #ru_maxrss is in kilobytes on Linux but bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak_rss = peak_rss / 1024
+        connection.send({"wall_time": wall_time, "peak_rss_kb": peak_rss, "error": None})
+    except Exception as exc:
+        connection.send({"wall_time": None, "peak_rss_kb": None, "error": str(exc)})
+    connection.close()
+
+def run_case(function, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs) in a fresh process and returns a dictionary
+    of its wall time (seconds), peak RSS (kilobytes) and any error.
+    """
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_measure, args=(function, args, kwargs, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+def run_benchmarks(workdir, sensors, row_counts, repeats=1, blocksize=None):
+    """
+    Runs every benchmark case for the sensors and line lengths given, returning
+    a list of result dictionaries.
+
+    :param workdir: string, synthetic files are written here
+    :param sensors: list of sensor names
+    :param row_counts: list of int
+    :param repeats: int
+    :param blocksize: int
+    :return: results
+    :rtype: list
+    """
+    results = []
+    for sensor in sensors:
+        cols = SENSORS[sensor]["cols"]
+        bands = SENSORS[sensor]["bands"]
+        for rows in row_counts:
+            casedir = tempfile.mkdtemp(prefix="{}_{}_".format(sensor, rows), dir=workdir)
+            bilfile = os.path.join(casedir, "{}_{}1b.bil".format(sensor, rows))
+            maskfile = bilfile.replace(".bil", "_mask.bil")
+            print("Writing synthetic {} line of {} rows".format(sensor, rows))
+            write_synthetic_cube(bilfile, rows, cols, bands, numpy.uint16, 2 ** 14)
+            write_synthetic_cube(maskfile, rows, cols, bands, numpy.uint8, 2)
+            case = {"sensor": sensor, "rows": rows, "cols": cols, "bands": bands}
+            for eqname, equation in benchmark_equations(bands):
+                band_list = band_expressions.parse_equation(equation).bands
+                for repeat in range(repeats):
+                    print("Timing bandmath {} on {} rows of {}".format(eqname, rows, sensor))
+                    result = run_case(scops_bandmath.bandmath, bilfile, equation, casedir, band_list,
+                                      eqname=eqname, maskfile=maskfile, blocksize=blocksize)
+                    result.update(case)
+                    result.update({"function": "bandmath", "equation_name": eqname,
+                                   "equation": equation, "repeat": repeat})
+                    results.append(result)
+
+                    print("Timing bandmath_mask_gen {} on {} rows of {}".format(eqname, rows, sensor))
+                    result = run_case(scops_bandmath.bandmath_mask_gen, maskfile,
+                                      os.path.join(casedir, "{}_{}_mask_gen.bil".format(sensor, eqname)),
+                                      band_list, 1, rows, cols, blocksize=blocksize)
+                    result.update(case)
+                    result.update({"function": "bandmath_mask_gen", "equation_name": eqname,
+                                   "equation": equation, "repeat": repeat})
+                    results.append(result)
+            #clear up as we go, the larger lines take up a lot of disk
+            shutil.rmtree(casedir, ignore_errors=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sensors',
+                        '-s',
+                        help='sensors to benchmark',
+                        nargs='+',
+                        choices=sorted(SENSORS.keys()),
+                        default=sorted(SENSORS.keys()))
+    parser.add_argument('--rows',
+                        '-r',
+                        help='line lengths to benchmark',
+                        nargs='+',
+                        type=int,
+                        default=DEFAULT_ROWS)
+    parser.add_argument('--repeats',
+                        help='number of times to run each case',
+                        type=int,
+                        default=1)
+    parser.add_argument('--blocksize',
+                        help='number of rows band math processes at a time',
+                        type=int,
+                        default=scops_common.BANDMATH_BLOCK_ROWS,
+                        metavar="<rows>")
+    parser.add_argument('--workdir',
+                        '-w',
+                        help='folder to write synthetic files to, defaults to a temporary folder',
+                        default=None,
+                        metavar="<folder>")
+    parser.add_argument('--output',
+                        '-o',
+                        help='JSON file to write the results to',
+                        default="bandmath_benchmark.json",
+                        metavar="<output>")
+    args = parser.parse_args()
+
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix="scops_benchmark_")
+    else:
+        workdir = args.workdir
+
+    try:
+        results = run_benchmarks(workdir, args.sensors, args.rows,
+                                 repeats=args.repeats, blocksize=args.blocksize)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"created": datetime.datetime.now().isoformat(),
+              "host": list(platform.uname()),
+              "python": platform.python_version(),
+              "numpy": numpy.__version__,
+              "settings": {"blocksize": args.blocksize,
+                           "threads": scops_common.BANDMATH_THREADS,
+                           "queue_blocks": scops_common.BANDMATH_QUEUE_BLOCKS},
+              "results": results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print("Wrote results to: {}".format(args.output))
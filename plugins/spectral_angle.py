@@ -4,190 +4,348 @@
 from __future__ import print_function
 import numpy
 import gdal
-import math
 import glob
 import os
 import collections
 import argparse
+import hashlib
+import json
+import logging
+
+from scops import scops_common
+from scops import envi_reader
+from scops import block_pipeline
+from scops import block_plugins
+
+logger=logging.getLogger()
 
 nodata=2**16-1
 
-def calculate_spectral_angle(hsi_filename,spectra):
+#default number of rows classified at a time, a block is held as a float32 (pixels x bands) matrix
+BLOCK_ROWS=128
+
+#resampled reference spectra, keyed on the reference file contents and sensor wavelengths
+_resampled_spectra={}
+
+def normalise_spectra(spectra):
+    """
+    Scale each of the reference spectra (rows of a 2D numpy array) to unit length
+    so the dot product with a pixel gives the cosine of the angle once divided by
+    the pixel magnitude. Spectra that are all zero are left as zero.
+
+    returns a float32 array the same shape as spectra
+    """
+    spectra=numpy.asarray(spectra,dtype=numpy.float64)
+    magnitude=numpy.sqrt((spectra*spectra).sum(axis=1))
+    magnitude=numpy.where(magnitude==0,1,magnitude)
+    return (spectra/magnitude[:,numpy.newaxis]).astype(numpy.float32)
+
+def block_spectral_angle(block,unit_spectra):
+    """
+    Calculate the spectral angle to each reference spectra for a block of a hyperspectral file
+
+    block = (bands, rows, cols) array as read from the file
+    unit_spectra = 2D numpy array from normalise_spectra - each row a different spectra
+
+    returns a float32 array of shape (spectra, rows, cols)
+    """
+    bands,rows,cols=block.shape
+    #the block as a (pixels x bands) matrix so all the angles come from one matrix multiply
+    pixels=numpy.ascontiguousarray(block.transpose(1,2,0),dtype=numpy.float32).reshape(rows*cols,bands)
+    dot=numpy.dot(pixels,unit_spectra.T)
+    hsi_magnitude=numpy.sqrt(numpy.einsum('ij,ij->i',pixels,pixels))
+    #pixels with no magnitude get a cosine of 0 (90 degrees) as before
+    hsi_magnitude=numpy.where(hsi_magnitude==0,numpy.inf,hsi_magnitude)
+    cos_angle=dot/hsi_magnitude[:,numpy.newaxis]
+    #rounding can take the cosine just outside [-1,1]
+    numpy.clip(cos_angle,-1,1,out=cos_angle)
+    return numpy.arccos(cos_angle).T.reshape(unit_spectra.shape[0],rows,cols)
+
+def spectral_angle_blocks(hsifile,spectra,blocksize=None):
+    """
+    Generator working through an open hyperspectral file (from envi_reader.open_image) in
+    blocks of rows, giving (first_row, angles) where angles is a (spectra, rows, cols) array.
+    Memory use depends only on the block size, not on the line length.
+
+    hsifile = envi_reader.ImageReader
+    spectra = 2D numpy array - each row a different spectra
+    blocksize = number of rows to work on at a time
+    """
+    if hsifile.band_count!=spectra.shape[1]:
+        raise Exception("The reference spectra must be sampled to the same wavelengths as the hyperspectral data.")
+    if blocksize is None:
+        blocksize=BLOCK_ROWS
+    blocksize=int(blocksize)
+    unit_spectra=normalise_spectra(spectra)
+
+    def read(first_row):
+        last_row=min(first_row+blocksize,hsifile.rows)
+        print("Working on rows: {}-{}/{}".format(first_row,last_row,hsifile.rows))
+        #copy the block so the disk is read in the reader thread rather than on first use
+        return first_row,numpy.array(hsifile.read_block(first_row,last_row-first_row))
+
+    #read the next block of the file while this one is worked on
+    for first_row,block in block_pipeline.prefetch(read,range(0,hsifile.rows,blocksize),scops_common.BANDMATH_QUEUE_BLOCKS):
+        yield first_row,block_spectral_angle(block,unit_spectra)
+
+def calculate_spectral_angle(hsi_filename,spectra,blocksize=None):
     """
     Run a spectral angle classification on a hyperspectral file (hsi_filename) using reference spectra
 
     hsi_filename = string filename
     spectra = 2D numpy array - each row a different spectra
 
-    returns a dictionary of key (spectra id) and value (spectral angle)
+    returns a dictionary of key (spectra id) and value (spectral angle) for the whole file,
+    run uses spectral_angle_blocks so the whole file never has to be held
     """
-    #open the gdal supported raster file
-    gdalfile=gdal.Open(hsi_filename)
-    #get the number of bands in the file
-    number_of_bands=gdalfile.RasterCount
-    if number_of_bands!=spectra.shape[1]:
-        raise Exception("The reference spectra must be sampled to the same wavelengths as the hyperspectral data.")
-    #define the arrays and set to zero
-    hsi_magnitude=numpy.zeros([gdalfile.RasterYSize,gdalfile.RasterXSize])
-    spectra_magnitude=numpy.zeros(spectra.shape[0])
-    dot_sum=numpy.zeros([spectra.shape[0],gdalfile.RasterYSize,gdalfile.RasterXSize])
-    #loop through each of the bands and calculate the values we need
-    for i,band in enumerate(range(1,number_of_bands+1)):
-        print("Working on band: {}/{}".format(i,number_of_bands))
-        band_data=gdalfile.GetRasterBand(band).ReadAsArray().astype(numpy.float32)
-        #sum up the band squared to calculate the magnitude later
-        hsi_magnitude=hsi_magnitude+(band_data*band_data)
-        for spec_index in range(spectra.shape[0]):
-            #sum up the spectra squared to calculate the magnitude later
-            spectra_magnitude[spec_index]=spectra_magnitude[spec_index]+(spectra[spec_index][i]*spectra[spec_index][i])
-            #multiply each band by the spectra scalar
-            dot_sum[spec_index]=dot_sum[spec_index]+(band_data*spectra[spec_index][i])
-
-    #square root to get magnitudes
-    hsi_magnitude=numpy.sqrt(hsi_magnitude)
-    spectra_magnitude=numpy.sqrt(spectra_magnitude)
-    #get the cosine of the angle
+    #open the file, ENVI files are memory mapped rather than read band by band
+    hsifile=envi_reader.open_image(hsi_filename)
     angle=collections.OrderedDict()
-    for i in range(spectra_magnitude.size):
-        #need to deal with denominator being zero else RAM usage hits the roof
-        #set it to 1 instead and then set the cos_angle to 0 (90 degrees) for these pixels
-        denom=hsi_magnitude*spectra_magnitude[i]
-        denom=numpy.where(denom==0,1,denom)
-        cos_angle=dot_sum[i]/denom
-        cos_angle[numpy.where(denom==1)]=0
-        #get the angle
-        angle[i+1]=numpy.arccos(cos_angle)
+    for i in range(spectra.shape[0]):
+        angle[i+1]=numpy.zeros([hsifile.rows,hsifile.cols],dtype=numpy.float32)
+    for first_row,angles in spectral_angle_blocks(hsifile,spectra,blocksize):
+        for i in range(spectra.shape[0]):
+            angle[i+1][first_row:first_row+angles.shape[1]]=angles[i]
     #tidy up
-    gdalfile=None
+    hsifile.close()
     return angle
 
 def create_classification_mask(angles):
     """
     Create the classification mask.
     Input is a dictionary of spectral angles (as output from calculate_spectral_angle).
-    The keys should be 0, 1, 2, ... for as many reference spectra used.
-    Output is the classification mask array.
-    """
-
-    #now to generate the classification mask - and set to max value
-    classification=numpy.ones(angles[1].shape)*(nodata)
-    #the scalar to convert indices to floating point
-    scalar=10**numpy.ceil(numpy.log10(angles[1].shape[1]))
-    #for each of the classes (test spectra)
-    for classkey in angles.keys():
-        indices=[]
-        #loop through each of the other classes and test if this one has smaller angle
-        for otherkey in angles.keys():
-            if otherkey is classkey:
-                continue
-            indices.append(numpy.where(angles[classkey]<angles[otherkey]))
-
-        #now need to pull out only the indices that occur in every set
-        float_indices=[]
-        for i in indices:
-            #convert to a float as row.col for comparison
-            float_indices.append(i[0]+i[1]/scalar)
-
-        #get the counts of each unique occurrence
-        #if the count is the same as the number of other classes (i.e. total classes - 1) then it is OK
-        all_float_indices=numpy.concatenate(float_indices)
-        unique,counts=numpy.unique(all_float_indices,return_counts=True)
-        #now get the indices that were in all sets
-        float_indices=unique[numpy.where(counts==len(angles.keys())-1)]
-        #and convert back to tuple indices
-        indices=(numpy.array([int(i) for i in float_indices]),
-                 numpy.array([int(round(math.modf(i)[0]*scalar)) for i in float_indices]))
-
-        if len(indices[0])!=0:
-            #here indices are only the ones where this class is smallest
-            classification[indices]=classkey
-
+    The keys should be 1, 2, 3, ... for as many reference spectra used.
+    Output is the classification mask array (uint16). Each pixel is given the key of the
+    class with the smallest angle, pixels where the smallest angle is shared by more than
+    one class or where any angle is not a number are set to nodata.
+    """
+    keys=numpy.array(list(angles.keys()),dtype=numpy.uint16)
+    stack=numpy.array(list(angles.values()))
+    #the class with the smallest angle for every pixel in one pass
+    smallest=numpy.argmin(stack,axis=0)
+    classification=keys[smallest]
+    #ties and NaNs never had a class that was smaller than all the others
+    minimum=numpy.min(stack,axis=0)
+    unclassified=(stack==minimum).sum(axis=0)!=1
+    classification[unclassified]=nodata
     return classification
 
-def run(output_folder=None,hsi_filename=None,refspectra=os.path.join(os.path.dirname(__file__),"ref_spectra/ref_spectra.txt"),filetype="ENVI",hsi_wavelengths=None):
+def load_reference_spectra(refspectra):
     """
-    Function to run the spectral angle classifier. This is the one that is called from SCOPS processor.
+    Read an ASCII reference spectra file of space separated columns, the first called "wavelength".
+
+    returns the wavelengths (sorted), the spectra names and a 2D numpy array - each row a different spectra
+    """
+    spectradata=numpy.genfromtxt(refspectra,names=True)
+    names=[name for name in spectradata.dtype.names if name not in ["wavelength"]]
+    order=numpy.argsort(spectradata['wavelength'])
+    wavelengths=spectradata['wavelength'][order]
+    matrix=numpy.vstack([spectradata[name][order] for name in names])
+    return wavelengths,names,matrix
+
+def resample_spectra(ref_wavelengths,ref_matrix,hsi_wavelengths,hsi_fwhm=None,response="point"):
+    """
+    Resample a library of reference spectra (2D numpy array - each row a different spectra)
+    to the hyperspectral bands, the whole library is resampled in one go.
+
+    response="point" interpolates linearly at the band centres. response="gaussian" weights
+    the reference spectra by a gaussian spectral response function of the band FWHM (needs
+    hsi_fwhm), bands too narrow to cover any reference samples fall back to interpolation.
+
+    Bands beyond the longest reference wavelength are set to 0 as the reference spectra
+    don't cover them.
+
+    returns a 2D numpy array of shape (spectra, bands)
+    """
+    ref_wavelengths=numpy.asarray(ref_wavelengths,dtype=numpy.float64)
+    hsi_wavelengths=numpy.asarray(hsi_wavelengths,dtype=numpy.float64)
+    #linear interpolation as a (bands x reference samples) weight matrix, clamped below the
+    #shortest reference wavelength in the same way as numpy.interp
+    upper=numpy.clip(numpy.searchsorted(ref_wavelengths,hsi_wavelengths),1,len(ref_wavelengths)-1)
+    lower=upper-1
+    span=ref_wavelengths[upper]-ref_wavelengths[lower]
+    fraction=numpy.clip((hsi_wavelengths-ref_wavelengths[lower])/numpy.where(span==0,1,span),0,1)
+    weights=numpy.zeros([len(hsi_wavelengths),len(ref_wavelengths)])
+    bands=numpy.arange(len(hsi_wavelengths))
+    weights[bands,lower]+=1-fraction
+    weights[bands,upper]+=fraction
+
+    if response=="gaussian":
+        if hsi_fwhm is None:
+            raise Exception("The FWHM of the hyperspectral bands is needed for gaussian resampling")
+        sigma=numpy.asarray(hsi_fwhm,dtype=numpy.float64)/(2*numpy.sqrt(2*numpy.log(2)))
+        srf=numpy.exp(-0.5*((ref_wavelengths[numpy.newaxis,:]-hsi_wavelengths[:,numpy.newaxis])/sigma[:,numpy.newaxis])**2)
+        total=srf.sum(axis=1)
+        covered=total>1e-6
+        weights[covered]=srf[covered]/total[covered,numpy.newaxis]
+    elif response!="point":
+        raise Exception("Unknown spectral response {}".format(response))
+
+    #The reference spectra data do not go this high - set the resampled ref spectra to 0 here
+    weights[hsi_wavelengths>ref_wavelengths.max()]=0
+    return numpy.dot(ref_matrix,weights.T)
+
+def resampled_reference_spectra(refspectra,hsi_wavelengths,hsi_fwhm=None,response="point"):
+    """
+    Load and resample a reference spectra file to the hyperspectral bands. Results are kept
+    in memory and, if the derived product cache is in use, on disk keyed by the contents of
+    refspectra and the sensor wavelengths so the same library is only resampled once per sensor.
+
+    returns a 2D numpy array - each row a different spectra - and a list of the spectra names
+    """
+    key_hash=hashlib.sha1()
+    with open(refspectra,'rb') as reffile:
+        key_hash.update(reffile.read())
+    sensor=[[round(float(w),4) for w in hsi_wavelengths],None,response]
+    if response!="point" and hsi_fwhm is not None:
+        sensor[1]=[round(float(w),4) for w in hsi_fwhm]
+    key_hash.update(json.dumps(sensor).encode("utf-8"))
+    key=key_hash.hexdigest()
+    if key in _resampled_spectra:
+        return _resampled_spectra[key]
+
+    cache_file=None
+    if scops_common.USE_DERIVED_CACHE:
+        cache_file=os.path.join(scops_common.DERIVED_CACHE_DIR,"resampled_spectra",key+".npz")
+        if os.path.isfile(cache_file):
+            try:
+                cached=numpy.load(cache_file)
+                _resampled_spectra[key]=(cached["spectra"],[str(name) for name in cached["names"]])
+                return _resampled_spectra[key]
+            except (IOError,OSError,ValueError,KeyError):
+                pass
+
+    ref_wavelengths,names,ref_matrix=load_reference_spectra(refspectra)
+    spectra=resample_spectra(ref_wavelengths,ref_matrix,hsi_wavelengths,hsi_fwhm=hsi_fwhm,response=response)
+    _resampled_spectra[key]=(spectra,names)
+
+    if cache_file is not None:
+        #write to the side and move in to place so other jobs never read half a file
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            temp_file=cache_file+".{}.tmp".format(os.getpid())
+            with open(temp_file,'wb') as output:
+                numpy.savez(output,spectra=spectra,names=numpy.array(names))
+            os.rename(temp_file,cache_file)
+        except (IOError,OSError) as exc:
+            print("Could not cache resampled spectra: {}".format(exc))
+    return spectra,names
+
+class SpectralAnglePlugin(block_plugins.BlockPlugin):
+    """
+    Block plugin for the spectral angle classifier, so it can share a pass over the level1b
+    file with band math and other plugins. Takes the same arguments as run.
+    """
+
+    def __init__(self,output_folder=None,hsi_filename=None,refspectra=os.path.join(os.path.dirname(__file__),"ref_spectra/ref_spectra.txt"),filetype="ENVI",hsi_wavelengths=None,blocksize=None,response="point"):
+        if refspectra is None:
+            raise Exception("Need to pass the reference spectra file.")
+        self.hsi_filename=hsi_filename
+        self.refspectra=refspectra
+        self.filetype=filetype
+        self.hsi_wavelengths=hsi_wavelengths
+        self.response=response
+        if blocksize is None:
+            blocksize=BLOCK_ROWS
+        self.block_rows=blocksize
+        self.outputfilename=os.path.join(output_folder,os.path.basename(os.path.splitext(hsi_filename)[0])+"_spectral_angle_classification.bsq")
+
+    def bands(self):
+        #every band goes in to the angle
+        return None
+
+    def cache_inputs(self):
+        #the classes come from the reference spectra and how they are resampled
+        hsi_wavelengths=self.hsi_wavelengths
+        if hsi_wavelengths is not None:
+            hsi_wavelengths=[float(w) for w in hsi_wavelengths]
+        return [self.refspectra],{"response":self.response,"filetype":self.filetype,"hsi_wavelengths":hsi_wavelengths}
+
+    def start(self,hsifile):
+        #get the wavelengths from the HSI file, for ENVI files these come straight from the header
+        hsi_wavelengths=self.hsi_wavelengths
+        if hsi_wavelengths is None:
+            hsi_wavelengths=hsifile.wavelengths
+            if hsi_wavelengths is None:
+                raise Exception("Could not find the wavelengths of {}".format(self.hsi_filename))
+
+        #now resample the ref spectra to match the wavelengths of the hsi
+        try:
+            spectra,self.spectra_id=resampled_reference_spectra(self.refspectra,hsi_wavelengths,hsi_fwhm=hsifile.fwhm,response=self.response)
+        except Exception as exc:
+            raise Exception("Failed to read in reference spectra beacuse of {}".format(exc))
+        if hsifile.band_count!=spectra.shape[1]:
+            raise Exception("The reference spectra must be sampled to the same wavelengths as the hyperspectral data.")
+        self.unit_spectra=normalise_spectra(spectra)
+
+        #create the classification mask so each block can be written as it is finished
+        driver=gdal.GetDriverByName(self.filetype)
+        try:
+            self.outfile=driver.Create(self.outputfilename, xsize=hsifile.cols, ysize=hsifile.rows,bands=1, eType=gdal.GDT_UInt16)
+        except Exception as exc:
+            raise Exception("Failed to create output file: {} because {}".format(self.outputfilename,exc))
+        self.band=self.outfile.GetRasterBand(1)
+        self.unclassified=0
+
+    def process_block(self,first_row,block,extra):
+        block_angles=block_spectral_angle(block,self.unit_spectra)
+        angles=collections.OrderedDict()
+        for i in range(block_angles.shape[0]):
+            angles[i+1]=block_angles[i]
+        classification=create_classification_mask(angles)
+
+        #count pixels that have no classification for the debug summary
+        self.unclassified+=int(numpy.count_nonzero(classification==nodata))
+
+        self.band.WriteArray(classification,0,first_row)
+
+    def abort(self):
+        if getattr(self,"outfile",None) is None:
+            #start failed before the classification was created
+            return
+        #release the classification before removing what was written of it
+        self.band=None
+        self.outfile=None
+        for filename in [self.outputfilename,os.path.splitext(self.outputfilename)[0]+".hdr",self.outputfilename+".aux.xml"]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def finish(self):
+        logger.debug("{} pixels of {} have no classification".format(self.unclassified,self.hsi_filename))
+        ##set band name
+        self.band.SetDescription("Spectral angle classification")
+        #need to write the classes to meta data for future reference
+        for i,name in enumerate(self.spectra_id):
+            self.band.SetMetadataItem(str(i+1),os.path.basename(name))
+        self.band.SetNoDataValue(nodata)
+        self.band=None
+        self.outfile=None
+        return self.outputfilename
+
+def block_plugin(**plugin_args):
+    """
+    Returns the block plugin used by SCOPS to run this in the same pass as any band math
+    and other plugins. Takes the same arguments as run.
+    """
+    return SpectralAnglePlugin(**plugin_args)
+
+def run(output_folder=None,hsi_filename=None,refspectra=os.path.join(os.path.dirname(__file__),"ref_spectra/ref_spectra.txt"),filetype="ENVI",hsi_wavelengths=None,blocksize=None,response="point"):
+    """
+    Function to run the spectral angle classifier on its own.
 
     inputs:
         output_folder = directory to write to.
         hsi_filename = hyperspectral bil file to classify.
         refspectra = reference spectra ASCII file.
         filetype = file type to write to.
+        blocksize = number of rows to classify at a time.
+        response = how to resample the reference spectra, "point" or "gaussian" (see resample_spectra).
     returns:
         outputfilename - filename of classification written to disk.
     """
-
-    if refspectra is None:
-        raise Exception("Need to pass the reference spectra file.")
-
-    outputfilename=os.path.join(output_folder,os.path.basename(os.path.splitext(hsi_filename)[0])+"_spectral_angle_classification.bsq")
-    #list to save the spectra to - this will be stacked into a numpy array
-    spectralist=[]
-    spectra_id=[]
-
-    #get the wavelengths from the HSI file
-    if hsi_wavelengths is None:
-        hsi_wavelengths=[]
-        gdalfile=gdal.Open(hsi_filename)
-        number_of_bands=gdalfile.RasterCount
-        for b in range(number_of_bands):
-            band=gdalfile.GetRasterBand(b+1)
-            hsi_wavelengths.append(float(band.GetMetadataItem("Wavelength")))
-        gdalfile=None
-
-    #now resample the ref spectra to match the wavelengths of the hsi
-    #here we do not do a full resample - only a 1d interpolation. For wide-band data
-    #this will be less accurate and a resampling method based on response functions is recommended
-    try:
-        #loop through and load in each spectra to test against
-        spectradata=numpy.genfromtxt(refspectra,names=True)
-        names=list(spectradata.dtype.names)
-        for name in names:
-            new_spectra=[]
-            #skip the wavelengths
-            if name in ["wavelength"]:
-                continue
-            #need to interpolate wavelength to HSI wavelengths
-            for w in hsi_wavelengths:
-                if w > spectradata['wavelength'].max():
-                    #The reference spectra data do not go this high - set the resampled ref spectra to 0 here
-                    new_spectra.append(0)
-                else:
-                    new_spectra.append(numpy.interp(w,spectradata['wavelength'],spectradata[name]))
-            spectralist.append(numpy.array(new_spectra))
-            spectra_id.append(name)
-
-        spectra=numpy.vstack(spectralist)
-    except Exception as exc:
-        raise Exception("Failed to read in reference spectra beacuse of {}".format(exc))
-
-    #now run the spectral angle calculation on the hyperspectral file
-    angles=calculate_spectral_angle(hsi_filename,spectra)
-    classification=create_classification_mask(angles)
-
-    #print out pixels that have no classification for debug purposes
-    I=numpy.where(classification>10)
-    for i in angles.keys():
-        print(i,angles[i][I])
-
-    #write out the classification mask
-    driver=gdal.GetDriverByName(filetype)
-    try:
-        outfile=driver.Create(outputfilename, xsize=classification.shape[1], ysize=classification.shape[0],bands=1, eType=gdal.GDT_UInt16)
-    except Exception as exc:
-        raise Exception("Failed to create output file: {} because {}".format(outputfilename,exc))
-    band=outfile.GetRasterBand(1)
-    band.WriteArray(classification)
-    ##set band name
-    band.SetDescription("Spectral angle classification")
-    #need to write the classes to meta data for future reference
-    band=outfile.GetRasterBand(1)
-    for i,key in enumerate(angles.keys()):
-        band.SetMetadataItem(str(key),os.path.basename(spectra_id[i]))
-    band.SetNoDataValue(nodata)
-    outfile=None
-
-    return outputfilename
+    plugin=SpectralAnglePlugin(output_folder=output_folder,hsi_filename=hsi_filename,refspectra=refspectra,filetype=filetype,hsi_wavelengths=hsi_wavelengths,blocksize=blocksize,response=response)
+    return block_plugins.run_block_plugins(hsi_filename,[plugin])[0]
 
 
 if __name__=="__main__":
@@ -205,6 +363,15 @@ if __name__=="__main__":
                         help='ASCII file containing reference spectra as space separated columns. First column should be "wavelength" all others should be the spectra intensity.',
                         default=os.path.join(os.path.dirname(__file__),"ref_spectra/ref_spectra.txt"),
                         metavar="<filename>")
+    parser.add_argument('--blocksize',
+                        help='Number of rows to classify at a time',
+                        type=int,
+                        default=BLOCK_ROWS,
+                        metavar="<rows>")
+    parser.add_argument('--response',
+                        help='How to resample the reference spectra to the hyperspectral bands, point interpolation or gaussian spectral response functions from the band FWHM',
+                        choices=["point","gaussian"],
+                        default="point")
     args = parser.parse_args()
 
-    run(output_folder=args.output_folder,hsi_filename=args.hsifilename,refspectra=args.refspectra)
+    run(output_folder=args.output_folder,hsi_filename=args.hsifilename,refspectra=args.refspectra,blocksize=args.blocksize,response=args.response)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Runs aplmap over a line in several processes at once, each mapping a chunk of
+the band list against the same transformed IGM, then merges the chunks back
+together in to a single BIL. aplmap maps each band on its own, so the merged
+file holds the same bytes as a single run over the whole band list.
+
+Available functions
+band_range_numbers: lists the bands given by an aplmap band list
+split_band_list: splits a band list in to chunks of consecutive bands
+chunk_count: number of chunks to split the aplmap of a file in to
+merge_envi_headers: merges the headers of files holding consecutive bands
+merge_bil_chunks: merges BIL files holding consecutive bands of the same area
+run_chunked_aplmap: runs aplmap in chunks and merges the output
+"""
+import logging
+import os
+import subprocess
+
+import numpy
+
+from scops import scops_common
+from scops import envi_reader
+from scops import line_executor
+from scops import log_tailer
+
+logger = logging.getLogger()
+
+#fewest bands worth giving an aplmap process of their own
+MIN_CHUNK_BANDS = 8
+
+#buffer size in MB given to aplmap when it runs on its own
+APLMAP_BUFFER_MB = 4096
+
+#ENVI header items with a value for each band
+PER_BAND_ITEMS = ["wavelength", "fwhm", "band names", "bbl", "data gain values", "data offset values"]
+
+def band_range_numbers(band_range, band_count=None):
+    """
+    Returns the band numbers given by an aplmap -bandlist, in the order they
+    are mapped. band_range is given as in the config, e.g. "1-622",
+    "100-200 250" or "ALL", band_count is needed to expand ALL and None is
+    returned for it otherwise.
+
+    :param band_range: string
+    :param band_count: int
+    :return: band numbers
+    :rtype: list
+    """
+    if band_range.strip().upper() == "ALL":
+        if band_count is None:
+            return None
+        return list(range(1, band_count + 1))
+    numbers = []
+    for item in band_range.replace(",", " ").split():
+        first, _, last = item.partition("-")
+        if last == "":
+            last = first
+        numbers.extend(range(int(first), int(last) + 1))
+    return numbers
+
+def _band_list_string(numbers):
+    """
+    Writes band numbers back out as an aplmap band list, e.g. "1-10 12"
+    """
+    runs = []
+    for number in numbers:
+        if len(runs) > 0 and number == runs[-1][1] + 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return " ".join(["{}-{}".format(first, last) if first != last else str(first)
+                     for first, last in runs])
+
+def split_band_list(band_range, band_count, chunks):
+    """
+    Splits a band list in to at most chunks lists of as even a size as
+    possible, keeping the bands in order so the outputs can be stacked back
+    together.
+
+    :param band_range: string
+    :param band_count: int, bands in the file being mapped
+    :param chunks: int
+    :return: band lists
+    :rtype: list
+    """
+    numbers = band_range_numbers(band_range, band_count)
+    chunks = max(1, min(int(chunks), len(numbers)))
+    size, extra = divmod(len(numbers), chunks)
+    band_lists = []
+    first = 0
+    for chunk in range(chunks):
+        last = first + size + (1 if chunk < extra else 0)
+        band_lists.append(_band_list_string(numbers[first:last]))
+        first = last
+    return band_lists
+
+def chunk_count(band_range, band_count):
+    """
+    Returns how many aplmap processes to split the mapping of a file in to,
+    scops_common.APLMAP_BAND_CHUNKS if it is set otherwise the cores left to
+    each product of the line running at once. There are always at least
+    MIN_CHUNK_BANDS bands in a chunk.
+
+    :param band_range: string
+    :param band_count: int, bands in the file being mapped
+    :return: chunks
+    :rtype: int
+    """
+    if int(scops_common.APLMAP_BAND_CHUNKS) > 0:
+        chunks = int(scops_common.APLMAP_BAND_CHUNKS)
+    else:
+        chunks = line_executor.cores_per_product()
+    bands = len(band_range_numbers(band_range, band_count))
+    return max(1, min(chunks, bands // MIN_CHUNK_BANDS))
+
+def merge_envi_headers(header_files, output_header):
+    """
+    Writes the header for the files of header_files stacked together, the
+    first header is kept with the band count updated and the per band lists
+    of PER_BAND_ITEMS (wavelengths, band names, etc.) joined together.
+
+    :param header_files: list of strings
+    :param output_header: string
+    :return: None
+    """
+    headers = [envi_reader.read_envi_header(header_file) for header_file in header_files]
+    counts = [int(header["bands"]) for header in headers]
+
+    def merge_item(match):
+        key = match.group(1).strip().lower()
+        if key == "bands":
+            return "{} = {}".format(match.group(1), sum(counts))
+        per_band = all([isinstance(header.get(key), list) and len(header[key]) == count
+                        for header, count in zip(headers, counts)])
+        if key not in PER_BAND_ITEMS or not per_band:
+            return match.group(0)
+        return "{} = {{{}}}".format(match.group(1), ", ".join([value for header in headers for value in header[key]]))
+
+    with open(header_files[0], 'r') as header_file:
+        text = header_file.read()
+    with open(output_header, 'w') as header_file:
+        header_file.write(envi_reader.HEADER_ITEM.sub(merge_item, text))
+
+def merge_bil_chunks(chunk_files, output_file, blocksize=None):
+    """
+    Stacks BIL files holding consecutive bands of the same area in to one
+    file, a block of rows at a time so memory doesn't depend on the size of
+    the line. The data is copied byte for byte so the output is the same as
+    if the bands had been written together.
+
+    :param chunk_files: list of strings
+    :param output_file: string
+    :param blocksize: int, defaults to scops_common.BANDMATH_BLOCK_ROWS
+    :return: None
+    """
+    if blocksize is None:
+        blocksize = scops_common.BANDMATH_BLOCK_ROWS
+    blocksize = max(1, int(blocksize))
+    readers = [envi_reader.open_image(chunk_file) for chunk_file in chunk_files]
+    try:
+        for reader in readers:
+            if not isinstance(reader, envi_reader.BilReader) or reader.interleave != "bil":
+                raise Exception("{} is not an uncompressed BIL file".format(reader.filename))
+            if (reader.rows, reader.cols, reader.dtype) != (readers[0].rows, readers[0].cols, readers[0].dtype):
+                raise Exception("{} does not cover the same area as {}".format(reader.filename, readers[0].filename))
+        with open(output_file, 'wb') as output:
+            for first_row in range(0, readers[0].rows, blocksize):
+                nrows = min(blocksize, readers[0].rows - first_row)
+                numpy.concatenate([reader.rows_view(first_row, nrows) for reader in readers], axis=1).tofile(output)
+    finally:
+        for reader in readers:
+            reader.close()
+    merge_envi_headers([envi_reader.find_header(chunk_file) for chunk_file in chunk_files], output_file + ".hdr")
+
+def run_chunked_aplmap(aplmap_cmd, band_range, band_count, mapname, chunks):
+    """
+    Runs aplmap_cmd over band_range in chunks processes at once and merges
+    their outputs in to mapname. aplmap_cmd is the aplmap command without
+    -bandlist, -mapname or -buffersize, the buffer is shared between the
+    processes. The output of each process is added to the log as it is
+    written, and the size of the merged file is logged as aplmap logs its
+    output's so the progress updater picks it up.
+
+    :param aplmap_cmd: list
+    :param band_range: string
+    :param band_count: int, bands in the file being mapped
+    :param mapname: string
+    :param chunks: int
+    :return: None
+    """
+    band_lists = split_band_list(band_range, band_count, chunks)
+    buffersize = max(256, APLMAP_BUFFER_MB // len(band_lists))
+    chunk_files = []
+    processes = []
+    try:
+        for index, band_list in enumerate(band_lists):
+            chunk_file = mapname.replace(".bil", "_chunk{}.bil".format(index))
+            chunk_cmd = list(aplmap_cmd)
+            chunk_cmd.extend(["-bandlist"] + band_list.split())
+            chunk_cmd.extend(["-mapname", chunk_file])
+            chunk_cmd.extend(["-buffersize", str(buffersize)])
+            logger.info(" ".join(chunk_cmd))
+            chunk_log = open(chunk_file + ".log", 'w')
+            processes.append((subprocess.Popen(chunk_cmd, stdout=chunk_log, stderr=subprocess.STDOUT), chunk_log))
+            chunk_files.append(chunk_file)
+
+        log_tailer.follow_processes([process for process, _ in processes],
+                                    [chunk_file + ".log" for chunk_file in chunk_files])
+        failed = []
+        for chunk_file, (process, chunk_log) in zip(chunk_files, processes):
+            if process.returncode != 0 or not os.path.exists(chunk_file):
+                failed.append(chunk_file)
+        if len(failed) > 0:
+            raise Exception("aplmap failed to output {}".format(", ".join(failed)))
+
+        logger.info("merging {} aplmap chunks in to {}".format(len(chunk_files), mapname))
+        merge_bil_chunks(chunk_files, mapname)
+        logger.info("Merged output file size will be {:.2f} {}".format(os.path.getsize(mapname) / 1024.0 ** 2, log_tailer.SIZE_TEXT))
+    finally:
+        for process, chunk_log in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            chunk_log.close()
+        for chunk_file in chunk_files:
+            for filename in [chunk_file, chunk_file + ".hdr", chunk_file.replace(".bil", ".hdr"), chunk_file + ".log"]:
+                if os.path.exists(filename):
+                    os.remove(filename)
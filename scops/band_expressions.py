@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Parsing, checking and compilation of band math equations.
+
+Equations are parsed once per process and keep their compiled numexpr programs,
+so the same equation run on many lines or blocks is only compiled once. Terms
+repeated between the equations of a line can be pulled out and evaluated once.
+
+Available functions
+parse_equation: returns the (cached) BandExpression for an equation string
+validate_bands: checks the bands used by a set of expressions exist in a file
+shared_subexpressions: rewrites expressions so repeated terms are only evaluated once
+"""
+import ast
+import re
+
+import numexpr
+from numexpr import necompiler
+
+#how band variables must be written in equations, e.g. band1, band147, band650
+BAND_PATTERN = re.compile(r'band(\d{1,3})')
+BAND_VARIABLE = re.compile(r'^band(\d{1,3})$')
+
+#prefix for the variables holding shared subexpressions
+SHARED_PREFIX = "_shared"
+
+#symbols for the operators numexpr understands
+BINARY_OPERATORS = {ast.Add: "+",
+                    ast.Sub: "-",
+                    ast.Mult: "*",
+                    ast.Div: "/",
+                    ast.Mod: "%",
+                    ast.Pow: "**",
+                    ast.LShift: "<<",
+                    ast.RShift: ">>",
+                    ast.BitAnd: "&",
+                    ast.BitOr: "|",
+                    ast.BitXor: "^"}
+UNARY_OPERATORS = {ast.USub: "-",
+                   ast.UAdd: "+",
+                   ast.Invert: "~"}
+COMPARE_OPERATORS = {ast.Eq: "==",
+                     ast.NotEq: "!=",
+                     ast.Lt: "<",
+                     ast.LtE: "<=",
+                     ast.Gt: ">",
+                     ast.GtE: ">="}
+
+#parsed equations, keyed on the equation string
+_expressions = {}
+
+class UnsupportedExpression(Exception):
+    """
+    Raised when an equation uses syntax that can't be rewritten
+    """
+    pass
+
+def _to_source(node):
+    """
+    Turns an expression tree back in to a string numexpr can evaluate, every
+    operation is bracketed so precedence doesn't need to be tracked.
+    """
+    if isinstance(node, ast.Name):
+        return node.id
+    node_type = type(node).__name__
+    if node_type in ("Num", "Constant", "NameConstant"):
+        if node_type == "Num":
+            return repr(node.n)
+        return repr(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        return "({} {} {})".format(_to_source(node.left),
+                                   BINARY_OPERATORS[type(node.op)],
+                                   _to_source(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return "({}{})".format(UNARY_OPERATORS[type(node.op)],
+                               _to_source(node.operand))
+    if isinstance(node, ast.Compare) and all([type(op) in COMPARE_OPERATORS for op in node.ops]):
+        source = _to_source(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            source += " {} {}".format(COMPARE_OPERATORS[type(op)], _to_source(comparator))
+        return "({})".format(source)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        return "{}({})".format(node.func.id, ", ".join([_to_source(arg) for arg in node.args]))
+    raise UnsupportedExpression("Can't rewrite {}".format(ast.dump(node)))
+
+def _names(tree):
+    """
+    Returns the variable names used in an expression tree in the order they
+    first appear, function names aren't included.
+    """
+    functions = set([node.func.id for node in ast.walk(tree)
+                     if isinstance(node, ast.Call) and isinstance(node.func, ast.Name)])
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id not in functions and node.id not in names:
+            if node.id not in ("True", "False", "None"):
+                names.append(node.id)
+    return names
+
+class BandExpression(object):
+    """
+    A parsed band math equation.
+
+    bands holds the band numbers referenced as strings, as written in the
+    equation, and variables every name numexpr will need in its local dict.
+    normalised is the equation written out in a standard form, so equations
+    which only differ in spacing or brackets match.
+    Compiled programs are kept for each set of input types they are used with.
+    """
+
+    def __init__(self, equation):
+        self.equation = equation
+        try:
+            self.tree = ast.parse(equation.strip(), mode='eval').body
+        except SyntaxError as exc:
+            raise ValueError("Could not parse equation '{}': {}".format(equation, exc))
+        self.variables = _names(self.tree)
+        try:
+            self.normalised = _to_source(self.tree)
+        except UnsupportedExpression:
+            self.normalised = equation.strip()
+        self.bands = []
+        for band in BAND_PATTERN.findall(equation):
+            if band not in self.bands:
+                self.bands.append(band)
+        self._programs = {}
+
+    def program(self, signature):
+        """
+        Returns the numexpr program for a list of (variable, type) pairs,
+        compiling it the first time that signature is seen.
+        """
+        key = tuple(signature)
+        if key not in self._programs:
+            self._programs[key] = numexpr.NumExpr(self.equation, signature)
+        return self._programs[key]
+
+    def evaluate(self, local_dict):
+        """
+        Evaluates the expression, local_dict must hold an array for each of
+        the variables.
+        """
+        arrays = [local_dict[name] for name in self.variables]
+        signature = [(name, necompiler.getType(array))
+                     for name, array in zip(self.variables, arrays)]
+        return self.program(signature)(*arrays)
+
+def parse_equation(equation):
+    """
+    Returns the BandExpression for an equation, equations are only parsed once
+    per process.
+
+    :param equation: string
+    :return: expression
+    :rtype: BandExpression
+    """
+    if equation not in _expressions:
+        _expressions[equation] = BandExpression(equation)
+    return _expressions[equation]
+
+def validate_bands(expressions, band_count, filename=None):
+    """
+    Checks every variable in the expressions is a band which exists in a file
+    of band_count bands, so bad equations are caught before any data is read.
+
+    :param expressions: list of BandExpression
+    :param band_count: int
+    :param filename: string, only used in the error message
+    :return: None
+    """
+    for expression in expressions:
+        unknown = [name for name in expression.variables if BAND_VARIABLE.match(name) is None]
+        if len(unknown) > 0:
+            raise ValueError("Equation '{}' uses {} which are not in the form bandx".format(expression.equation, ", ".join(unknown)))
+        missing = [band for band in expression.bands if not 1 <= int(band) <= band_count]
+        if len(missing) > 0:
+            raise ValueError("Equation '{}' uses band(s) {} but {} only has {} bands".format(expression.equation, ", ".join(missing), filename, band_count))
+
+def shared_subexpressions(expressions):
+    """
+    Finds terms that occur more than once across a set of expressions, such as
+    the (band800 + band670) common to several vegetation indices.
+
+    Returns (shared, rewritten) where shared is a list of (variable,
+    BandExpression) to evaluate in order and store under variable, and
+    rewritten holds an expression for each of the inputs which uses them.
+    Expressions which can't be rewritten are returned unchanged.
+
+    :param expressions: list of BandExpression
+    :return: shared
+    :rtype: list
+    :return: rewritten
+    :rtype: list
+    """
+    #count every operation which works on at least one band
+    counts = {}
+    for expression in expressions:
+        for node in ast.walk(expression.tree):
+            if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call)) and len(_names(node)) > 0:
+                key = ast.dump(node)
+                counts[key] = counts.get(key, 0) + 1
+
+    shared_sources = {}
+    shared = []
+
+    def rewrite(node):
+        #children first, so shared terms are defined before anything that uses them
+        key = ast.dump(node)
+        if isinstance(node, ast.BinOp):
+            source = "({} {} {})".format(rewrite(node.left), BINARY_OPERATORS.get(type(node.op)), rewrite(node.right))
+        elif isinstance(node, ast.UnaryOp):
+            source = "({}{})".format(UNARY_OPERATORS.get(type(node.op)), rewrite(node.operand))
+        elif isinstance(node, ast.Call):
+            source = "{}({})".format(node.func.id, ", ".join([rewrite(arg) for arg in node.args]))
+        elif isinstance(node, ast.Compare):
+            source = rewrite(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                source += " {} {}".format(COMPARE_OPERATORS[type(op)], rewrite(comparator))
+            source = "({})".format(source)
+        else:
+            return _to_source(node)
+        if counts.get(key, 0) < 2:
+            return source
+        if key not in shared_sources:
+            name = "{}{}".format(SHARED_PREFIX, len(shared))
+            shared_sources[key] = name
+            shared.append((name, parse_equation(source)))
+        return shared_sources[key]
+
+    rewritten = []
+    for expression in expressions:
+        try:
+            #check the whole tree can be written out before sharing any of it
+            _to_source(expression.tree)
+        except UnsupportedExpression:
+            rewritten.append(expression)
+            continue
+        rewritten.append(parse_equation(rewrite(expression.tree)))
+    return shared, rewritten
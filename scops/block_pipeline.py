@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Helpers to overlap reading, processing and writing blocks of a file.
+
+Reading runs ahead of the consumer in a background thread and writes are
+handed to another, so the disk and the CPU are kept busy at the same time.
+numpy, numexpr and GDAL release the GIL for the heavy lifting so threads are
+enough for this.
+
+Available functions
+prefetch: runs a function over a list of items in the background, ahead of the consumer
+BlockWriter: runs write functions in order in a background thread
+"""
+import sys
+import threading
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+#marks the end of a queue
+_FINISHED = object()
+
+def prefetch(function, items, depth):
+    """
+    Generator giving function(item) for each of items. Up to depth results are
+    prepared in a background thread ahead of the one being used, if depth is 0
+    everything is run in the calling thread. Exceptions are raised in the
+    calling thread.
+
+    :param function: callable
+    :param items: iterable
+    :param depth: int
+    """
+    depth = int(depth)
+    if depth < 1:
+        for item in items:
+            yield function(item)
+        return
+
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                results.put((True, function(item)))
+        except Exception:
+            results.put((False, sys.exc_info()[1]))
+            return
+        results.put((True, _FINISHED))
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            success, result = results.get()
+            if not success:
+                raise result
+            if result is _FINISHED:
+                break
+            yield result
+    finally:
+        #let the worker finish if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+class BlockWriter(object):
+    """
+    Runs write functions in the order they are given in a background thread,
+    holding at most depth of them waiting. With a depth of 0 they are run
+    straight away in the calling thread.
+
+    Any exception from a write is raised from the next call to write or close.
+    close must be called to wait for everything to be written.
+    """
+
+    def __init__(self, depth):
+        self.depth = int(depth)
+        self.error = None
+        self.thread = None
+        if self.depth > 0:
+            self.tasks = queue.Queue(maxsize=self.depth)
+            self.thread = threading.Thread(target=self._worker)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is _FINISHED:
+                return
+            if self.error is not None:
+                #drop anything after a failure, it will be raised to the caller
+                continue
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                self.error = sys.exc_info()[1]
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, function, *args):
+        """
+        Queues function(*args) to be run
+        """
+        self._check()
+        if self.thread is None:
+            function(*args)
+        else:
+            self.tasks.put((function, args))
+
+    def close(self):
+        """
+        Waits for all the queued writes to finish
+        """
+        if self.thread is not None:
+            self.tasks.put(_FINISHED)
+            self.thread.join()
+            self.thread = None
+        self._check()
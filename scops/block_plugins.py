@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Block level interface for products derived from a level1b file, so band math
+and any number of plugins can be made from a single pass over the cube.
+
+A plugin module can provide a block_plugin(output_folder, hsi_filename,
+**kwargs) function returning a BlockPlugin, this is used in preference to its
+run function. Plugins which only have run are wrapped in a FilePlugin so they
+work the same way.
+
+Outputs of plugins are kept in the derived product cache keyed on the
+level1b file and the plugin source. Anything else an output depends on (data
+files such as reference spectra, or settings) is given by cache_inputs, a
+method of a BlockPlugin or a cache_inputs(**plugin_args) function of a
+plugin module with only run.
+
+If anything fails part way through the pass, abort is called for every
+plugin which was started and hasn't finished, so writer threads are stopped
+and partly written outputs removed.
+
+Available functions
+BlockPlugin: base class for block plugins
+FilePlugin: adapter for plugins which read the file themselves through run
+plugin_for_module: returns the BlockPlugin to use for a plugin module
+run_block_plugins: feeds blocks of a file to a set of plugins in one pass
+"""
+import logging
+
+import numpy
+
+from scops import scops_common
+from scops import envi_reader
+from scops import block_pipeline
+
+logger = logging.getLogger()
+
+class BlockPlugin(object):
+    """
+    Base class for block plugins. The driver calls start once with the open
+    reader, process_block for each block of rows in order, then finish.
+
+    block_rows can be set to the most rows a plugin wants at a time, the
+    driver uses the smallest of these.
+    """
+    block_rows = None
+
+    def bands(self):
+        """
+        Returns the list of band numbers (counting from 1) the plugin needs,
+        None for all of them or an empty list if it doesn't read the file
+        through the driver.
+        """
+        return None
+
+    def cache_inputs(self):
+        """
+        Returns the files, other than the level1b file, and the settings the
+        output depends on, as (list of filenames, dict), so the output isn't
+        taken from the derived product cache when any of them change.
+        """
+        return [], {}
+
+    def start(self, reader):
+        """
+        Called with the envi_reader.ImageReader for the file before any blocks
+        """
+        pass
+
+    def read_extra(self, first_row, nrows):
+        """
+        Reads anything else the plugin needs for a block (e.g. mask files), it
+        is run ahead in the reader thread and passed on to process_block.
+        """
+        return None
+
+    def process_block(self, first_row, block, extra):
+        """
+        Processes a (bands, rows, cols) block holding the bands asked for, in
+        the order given by bands. Plugins must provide an implementation of
+        this unless they ask for no bands.
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        Called after the last block, returns the plugin output
+        """
+        return None
+
+    def abort(self):
+        """
+        Called instead of finish if the pass fails after start was called
+        (or if finish itself fails), to release anything start set up and
+        remove partly written outputs. start may not have completed.
+        """
+        pass
+
+class FilePlugin(BlockPlugin):
+    """
+    Adapter for plugins with only the original run(**plugin_args) interface,
+    they read the file themselves so are run from finish.
+    """
+
+    def __init__(self, module, plugin_args):
+        self.module = module
+        self.plugin_args = plugin_args
+
+    def bands(self):
+        return []
+
+    def cache_inputs(self):
+        if hasattr(self.module, "cache_inputs"):
+            return self.module.cache_inputs(**self.plugin_args)
+        return [], {}
+
+    def finish(self):
+        return self.module.run(**self.plugin_args)
+
+def plugin_for_module(module, plugin_args):
+    """
+    Returns a BlockPlugin for a plugin module, using its block_plugin function
+    if it has one and wrapping its run function otherwise.
+
+    :param module: module
+    :param plugin_args: dict of keyword arguments, including output_folder and hsi_filename
+    :return: plugin
+    :rtype: BlockPlugin
+    """
+    if hasattr(module, "block_plugin"):
+        return module.block_plugin(**plugin_args)
+    return FilePlugin(module, plugin_args)
+
+def run_block_plugins(filename, plugins, blocksize=None, queue_blocks=None):
+    """
+    Reads filename once, a block of rows at a time, and hands each plugin the
+    bands it asked for. Only the union of the bands needed is read and the
+    next block is read while the current one is processed.
+
+    Returns the result of finish for each plugin, in the same order. If
+    anything fails, each plugin started and not yet finished is aborted
+    before the error is raised.
+
+    :param filename: string
+    :param plugins: list of BlockPlugin
+    :param blocksize: int, defaults to scops_common.BANDMATH_BLOCK_ROWS
+    :param queue_blocks: int, defaults to scops_common.BANDMATH_QUEUE_BLOCKS
+    :return: results
+    :rtype: list
+    """
+    if blocksize is None:
+        blocksize = scops_common.BANDMATH_BLOCK_ROWS
+    if queue_blocks is None:
+        queue_blocks = scops_common.BANDMATH_QUEUE_BLOCKS
+    blocksize = min([int(blocksize)] + [int(plugin.block_rows) for plugin in plugins
+                                        if plugin.block_rows is not None])
+    reader = envi_reader.open_image(filename)
+    started = []
+    results = []
+    try:
+        try:
+            for plugin in plugins:
+                started.append(plugin)
+                plugin.start(reader)
+            _run_pass(reader, plugins, blocksize, queue_blocks)
+        finally:
+            reader.close()
+        for plugin in plugins:
+            results.append(plugin.finish())
+    except Exception as error:
+        for plugin in started[len(results):]:
+            try:
+                plugin.abort()
+            except Exception as abort_error:
+                logger.warning("could not clean up after {}: {}".format(type(plugin).__name__, abort_error))
+        raise error
+    return results
+
+def _run_pass(reader, plugins, blocksize, queue_blocks):
+    """
+    Feeds each block of reader to the started plugins
+    """
+    #work out which bands to read and where each plugin's are in the block
+    plugin_bands = [plugin.bands() for plugin in plugins]
+    if None in plugin_bands:
+        all_bands = list(range(1, reader.band_count + 1))
+    else:
+        all_bands = sorted(set([int(band) for bands in plugin_bands for band in bands]))
+    band_index = dict([(band, i) for i, band in enumerate(all_bands)])
+    selections = []
+    for bands in plugin_bands:
+        if bands is None or [int(band) for band in bands] == all_bands:
+            selections.append(None)
+        else:
+            selections.append([band_index[int(band)] for band in bands])
+    active = [i for i, bands in enumerate(plugin_bands) if bands is None or len(bands) > 0]
+
+    def read(block_rows):
+        first_row, nrows = block_rows
+        #copy the block so the disk is read in the reader thread rather than on first use
+        block = numpy.array(reader.read_block(first_row, nrows, all_bands))
+        extras = [plugins[i].read_extra(first_row, nrows) for i in active]
+        return first_row, block, extras
+
+    if len(active) > 0:
+        block_rows = [(first_row, min(blocksize, reader.rows - first_row))
+                      for first_row in range(0, reader.rows, blocksize)]
+        blocks = block_pipeline.prefetch(read, block_rows, queue_blocks)
+        try:
+            for first_row, block, extras in blocks:
+                for i, extra in zip(active, extras):
+                    if selections[i] is None:
+                        plugins[i].process_block(first_row, block, extra)
+                    else:
+                        plugins[i].process_block(first_row, block[selections[i]], extra)
+        finally:
+            #stop reading ahead straight away if a plugin failed, before the reader is closed
+            blocks.close()
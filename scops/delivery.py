@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Formats mapped products can be delivered in. By default each mapped BIL is
+zipped and the zips are collected in to a master zip for the order, orders
+can instead ask for a tiled, deflate compressed GeoTIFF of each line which GIS
+tools can open directly, written straight from the mapped BIL with the tiles
+compressed across several threads.
+
+The format is set by delivery_format in the order's config, falling back to
+scops_common.DELIVERY_FORMAT.
+
+Available functions
+delivery_format: format an order's products are delivered in
+delivered_name: name of the file a mapped product is delivered as
+write_geotiff: writes a mapped file as a tiled, compressed GeoTIFF
+"""
+import logging
+
+import gdal
+
+from scops import scops_common
+from scops import line_executor
+
+logger = logging.getLogger()
+
+#formats products can be delivered in
+ZIP = "zip"
+GEOTIFF = "geotiff"
+FORMATS = [ZIP, GEOTIFF]
+
+#width and height in pixels of the GeoTIFF tiles
+TILE_SIZE = 256
+
+def delivery_format(config, line_name):
+    """
+    Returns the format products of line_name are delivered in, from
+    delivery_format in its section of config or the DEFAULT section.
+
+    :param config: ConfigParser
+    :param line_name: string, section of the config
+    :return: one of FORMATS
+    :rtype: string
+    """
+    if config.has_option(line_name, "delivery_format"):
+        chosen = config.get(line_name, "delivery_format")
+    else:
+        chosen = scops_common.DELIVERY_FORMAT
+    chosen = chosen.strip().lower()
+    if chosen not in FORMATS:
+        raise Exception("unknown delivery format {}, expected one of {}".format(chosen, ", ".join(FORMATS)))
+    return chosen
+
+def delivered_name(mapname, chosen):
+    """
+    Returns the name of the file mapname is delivered as in format chosen
+
+    :param mapname: string, mapped BIL
+    :param chosen: one of FORMATS
+    :return: filename
+    :rtype: string
+    """
+    if chosen == GEOTIFF:
+        return mapname.replace(".bil", ".tif")
+    return mapname + ".zip"
+
+def write_geotiff(mapname, output_file, level=None, threads=None):
+    """
+    Writes mapname as a tiled GeoTIFF with each band deflated separately, so
+    single bands can be read without decompressing the rest. Band names,
+    wavelengths and the no data value are carried over from the ENVI header.
+
+    :param mapname: string, mapped BIL
+    :param output_file: string
+    :param level: deflate level, defaults to scops_common.ZIP_COMPRESSION_LEVEL
+    :param threads: threads compressing tiles, defaults to scops_common.ZIP_THREADS or the cores each product has if that is 0
+    :return: None
+    """
+    if level is None:
+        level = scops_common.ZIP_COMPRESSION_LEVEL
+    if threads is None:
+        threads = scops_common.ZIP_THREADS
+    threads = int(threads)
+    if threads <= 0:
+        threads = line_executor.cores_per_product()
+    creation_options = ["TILED=YES",
+                        "BLOCKXSIZE={}".format(TILE_SIZE),
+                        "BLOCKYSIZE={}".format(TILE_SIZE),
+                        "INTERLEAVE=BAND",
+                        "COMPRESS=DEFLATE",
+                        "ZLEVEL={}".format(int(level)),
+                        "NUM_THREADS={}".format(threads),
+                        "BIGTIFF=IF_SAFER"]
+    logger.info("writing {} as {}".format(mapname, output_file))
+    mapped = gdal.Open(mapname)
+    if mapped is None:
+        raise Exception("couldn't open {}".format(mapname))
+    output = gdal.Translate(output_file, mapped, format="GTiff", creationOptions=creation_options)
+    if output is None:
+        raise Exception("couldn't write {}".format(output_file))
+    #closing the dataset flushes the last tiles
+    output = None
+    mapped = None
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+A cache of level1b derived products (band math outputs and plugin outputs)
+shared between orders, so restarted orders and orders covering the same
+flight day don't regenerate identical files.
+
+Entries are keyed on the identity of the input files (path, size and
+modification time), the operation that made them and its arguments. Files are
+hard linked in and out of the cache where possible, so storing and fetching
+an entry doesn't write the data again, and copied otherwise. Anything already
+at the destination is unlinked first rather than written through. The cache
+is trimmed to a size limit by removing the least recently used entries.
+
+What the cache did is kept as well as logged, so it can be added to the logs
+of products which are set up after it was used.
+
+Available functions
+cache_key: builds the key for an operation on a set of input files
+companion_files: lists a file and the headers that go with it
+DerivedCache: the cache itself
+open_cache: returns the cache set up in scops_common, or None if it is turned off
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from scops import scops_common
+
+logger = logging.getLogger()
+
+#name of the file holding an entry's details
+ENTRY_INFO = "entry.json"
+
+def cache_key(input_files, operation, arguments=None):
+    """
+    Returns a key for operation run with arguments on input_files. Missing
+    input files are allowed (e.g. optional masks) and are keyed as missing.
+
+    :param input_files: list of filenames
+    :param operation: string
+    :param arguments: dict, must be serialisable to json
+    :return: key
+    :rtype: string
+    """
+    identity = []
+    for filename in input_files:
+        if filename is not None and os.path.isfile(filename):
+            stat = os.stat(filename)
+            identity.append([os.path.realpath(filename), stat.st_size, int(stat.st_mtime)])
+        else:
+            identity.append([filename, None, None])
+    details = json.dumps([identity, operation, arguments], sort_keys=True)
+    return hashlib.sha1(details.encode("utf-8")).hexdigest()
+
+def companion_files(filename):
+    """
+    Returns filename and any ENVI headers or GDAL metadata which go with it
+    that exist.
+
+    :param filename: string
+    :return: files
+    :rtype: list
+    """
+    files = [filename]
+    for companion in [filename + ".hdr", os.path.splitext(filename)[0] + ".hdr", filename + ".aux.xml"]:
+        if os.path.isfile(companion) and companion not in files:
+            files.append(companion)
+    return files
+
+def _link_or_copy(source, destination):
+    """
+    Hard links source to destination, copying it if they are on different
+    file systems. Any file (or link to a cache entry) already at destination
+    is removed first rather than written through.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+class DerivedCache(object):
+    """
+    Cache of derived files, each entry is a folder named after its key holding
+    the files and an entry.json describing them. Hits and misses are counted
+    for the job log, and messages holds everything the cache has logged.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.messages = []
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                #another job may have made it in the meantime
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _log(self, message, level=logging.INFO):
+        logger.log(level, message)
+        self.messages.append(message)
+
+    def fetch(self, key, output_folder, stem=None):
+        """
+        Links the files for key in to output_folder. Returns the entry details
+        (the files, relative to output_folder, and anything stored alongside
+        them) or None if key isn't in the cache.
+
+        If the entry was stored with a stem and stem is given, the files are
+        renamed so they start with stem instead.
+
+        :param key: string
+        :param output_folder: string
+        :param stem: string
+        :return: details
+        :rtype: dict
+        """
+        entry = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry, ENTRY_INFO), 'r') as info_file:
+                details = json.load(info_file)
+            files = details["files"]
+            if stem is not None and details.get("stem") is not None:
+                files = [stem + filename[len(details["stem"]):] for filename in files]
+            for filename, output_filename in zip(details["files"], files):
+                _link_or_copy(os.path.join(entry, filename), os.path.join(output_folder, output_filename))
+            #mark it as recently used
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError, KeyError):
+            self.misses += 1
+            self._log("derived cache miss for {}".format(key))
+            return None
+        details["files"] = files
+        self.hits += 1
+        self._log("derived cache hit for {}, linked {} in to {}".format(key, ", ".join(files), output_folder))
+        return details
+
+    def store(self, key, files, **details):
+        """
+        Adds files to the cache under key along with any extra details (which
+        must be serialisable to json), if they all start with the same name
+        this can be given as stem so fetch can rename them. It then
+        trims the cache back down to its size limit. Failures are logged and
+        otherwise ignored as the cache is only an optimisation.
+
+        :param key: string
+        :param files: list of filenames in the same folder
+        :return: None
+        """
+        entry = self.entry_dir(key)
+        if os.path.isdir(entry):
+            return
+        details["files"] = [os.path.basename(filename) for filename in files]
+        staging = None
+        try:
+            #build the entry to the side and move it in so other jobs never see half of one
+            staging = tempfile.mkdtemp(prefix=".staging_", dir=self.cache_dir)
+            for filename in files:
+                _link_or_copy(filename, os.path.join(staging, os.path.basename(filename)))
+            with open(os.path.join(staging, ENTRY_INFO), 'w') as info_file:
+                json.dump(details, info_file)
+            os.rename(staging, entry)
+        except (IOError, OSError) as exc:
+            self._log("could not add {} to the derived cache: {}".format(key, exc), logging.WARNING)
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is under its
+        size limit.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = self.entry_dir(key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry)])
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                #removed by another job
+                continue
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._log("evicting {} from the derived cache".format(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def log_stats(self):
+        self._log("derived cache: {} hits, {} misses".format(self.hits, self.misses))
+
+def open_cache():
+    """
+    Returns a DerivedCache in scops_common.DERIVED_CACHE_DIR, or None if the
+    cache is turned off or can't be used.
+
+    :return: cache
+    :rtype: DerivedCache
+    """
+    if not scops_common.USE_DERIVED_CACHE:
+        return None
+    try:
+        return DerivedCache(scops_common.DERIVED_CACHE_DIR,
+                            float(scops_common.DERIVED_CACHE_SIZE_GB) * 1024 ** 3)
+    except OSError as exc:
+        logger.warning("derived cache unavailable: {}".format(exc))
+        return None
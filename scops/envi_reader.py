@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Readers for the level1b style image files used by the processor chain.
+
+ENVI files with a plain binary layout are exposed as a numpy memmap so
+consumers can take band or row views without copying the data, anything else
+falls back to reading through GDAL.
+
+Available functions
+read_envi_header: parses an ENVI .hdr file into a dictionary
+rewrite_envi_header: writes a copy of an ENVI header with some items changed
+find_header: finds the .hdr file which goes with a binary file
+open_image: returns the best reader available for a file
+"""
+import os
+import re
+
+import numpy
+import gdal
+
+#ENVI data type codes and their numpy equivalents
+ENVI_DATA_TYPES = {1: numpy.uint8,
+                   2: numpy.int16,
+                   3: numpy.int32,
+                   4: numpy.float32,
+                   5: numpy.float64,
+                   12: numpy.uint16,
+                   13: numpy.uint32,
+                   14: numpy.int64,
+                   15: numpy.uint64}
+
+#a key = value item of an ENVI header, values in {} can run over several lines
+HEADER_ITEM = re.compile(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', re.MULTILINE)
+
+def read_envi_header(header_file):
+    """
+    Reads an ENVI header into a dictionary. Keys are lower case, values are
+    left as strings except for {} lists which are split into lists of strings.
+
+    :param header_file: string
+    :return: header
+    :rtype: dict
+    """
+    header = {}
+    with open(header_file, 'r') as hdr:
+        text = hdr.read()
+    if not text.startswith("ENVI"):
+        raise IOError("{} is not an ENVI header".format(header_file))
+    #values in {} can run over several lines, so match on the whole file
+    for match in HEADER_ITEM.finditer(text):
+        key = match.group(1).strip().lower()
+        value = match.group(2).strip()
+        if value.startswith("{"):
+            value = [item.strip() for item in value[1:-1].split(",")]
+            if value == ['']:
+                value = []
+        header[key] = value
+    return header
+
+def rewrite_envi_header(header_file, output_header, changes):
+    """
+    Writes a copy of an ENVI header with the items in changes replaced, the
+    rest of the header is kept as it is. Values can be strings or lists,
+    which are written out in {}.
+
+    :param header_file: string
+    :param output_header: string
+    :param changes: dict of lower case item names and new values
+    :return: None
+    """
+    def change_item(match):
+        key = match.group(1).strip().lower()
+        if key not in changes:
+            return match.group(0)
+        value = changes[key]
+        if isinstance(value, list):
+            value = "{{{}}}".format(", ".join([str(item) for item in value]))
+        return "{} = {}".format(match.group(1), value)
+
+    with open(header_file, 'r') as hdr:
+        text = hdr.read()
+    with open(output_header, 'w') as hdr:
+        hdr.write(HEADER_ITEM.sub(change_item, text))
+
+def find_header(filename):
+    """
+    Returns the header for a binary file, ENVI allows either file.bil.hdr
+    or file.hdr. Returns None if neither exists.
+
+    :param filename: string
+    :return: header filename
+    :rtype: string
+    """
+    for header_file in [filename + ".hdr", os.path.splitext(filename)[0] + ".hdr"]:
+        if os.path.isfile(header_file):
+            return header_file
+    return None
+
+class ImageReader(object):
+    """
+    Abstract class for image readers.
+
+    Bands are numbered from 1 as they are in GDAL and the band math equations.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = 0
+        self.cols = 0
+        self.band_count = 0
+        self.dtype = None
+        self.wavelengths = None
+        self.fwhm = None
+
+    def read_block(self, first_row, nrows, bands=None):
+        """
+        Returns an array of shape (bands, nrows, cols) holding the requested
+        bands for a block of rows. If bands is None all bands are returned.
+        Readers must provide an implementation of this
+        """
+        raise NotImplementedError
+
+    def band(self, band):
+        """
+        Returns a (rows, cols) array for the whole of a band.
+        """
+        return self.read_block(0, self.rows, [band])[0]
+
+    def close(self):
+        pass
+
+class BilReader(ImageReader):
+    """
+    Reader for uncompressed ENVI files. The file is memory mapped and the cube
+    attribute is a view of it in its native interleave, band, row and block
+    access are all views on to it so nothing is copied until it is used.
+    """
+
+    def __init__(self, filename, header=None):
+        super(BilReader, self).__init__(filename)
+        if header is None:
+            header_file = find_header(filename)
+            if header_file is None:
+                raise IOError("Could not find a header for {}".format(filename))
+            header = read_envi_header(header_file)
+        if int(header.get("file compression", 0)) != 0:
+            raise IOError("{} is compressed and can't be memory mapped".format(filename))
+
+        self.header = header
+        self.rows = int(header["lines"])
+        self.cols = int(header["samples"])
+        self.band_count = int(header["bands"])
+        self.interleave = header.get("interleave", "bsq").lower()
+        try:
+            dtype = numpy.dtype(ENVI_DATA_TYPES[int(header["data type"])])
+        except KeyError:
+            raise IOError("Unsupported ENVI data type {} in {}".format(header.get("data type"), filename))
+        if int(header.get("byte order", 0)) == 1:
+            dtype = dtype.newbyteorder(">")
+        else:
+            dtype = dtype.newbyteorder("<")
+        self.dtype = dtype
+
+        if "wavelength" in header:
+            self.wavelengths = [float(w) for w in header["wavelength"]]
+        if "fwhm" in header:
+            self.fwhm = [float(w) for w in header["fwhm"]]
+
+        if self.interleave == "bil":
+            shape = (self.rows, self.band_count, self.cols)
+        elif self.interleave == "bip":
+            shape = (self.rows, self.cols, self.band_count)
+        elif self.interleave == "bsq":
+            shape = (self.band_count, self.rows, self.cols)
+        else:
+            raise IOError("Unknown interleave {} in {}".format(self.interleave, filename))
+        self.cube = numpy.memmap(filename, dtype=self.dtype, mode='r',
+                                 offset=int(header.get("header offset", 0)),
+                                 shape=shape)
+
+    def rows_view(self, first_row, nrows):
+        """
+        Returns the block of rows as a view of the cube in its native interleave
+        """
+        if self.interleave == "bsq":
+            return self.cube[:, first_row:first_row + nrows, :]
+        return self.cube[first_row:first_row + nrows]
+
+    def read_block(self, first_row, nrows, bands=None):
+        block = self.rows_view(first_row, nrows)
+        #put the block in to (bands, rows, cols) order, this is only a view
+        if self.interleave == "bil":
+            block = block.transpose(1, 0, 2)
+        elif self.interleave == "bip":
+            block = block.transpose(2, 0, 1)
+        if bands is None:
+            return block
+        indices = [int(b) - 1 for b in bands]
+        if len(indices) > 0 and indices == list(range(indices[0], indices[0] + len(indices))):
+            #a contiguous run of bands can be sliced without a copy
+            return block[indices[0]:indices[0] + len(indices)]
+        return block[indices]
+
+    def band(self, band):
+        """
+        Returns a (rows, cols) view of a single band of the cube
+        """
+        if self.interleave == "bil":
+            return self.cube[:, int(band) - 1, :]
+        elif self.interleave == "bip":
+            return self.cube[:, :, int(band) - 1]
+        return self.cube[int(band) - 1]
+
+    def close(self):
+        self.cube = None
+
+class GdalReader(ImageReader):
+    """
+    Reader for any GDAL supported file, used where a file can't be mapped.
+    """
+
+    def __init__(self, filename):
+        super(GdalReader, self).__init__(filename)
+        self.dataset = gdal.Open(filename)
+        if self.dataset is None:
+            raise IOError("Could not open {}".format(filename))
+        self.rows = self.dataset.RasterYSize
+        self.cols = self.dataset.RasterXSize
+        self.band_count = self.dataset.RasterCount
+        wavelengths = [self.dataset.GetRasterBand(b + 1).GetMetadataItem("Wavelength")
+                       for b in range(self.band_count)]
+        if None not in wavelengths:
+            self.wavelengths = [float(w) for w in wavelengths]
+
+    def read_block(self, first_row, nrows, bands=None):
+        if bands is None:
+            bands = range(1, self.band_count + 1)
+        return numpy.array([self.dataset.GetRasterBand(int(band)).ReadAsArray(0, first_row, self.cols, nrows)
+                            for band in bands])
+
+    def close(self):
+        self.dataset = None
+
+def open_image(filename):
+    """
+    Opens a file with a memory mapped BilReader if it is an uncompressed ENVI
+    file, otherwise with a GdalReader.
+
+    :param filename: string
+    :return: reader
+    :rtype: ImageReader
+    """
+    header_file = find_header(filename)
+    if header_file is not None:
+        try:
+            return BilReader(filename, read_envi_header(header_file))
+        except (IOError, KeyError, ValueError):
+            pass
+    return GdalReader(filename)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Runs the products of a line (the main line, band math and plugin outputs)
+through APL at the same time, in a bounded number of worker processes sized
+from the cores and memory allocated to the job.
+
+Available functions
+available_cores: number of cores allocated to the job
+available_memory: bytes of memory allocated to the job
+product_workers: number of products to run at once
+cores_per_product: number of cores each product running at once can use
+LineExecutor: runs tasks in worker processes, at most workers at a time
+"""
+import atexit
+import multiprocessing
+import os
+import sys
+import traceback
+
+from scops import scops_common
+
+#environment variables queue systems use for the number of cores a job was given
+CORE_VARIABLES = ["NSLOTS", "LSB_DJOB_NUMPROC", "SLURM_CPUS_ON_NODE", "PBS_NUM_PPN"]
+
+#files holding the memory limit of the job's cgroup, version 2 then version 1
+CGROUP_MEMORY_FILES = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+
+#environment variables queue systems use for the memory a job asked for, in
+#megabytes for SLURM and with a unit (e.g. 16gb) for PBS and SGE
+MEMORY_VARIABLES = ["SLURM_MEM_PER_NODE", "PBS_RESC_MEM", "PBS_RESOURCE_MEM", "SGE_HGR_h_vmem", "SGE_HGR_mem_free"]
+
+#multipliers of the units memory requests are given in
+MEMORY_UNITS = {"": 1024 ** 2, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+#products the line being run has, set by LineExecutor so the cores of
+#workers it has no product for are shared between the ones it has
+_line_products = None
+
+def available_cores():
+    """
+    Returns the number of cores allocated to the job by the queue system,
+    or the number the process can run on if it isn't running under one.
+
+    :return: cores
+    :rtype: int
+    """
+    for variable in CORE_VARIABLES:
+        try:
+            return max(1, int(os.environ[variable]))
+        except (KeyError, ValueError):
+            pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+def _parse_memory(value):
+    """
+    Returns the bytes given by a memory request such as 16gb, 4G or 2048
+    (megabytes), or None if it can't be read
+    """
+    value = value.strip().lower()
+    if value.endswith("b") and len(value) > 1 and not value[-2].isdigit():
+        value = value[:-1]
+    number = value.rstrip("".join(MEMORY_UNITS.keys()))
+    unit = value[len(number):]
+    try:
+        return float(number) * MEMORY_UNITS[unit]
+    except (KeyError, ValueError):
+        return None
+
+def _cgroup_memory():
+    """
+    Returns the memory limit of the cgroup the process runs in, or None if
+    it has no limit
+    """
+    for memory_file in CGROUP_MEMORY_FILES:
+        try:
+            with open(memory_file, 'r') as limit_file:
+                limit = limit_file.read().strip()
+        except (IOError, OSError):
+            continue
+        try:
+            limit = float(limit)
+        except ValueError:
+            #memory.max holds "max" when there is no limit
+            return None
+        #version 1 gives a huge number rather than no limit
+        if limit <= 0 or limit >= 2 ** 62:
+            return None
+        return limit
+    return None
+
+def _requested_memory():
+    """
+    Returns the memory the job asked the queue system for, or None if it
+    isn't running under one
+    """
+    for variable in MEMORY_VARIABLES:
+        if os.environ.get(variable, "") != "":
+            memory = _parse_memory(os.environ[variable])
+            if memory is not None and memory > 0:
+                return memory
+    return None
+
+def available_memory():
+    """
+    Returns the bytes of memory allocated to the job, from
+    scops_common.JOB_MEMORY_GB if it is set, otherwise the smaller of the
+    memory limit of the job's cgroup and the memory requested from the queue
+    system, falling back to the physical memory of the machine if neither
+    is set.
+
+    :return: memory
+    :rtype: float
+    """
+    if float(scops_common.JOB_MEMORY_GB) > 0:
+        return float(scops_common.JOB_MEMORY_GB) * 1024 ** 3
+    limits = [limit for limit in [_cgroup_memory(), _requested_memory()] if limit is not None]
+    if len(limits) > 0:
+        return min(limits)
+    try:
+        return float(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (ValueError, OSError, AttributeError):
+        return float(scops_common.PRODUCT_MEMORY_GB) * 1024 ** 3
+
+def product_workers():
+    """
+    Returns how many products of a line to run at once, scops_common.PRODUCT_WORKERS
+    if it is set otherwise as many as the cores and memory allow.
+
+    :return: workers
+    :rtype: int
+    """
+    if int(scops_common.PRODUCT_WORKERS) > 0:
+        return int(scops_common.PRODUCT_WORKERS)
+    by_memory = int(available_memory() // (float(scops_common.PRODUCT_MEMORY_GB) * 1024 ** 3))
+    return max(1, min(available_cores(), by_memory))
+
+def cores_per_product(products=None):
+    """
+    Returns the number of cores each product can use when product_workers
+    are running at once, e.g. for aplmap processes of its own. If the line
+    has fewer products than that the cores are shared between those.
+
+    :param products: int, products of the line, defaults to those given to the LineExecutor
+    :return: cores
+    :rtype: int
+    """
+    if products is None:
+        products = _line_products
+    workers = product_workers()
+    if products is not None:
+        workers = min(workers, max(1, int(products)))
+    return max(1, available_cores() // workers)
+
+def _clear_exit_handlers():
+    """
+    Drops the atexit handlers inherited from the parent process
+    """
+    if hasattr(atexit, "_clear"):
+        atexit._clear()
+    else:
+        del atexit._exithandlers[:]
+
+def _run_task(function, args, kwargs):
+    """
+    Runs a task in a worker process. Workers finish with os._exit so don't run
+    atexit handlers, the ones the task registered (e.g. the writeback of a
+    failed line) are run here instead.
+    """
+    _clear_exit_handlers()
+    try:
+        function(*args, **kwargs)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        atexit._run_exitfuncs()
+
+class LineExecutor(object):
+    """
+    Runs tasks in forked worker processes, no more than workers at a time. With
+    one worker tasks are run straight away in the calling process, so errors
+    are raised from submit as they always have been. Otherwise failures are
+    collected and raised from join once every task has finished. Given the
+    number of products the line has, cores_per_product shares the cores
+    between that many rather than product_workers.
+    """
+
+    def __init__(self, workers=None, products=None):
+        global _line_products
+        if workers is None:
+            workers = product_workers()
+        if products is not None:
+            #no more workers than there are products to run
+            workers = min(int(workers), max(1, int(products)))
+            _line_products = products
+        self.workers = max(1, int(workers))
+        self.running = []
+        self.failed = []
+
+    @property
+    def concurrent(self):
+        return self.workers > 1
+
+    def submit(self, name, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs), waiting for a free worker first
+        """
+        if not self.concurrent:
+            function(*args, **kwargs)
+            return
+        self._wait(self.workers - 1)
+        process = multiprocessing.Process(target=_run_task, args=(function, args, kwargs), name=name)
+        process.start()
+        self.running.append(process)
+
+    def _wait(self, limit):
+        """
+        Waits until no more than limit tasks are running
+        """
+        while len(self.running) > limit:
+            for process in list(self.running):
+                process.join(0.1)
+                if not process.is_alive():
+                    self.running.remove(process)
+                    if process.exitcode != 0:
+                        self.failed.append(process.name)
+
+    def join(self):
+        """
+        Waits for every task to finish, raising an exception naming any that failed
+        """
+        self._wait(0)
+        if len(self.failed) > 0:
+            failed = self.failed
+            self.failed = []
+            raise Exception("Processing failed for {}".format(", ".join(failed)))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Geometric correction (aplcorr) and reprojection (apltran) of a line, shared
+by the main line and every band math and plugin product made from it.
+
+The IGM files only depend on the line, its navigation, the view vectors, the
+DEM and the projection, so they are made once in the order's igm folder and
+reused by each product, including products processed in temporary space. A
+lock file stops products running at the same time from making them twice and
+a key file next to each IGM records what it was made from, so a change of DEM
+or projection makes it again.
+
+Available functions
+GeometryError: raised when aplcorr or apltran fails, holding the stage
+geometry_lock: holds an exclusive lock on the geometry of a line
+shared_geometry: returns the IGM files for a line, making them if needed
+"""
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+from scops import derived_cache
+
+from arsf_dem import dem_common_functions
+
+logger = logging.getLogger()
+
+#suffix of the file recording what an IGM was made from
+KEY_SUFFIX = ".key"
+#suffix of the file locked while a line's IGMs are made
+LOCK_SUFFIX = ".lock"
+
+class GeometryError(Exception):
+    """
+    Raised when aplcorr or apltran fails, stage is the one that failed
+    """
+
+    def __init__(self, stage, message):
+        Exception.__init__(self, message)
+        self.stage = stage
+
+@contextlib.contextmanager
+def geometry_lock(igm_file):
+    """
+    Holds an exclusive lock on the IGM files of a line. The lock is released
+    by the system if the process dies, so a failed product doesn't block the
+    others.
+
+    :param igm_file: string
+    """
+    with open(igm_file + LOCK_SUFFIX, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def _current(filename, key):
+    """
+    Returns True if filename exists and was made from the inputs in key
+    """
+    try:
+        with open(filename + KEY_SUFFIX, 'r') as key_file:
+            return os.path.isfile(filename) and key_file.read().strip() == key
+    except IOError:
+        return False
+
+def _publish(made_file, filename, key):
+    """
+    Moves made_file and its header over filename, then records key. Each file
+    is renamed in to place so other products never read part of one.
+    """
+    if os.path.exists(filename + KEY_SUFFIX):
+        os.remove(filename + KEY_SUFFIX)
+    for source in derived_cache.companion_files(made_file):
+        if source.startswith(made_file):
+            destination = filename + source[len(made_file):]
+        else:
+            destination = os.path.splitext(filename)[0] + ".hdr"
+        shutil.move(source, destination + ".partial")
+        os.rename(destination + ".partial", destination)
+    with open(filename + KEY_SUFFIX + ".partial", 'w') as key_file:
+        key_file.write(key)
+    os.rename(filename + KEY_SUFFIX + ".partial", filename + KEY_SUFFIX)
+
+def _run(command, output, stage):
+    """
+    Runs an APL command, raising GeometryError if it fails or output isn't made
+    """
+    try:
+        dem_common_functions.CallSubprocessOn(command, redirect=False, logger=logger)
+        if not os.path.exists(output):
+            raise Exception("igm file not output by {}!".format(stage))
+    except Exception as e:
+        raise GeometryError(stage, e)
+
+def shared_geometry(igm_folder, line_name, projection_name, lev1file, nav_file, vv_file, dem, outproj_args, work_folder=None, status=None):
+    """
+    Returns the IGM file for a line and the IGM transformed to projection_name,
+    running aplcorr and apltran only if they haven't already been run on the
+    same inputs. The files are made in work_folder (e.g. fast temporary space)
+    and moved in to igm_folder when complete.
+
+    :param igm_folder: string
+    :param line_name: string
+    :param projection_name: string used in the transformed IGM name
+    :param lev1file: string
+    :param nav_file: string
+    :param vv_file: string
+    :param dem: string
+    :param outproj_args: list of apltran arguments for the output projection
+    :param work_folder: string, defaults to igm_folder
+    :param status: function called with the stage name before each stage is run
+    :return: igm_file
+    :rtype: string
+    :return: igm_file_transformed
+    :rtype: string
+    """
+    igm_file = os.path.join(igm_folder, line_name + ".igm")
+    igm_file_transformed = igm_file.replace(".igm", "_{}.igm").format(projection_name.replace(' ', '_'))
+    aplcorr_key = derived_cache.cache_key([lev1file, nav_file, vv_file, dem], "aplcorr")
+
+    def apltran_key():
+        return derived_cache.cache_key([igm_file], "apltran", outproj_args)
+
+    if _current(igm_file, aplcorr_key) and _current(igm_file_transformed, apltran_key()):
+        logger.info("reusing geometry of {} from {}".format(line_name, igm_folder))
+        return igm_file, igm_file_transformed
+
+    if work_folder is None:
+        work_folder = igm_folder
+
+    with geometry_lock(igm_file):
+        make_folder = tempfile.mkdtemp(prefix=".geometry_", dir=work_folder)
+        try:
+            #another product may have made them while we waited for the lock
+            if _current(igm_file, aplcorr_key):
+                logger.info("reusing {}".format(igm_file))
+            else:
+                if status is not None:
+                    status("aplcorr")
+                made_file = os.path.join(make_folder, os.path.basename(igm_file))
+                aplcorr_cmd = ["aplcorr"]
+                aplcorr_cmd.extend(["-lev1file", lev1file])
+                aplcorr_cmd.extend(["-navfile", nav_file])
+                aplcorr_cmd.extend(["-vvfile", vv_file])
+                aplcorr_cmd.extend(["-dem", dem])
+                aplcorr_cmd.extend(["-igmfile", made_file])
+                _run(aplcorr_cmd, made_file, "aplcorr")
+                _publish(made_file, igm_file, aplcorr_key)
+
+            if _current(igm_file_transformed, apltran_key()):
+                logger.info("reusing {}".format(igm_file_transformed))
+            else:
+                if status is not None:
+                    status("apltran")
+                made_file = os.path.join(make_folder, os.path.basename(igm_file_transformed))
+                apltran_cmd = ["apltran"]
+                apltran_cmd.extend(["-inproj", "latlong", "WGS84"])
+                apltran_cmd.extend(["-igm", igm_file])
+                apltran_cmd.extend(["-output", made_file])
+                apltran_cmd.extend(outproj_args)
+                _run(apltran_cmd, made_file, "apltran")
+                _publish(made_file, igm_file_transformed, apltran_key())
+        finally:
+            shutil.rmtree(make_folder, ignore_errors=True)
+    return igm_file, igm_file_transformed
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Splits long lines in to overlapping along track segments which are masked
+and mapped side by side, then mosaicked back in to a single mapped file.
+
+The geometry of the whole line is made once (see line_geometry) and each
+segment takes its rows of the transformed IGM. Every segment is mapped on to
+the same grid, anchored on the corner of the whole line, so the mosaic only
+has to place them. Segments overlap by OVERLAP_ROWS scan lines so the map
+pixels at the joins have all the scan lines they are interpolated from. Each
+overlap is split along the scan line at its middle, each side taking the
+segment which covers it from its interior, with the other segment only
+filling pixels that one has no data for.
+
+When the segments are masked their interior rows are also written in to a
+masked file for the whole line, as a line masked in one go would have.
+
+Available functions
+segment_count: number of segments to split a file in to
+interior_rows: splits the rows of a line in to the rows each segment covers
+segment_rows: splits the rows of a line in to overlapping segments
+cut_rows: copies a range of rows of a BIL file to a new file
+igm_bounds: finds the map extent of some rows of an IGM file
+boundary_line: finds where a scan line splits the map between two segments
+segment_area: returns the aplmap -area for a segment on the grid of the line
+mosaic_segments: places mapped segments in to one file
+run_segmented_aplmap: masks and maps a line in segments and mosaics them
+"""
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import gdal
+
+from scops import scops_common
+from scops import envi_reader
+from scops import line_executor
+from scops import aplmap_chunks
+from scops import log_tailer
+
+logger = logging.getLogger()
+
+#scan lines shared by neighbouring segments
+OVERLAP_ROWS = 64
+
+#pixels added round each segment's area so the edges of its swath aren't cut off
+AREA_PAD_PIXELS = 2
+
+def segment_count(rows):
+    """
+    Returns the number of segments to split a line of rows scan lines in to,
+    one for every scops_common.LINE_SEGMENT_ROWS rows or 1 if it isn't set.
+
+    :param rows: int
+    :return: segments
+    :rtype: int
+    """
+    if int(scops_common.LINE_SEGMENT_ROWS) <= 0:
+        return 1
+    return max(1, int(round(rows / float(scops_common.LINE_SEGMENT_ROWS))))
+
+def interior_rows(rows, segments):
+    """
+    Splits rows scan lines in to segments (first_row, last_row) ranges of
+    about the same length which don't overlap, the rows each segment covers
+    from its interior.
+
+    :param rows: int
+    :param segments: int
+    :return: ranges
+    :rtype: list
+    """
+    segments = max(1, min(int(segments), rows))
+    return [(segment * rows // segments, (segment + 1) * rows // segments) for segment in range(segments)]
+
+def segment_rows(rows, segments, overlap=OVERLAP_ROWS):
+    """
+    Splits rows scan lines in to segments (first_row, nrows) ranges of about
+    the same length, each reaching overlap rows in to its neighbours.
+
+    :param rows: int
+    :param segments: int
+    :param overlap: int
+    :return: ranges
+    :rtype: list
+    """
+    ranges = []
+    for first, last in interior_rows(rows, segments):
+        first = max(0, first - overlap)
+        last = min(rows, last + overlap)
+        ranges.append((first, last - first))
+    return ranges
+
+def _bil_reader(filename):
+    """
+    Opens filename, raising an exception if it isn't an uncompressed BIL
+    """
+    reader = envi_reader.open_image(filename)
+    if not isinstance(reader, envi_reader.BilReader) or reader.interleave != "bil":
+        reader.close()
+        raise Exception("{} is not an uncompressed BIL file".format(filename))
+    return reader
+
+def cut_rows(filename, first_row, nrows, output_file, blocksize=None):
+    """
+    Copies nrows rows of a BIL file starting at first_row to output_file,
+    with a copy of its header describing the new file.
+
+    :param filename: string
+    :param first_row: int
+    :param nrows: int
+    :param output_file: string
+    :param blocksize: int, defaults to scops_common.BANDMATH_BLOCK_ROWS
+    :return: output_file
+    :rtype: string
+    """
+    if blocksize is None:
+        blocksize = scops_common.BANDMATH_BLOCK_ROWS
+    blocksize = max(1, int(blocksize))
+    reader = _bil_reader(filename)
+    try:
+        with open(output_file, 'wb') as output:
+            for row in range(first_row, first_row + nrows, blocksize):
+                reader.rows_view(row, min(blocksize, first_row + nrows - row)).tofile(output)
+    finally:
+        reader.close()
+    envi_reader.rewrite_envi_header(envi_reader.find_header(filename), output_file + ".hdr",
+                                    {"lines": nrows, "header offset": 0})
+    return output_file
+
+def igm_bounds(igm_file, first_row=0, nrows=None):
+    """
+    Returns (min x, max x, min y, max y) of a range of rows of an IGM file,
+    ignoring any pixels set to its data ignore value.
+
+    :param igm_file: string
+    :param first_row: int
+    :param nrows: int, defaults to the rest of the file
+    :return: bounds
+    :rtype: tuple
+    """
+    reader = _bil_reader(igm_file)
+    if nrows is None:
+        nrows = reader.rows - first_row
+    ignore = reader.header.get("data ignore value")
+    bounds = [numpy.inf, -numpy.inf, numpy.inf, -numpy.inf]
+    blocksize = max(1, int(scops_common.BANDMATH_BLOCK_ROWS))
+    try:
+        for row in range(first_row, first_row + nrows, blocksize):
+            block = reader.read_block(row, min(blocksize, first_row + nrows - row), [1, 2])
+            valid = numpy.isfinite(block).all(axis=0)
+            if ignore is not None:
+                valid &= (block != float(ignore)).all(axis=0)
+            if valid.any():
+                x = block[0][valid]
+                y = block[1][valid]
+                bounds = [min(bounds[0], x.min()), max(bounds[1], x.max()),
+                          min(bounds[2], y.min()), max(bounds[3], y.max())]
+    finally:
+        reader.close()
+    if not numpy.isfinite(bounds).all():
+        raise Exception("No valid positions in rows {} to {} of {}".format(first_row, first_row + nrows, igm_file))
+    return tuple([float(bound) for bound in bounds])
+
+def _row_positions(reader, row, ignore):
+    """
+    Returns the x and y of the valid pixels of one row of an IGM
+    """
+    block = reader.read_block(row, 1, [1, 2])
+    valid = numpy.isfinite(block).all(axis=0)
+    if ignore is not None:
+        valid &= (block != float(ignore)).all(axis=0)
+    return block[0][valid], block[1][valid]
+
+def boundary_line(igm_file, row, later_row):
+    """
+    Returns the line scan line row of an IGM makes on the map, as a point on
+    it and a normal pointing towards scan line later_row, (x, y, normal x,
+    normal y). A pixel is on the later side if its offset from the point has
+    a positive dot product with the normal. None is returned if the rows
+    don't have enough valid positions to tell.
+
+    :param igm_file: string
+    :param row: int
+    :param later_row: int
+    :return: line
+    :rtype: tuple
+    """
+    reader = _bil_reader(igm_file)
+    ignore = reader.header.get("data ignore value")
+    try:
+        x, y = _row_positions(reader, row, ignore)
+        later_x, later_y = _row_positions(reader, later_row, ignore)
+    finally:
+        reader.close()
+    if len(x) < 2 or len(later_x) == 0:
+        return None
+    normal_x = -(float(y[-1]) - float(y[0]))
+    normal_y = float(x[-1]) - float(x[0])
+    if normal_x == 0 and normal_y == 0:
+        return None
+    if normal_x * (later_x.mean() - x[0]) + normal_y * (later_y.mean() - y[0]) < 0:
+        normal_x, normal_y = -normal_x, -normal_y
+    return float(x[0]), float(y[0]), normal_x, normal_y
+
+def segment_area(segment_bounds, line_bounds, pixelx, pixely, pad=AREA_PAD_PIXELS):
+    """
+    Returns the aplmap -area (min x, max x, min y, max y) for a segment,
+    snapped to the grid of pixels anchored on the top left of the whole line
+    so that every segment lines up.
+
+    :param segment_bounds: tuple from igm_bounds for the segment
+    :param line_bounds: tuple from igm_bounds for the whole line
+    :param pixelx: float
+    :param pixely: float
+    :param pad: int, pixels to add on each side
+    :return: area
+    :rtype: list
+    """
+    origin_x = line_bounds[0]
+    origin_y = line_bounds[3]
+    min_x = origin_x + (math.floor((segment_bounds[0] - origin_x) / pixelx) - pad) * pixelx
+    max_x = origin_x + (math.ceil((segment_bounds[1] - origin_x) / pixelx) + pad) * pixelx
+    max_y = origin_y - (math.floor((origin_y - segment_bounds[3]) / pixely) - pad) * pixely
+    min_y = origin_y - (math.ceil((origin_y - segment_bounds[2]) / pixely) + pad) * pixely
+    return [min_x, max_x, min_y, max_y]
+
+def mosaic_segments(segment_files, output_file, nodata=0, blocksize=None, boundaries=None):
+    """
+    Places mapped segments on the same grid in to one BIL file covering all of
+    them. boundaries gives the line from boundary_line splitting each pair of
+    neighbouring segments, a segment's data is used on its own side of them
+    and only fills pixels without data elsewhere. Without a boundary (or if
+    boundaries isn't given) the first segment with data in a pixel is used.
+
+    :param segment_files: list of strings, in along track order
+    :param output_file: string
+    :param nodata: value aplmap fills pixels without data with
+    :param blocksize: int, defaults to scops_common.BANDMATH_BLOCK_ROWS
+    :param boundaries: list of len(segment_files) - 1 lines from boundary_line, or None
+    :return: None
+    """
+    if blocksize is None:
+        blocksize = scops_common.BANDMATH_BLOCK_ROWS
+    blocksize = max(1, int(blocksize))
+    geotransforms = []
+    for segment_file in segment_files:
+        dataset = gdal.Open(segment_file)
+        geotransforms.append(dataset.GetGeoTransform())
+        dataset = None
+    pixelx = geotransforms[0][1]
+    pixely = abs(geotransforms[0][5])
+
+    readers = [_bil_reader(segment_file) for segment_file in segment_files]
+    try:
+        origin_x = min([geotransform[0] for geotransform in geotransforms])
+        origin_y = max([geotransform[3] for geotransform in geotransforms])
+        offsets = []
+        for reader, geotransform in zip(readers, geotransforms):
+            col = (geotransform[0] - origin_x) / pixelx
+            row = (origin_y - geotransform[3]) / pixely
+            if abs(col - round(col)) > 0.01 or abs(row - round(row)) > 0.01:
+                raise Exception("{} is not on the same grid as {}".format(reader.filename, readers[0].filename))
+            offsets.append((int(round(row)), int(round(col))))
+        rows = max([row + reader.rows for (row, _), reader in zip(offsets, readers)])
+        cols = max([col + reader.cols for (_, col), reader in zip(offsets, readers)])
+        bands = readers[0].band_count
+
+        output = numpy.memmap(output_file, dtype=readers[0].dtype, mode='w+', shape=(rows, bands, cols))
+        if nodata != 0:
+            output[:] = nodata
+        if boundaries is None:
+            boundaries = [None] * (len(readers) - 1)
+        for index, (reader, (row, col)) in enumerate(zip(readers, offsets)):
+            #the boundaries before and after this segment, with the side it owns
+            sides = []
+            if index > 0 and boundaries[index - 1] is not None:
+                sides.append((boundaries[index - 1], True))
+            if index < len(readers) - 1 and boundaries[index] is not None:
+                sides.append((boundaries[index], False))
+            x = origin_x + (numpy.arange(col, col + reader.cols) + 0.5) * pixelx
+            for first_row in range(0, reader.rows, blocksize):
+                nrows = min(blocksize, reader.rows - first_row)
+                source = reader.rows_view(first_row, nrows)
+                destination = output[row + first_row:row + first_row + nrows, :, col:col + reader.cols]
+                if len(sides) == 0:
+                    owned = numpy.zeros((nrows, reader.cols), dtype=bool)
+                else:
+                    y = origin_y - (numpy.arange(row + first_row, row + first_row + nrows) + 0.5) * pixely
+                    owned = numpy.ones((nrows, reader.cols), dtype=bool)
+                    for (point_x, point_y, normal_x, normal_y), later in sides:
+                        side = normal_x * (x[numpy.newaxis, :] - point_x) + normal_y * (y[:, numpy.newaxis] - point_y)
+                        owned &= (side >= 0) if later else (side < 0)
+                take = (source != nodata) & (owned[:, numpy.newaxis, :] | (destination == nodata))
+                destination[take] = source[take]
+        output.flush()
+        output = None
+
+        map_info = list(readers[0].header["map info"])
+        map_info[1:5] = ["1", "1", repr(origin_x), repr(origin_y)]
+        envi_reader.rewrite_envi_header(envi_reader.find_header(segment_files[0]), output_file + ".hdr",
+                                        {"samples": cols, "lines": rows, "map info": map_info})
+    finally:
+        for reader in readers:
+            reader.close()
+
+def _run_command(command, log_file):
+    """
+    Runs an APL command for a segment, adding its output to the log as it
+    is written so the progress of the segment can be followed
+    """
+    logger.info(" ".join(command))
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            log_tailer.follow_processes([process], [log_file])
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    if process.returncode != 0:
+        raise Exception("{} failed, see {}".format(command[0], log_file))
+
+def _write_interior(segment_file, output_file, first_row, interior, rows):
+    """
+    Writes the interior rows of a segment in to their place in output_file, a
+    BIL holding all rows of the line. The first segment writes the header.
+    """
+    reader = _bil_reader(segment_file)
+    try:
+        row_bytes = reader.cols * reader.band_count * reader.dtype.itemsize
+        with open(output_file, 'r+b') as output:
+            output.seek(interior[0] * row_bytes)
+            reader.rows_view(interior[0] - first_row, interior[1] - interior[0]).tofile(output)
+    finally:
+        reader.close()
+    if interior[0] == 0:
+        envi_reader.rewrite_envi_header(envi_reader.find_header(segment_file), output_file + ".hdr",
+                                        {"lines": rows, "header offset": 0})
+
+def run_segmented_aplmap(lev1file, maskfile, badpix_mask, aplmask_flags, igm_file, aplmap_cmd, band_list, pixelx, pixely, mapname, segments, masked_file=None):
+    """
+    Splits a line in to segments, masks (if aplmask_flags isn't None) and maps
+    each of them, up to line_executor.cores_per_product at once, then
+    mosaics them in to mapname. If masked_file is given the interior rows of
+    the masked segments are written in to it, making the masked file of the
+    whole line.
+
+    aplmask_flags are the aplmask arguments other than -lev1, -mask and
+    -output, any use of badpix_mask in them is swapped for the segment's
+    copy. aplmap_cmd is the aplmap command without -igm, -lev1, -bandlist,
+    -mapname, -buffersize or -area.
+
+    :param lev1file: string
+    :param maskfile: string
+    :param badpix_mask: string
+    :param aplmask_flags: list or None
+    :param igm_file: string, the transformed IGM of the whole line
+    :param aplmap_cmd: list
+    :param band_list: string
+    :param pixelx: float
+    :param pixely: float
+    :param mapname: string
+    :param segments: int
+    :param masked_file: string
+    :return: None
+    """
+    reader = envi_reader.open_image(lev1file)
+    rows = reader.rows
+    reader.close()
+    ranges = segment_rows(rows, segments)
+    interiors = interior_rows(rows, segments)
+    line_bounds = igm_bounds(igm_file)
+    #split each overlap along the scan line at its middle, where the segments' interiors meet
+    boundaries = [boundary_line(igm_file, interiors[index][1], min(rows - 1, interiors[index][1] + OVERLAP_ROWS))
+                  for index in range(len(interiors) - 1)]
+    if aplmask_flags is not None and masked_file is not None:
+        #each segment writes its rows in to place as it is masked
+        open(masked_file, 'wb').close()
+    else:
+        masked_file = None
+    workers = min(len(ranges), line_executor.cores_per_product())
+    buffersize = max(256, aplmap_chunks.APLMAP_BUFFER_MB // workers)
+    work_folder = tempfile.mkdtemp(prefix=".segments_", dir=os.path.dirname(mapname))
+
+    def run_segment(index):
+        first_row, nrows = ranges[index]
+        folder = os.path.join(work_folder, "segment{}".format(index))
+        os.mkdir(folder)
+        segment_lev1 = cut_rows(lev1file, first_row, nrows, os.path.join(folder, os.path.basename(lev1file)))
+        segment_igm = cut_rows(igm_file, first_row, nrows, os.path.join(folder, os.path.basename(igm_file)))
+        if aplmask_flags is not None:
+            segment_mask = cut_rows(maskfile, first_row, nrows, os.path.join(folder, os.path.basename(maskfile)))
+            flags = list(aplmask_flags)
+            if badpix_mask is not None and badpix_mask in flags:
+                segment_badpix = cut_rows(badpix_mask, first_row, nrows, os.path.join(folder, os.path.basename(badpix_mask)))
+                flags = [segment_badpix if flag == badpix_mask else flag for flag in flags]
+            segment_masked = os.path.join(folder, "masked.bil")
+            aplmask_cmd = ["aplmask", "-lev1", segment_lev1]
+            aplmask_cmd.extend(flags)
+            aplmask_cmd.extend(["-mask", segment_mask, "-output", segment_masked])
+            _run_command(aplmask_cmd, os.path.join(folder, "aplmask.log"))
+            os.remove(segment_lev1)
+            segment_lev1 = segment_masked
+            if masked_file is not None:
+                _write_interior(segment_masked, masked_file, first_row, interiors[index], rows)
+
+        segment_mapname = os.path.join(folder, os.path.basename(mapname))
+        segment_aplmap_cmd = list(aplmap_cmd)
+        segment_aplmap_cmd.extend(["-igm", segment_igm])
+        segment_aplmap_cmd.extend(["-lev1", segment_lev1])
+        segment_aplmap_cmd.extend(["-bandlist"] + band_list.split())
+        segment_aplmap_cmd.extend(["-mapname", segment_mapname])
+        segment_aplmap_cmd.extend(["-buffersize", str(buffersize)])
+        segment_aplmap_cmd.extend(["-area"] + [repr(bound) for bound in segment_area(igm_bounds(segment_igm), line_bounds, pixelx, pixely)])
+        _run_command(segment_aplmap_cmd, os.path.join(folder, "aplmap.log"))
+        if not os.path.exists(segment_mapname):
+            raise Exception("mapped file not output by aplmap for segment {}!".format(index))
+        #the inputs aren't needed once the segment is mapped, free up the space
+        os.remove(segment_lev1)
+        return segment_mapname
+
+    pool = ThreadPool(workers)
+    try:
+        logger.info("mapping {} in {} segments, {} at a time".format(lev1file, len(ranges), workers))
+        segment_files = pool.map(run_segment, range(len(ranges)))
+        logger.info("mosaicking {} segments in to {}".format(len(segment_files), mapname))
+        mosaic_segments(segment_files, mapname, boundaries=boundaries)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(work_folder, ignore_errors=True)
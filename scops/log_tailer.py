@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Follows a line's log for the progress updater. Only the bytes appended since
+the last update are read, so checking the progress of a verbose aplmap run
+costs the same however long its log has grown.
+
+It is also used to pass on the logs of APL processes run side by side (for
+segments or band chunks) to the product's log as they are written, so its
+progress can be followed while they run.
+
+Available functions
+LogTailer: follows a log, keeping its last line and file size message
+follow_processes: waits for processes, logging their output as it is written
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger()
+
+#seconds between checks of the logs of processes being followed
+FOLLOW_SECONDS = 1
+
+#text of the lines APL writes its progress in
+PROGRESS_TEXT = "Approximate percent complete:"
+
+#word following the size APL gives for its output
+SIZE_TEXT = "megabytes"
+
+class LogTailer(object):
+    """
+    Follows logfile from where the last update got to. The log being
+    truncated or replaced is noticed and it is read again from the start.
+
+    tailer = LogTailer(logfile)
+    tailer.update()
+    tailer.progress(), tailer.filesize()
+    """
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+        self.offset = 0
+        self.inode = None
+        self.partial = ""
+        self.last_line = ""
+        self.size_line = None
+
+    def _reset(self):
+        self.offset = 0
+        self.partial = ""
+        self.last_line = ""
+        self.size_line = None
+
+    def update(self):
+        """
+        Reads anything appended to the log since the last update, returning
+        the lines completed since then
+
+        :return: lines
+        :rtype: list
+        """
+        stats = os.stat(self.logfile)
+        if stats.st_ino != self.inode or stats.st_size < self.offset:
+            self._reset()
+            self.inode = stats.st_ino
+        if stats.st_size == self.offset:
+            return []
+        with open(self.logfile, 'rb') as log:
+            log.seek(self.offset)
+            appended = log.read(stats.st_size - self.offset)
+        self.offset += len(appended)
+        lines = (self.partial + appended.decode("utf-8", "replace")).split("\n")
+        #the last piece is a line still being written, or empty after a newline
+        self.partial = lines.pop()
+        for line in lines:
+            if SIZE_TEXT in line:
+                self.size_line = line
+        if len(lines) > 0:
+            self.last_line = lines[-1] + "\n"
+        return lines
+
+    def progress(self):
+        """
+        Returns the percent complete APL last logged, or 0 if the last line of
+        the log isn't a progress line
+
+        :return: percent
+        :rtype: int
+        """
+        line = self.partial if self.partial != "" else self.last_line
+        if PROGRESS_TEXT not in line:
+            return 0
+        progress = [int(s) for s in line[-10:].split() if s.isdigit()][0]
+        #if it's greater than 100 we picked up the wrong bit of the message
+        if progress > 100:
+            progress = [int(s) for s in line[-16:].split() if s.isdigit()][0]
+        return progress
+
+    def filesize(self):
+        """
+        Returns the size of the output APL last logged and its unit
+
+        :return: (size, "MB" or "GB")
+        :rtype: tuple
+        """
+        if self.size_line is None:
+            return 0, "MB"
+        logline = self.size_line.split()
+        filesize = float(logline[logline.index(SIZE_TEXT) - 1])
+        if filesize > 500:
+            return round((filesize / 1024), 2), "GB"
+        return filesize, "MB"
+
+def follow_processes(processes, log_files, interval=None):
+    """
+    Waits for processes to finish, adding the lines each writes to its log
+    file (given in the same order) to the log every interval seconds while
+    they run.
+
+    :param processes: list of subprocess.Popen
+    :param log_files: list of strings
+    :param interval: float, defaults to FOLLOW_SECONDS
+    :return: None
+    """
+    if interval is None:
+        interval = FOLLOW_SECONDS
+    tailers = [LogTailer(log_file) for log_file in log_files]
+
+    def pass_on(final=False):
+        for tailer in tailers:
+            try:
+                lines = tailer.update()
+            except OSError:
+                continue
+            if final and tailer.partial != "":
+                lines.append(tailer.partial)
+                tailer.partial = ""
+            for line in lines:
+                logger.info(line)
+
+    while any([process.poll() is None for process in processes]):
+        pass_on()
+        time.sleep(float(interval))
+    pass_on(final=True)
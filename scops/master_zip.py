@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Builds the master zip of an order as its lines finish. Each product appends
+its zip to the master archive under a lock as soon as it is zipped, so when
+the last one completes the archive only needs checking before the PI is
+emailed rather than every zip being copied in again.
+
+A reprocessed line can't be taken back out of the archive, so it is marked
+stale and rebuilt from the line zips when the order finishes.
+
+Available functions
+master_zip_lock: holds an exclusive lock on a master zip
+append_line_zip: adds a line's zip to the master zip
+finish_master_zip: makes sure the master zip holds exactly the line zips given
+"""
+import contextlib
+import fcntl
+import logging
+import os
+import zipfile
+
+logger = logging.getLogger()
+
+#suffix of the lock file products append to a master zip under
+LOCK_SUFFIX = ".lock"
+
+#suffix of the file marking that a master zip needs rebuilding
+STALE_SUFFIX = ".stale"
+
+@contextlib.contextmanager
+def master_zip_lock(master_zip):
+    """
+    Holds an exclusive lock on master_zip, released by the system if the
+    process dies.
+
+    :param master_zip: string
+    """
+    with open(master_zip + LOCK_SUFFIX, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def _mark_stale(master_zip):
+    open(master_zip + STALE_SUFFIX, 'a').close()
+
+def append_line_zip(master_zip, line_zip, folder):
+    """
+    Adds line_zip to master_zip as folder/<zip name> uncompressed. If the
+    archive already holds the line, or can't be read after a failed append,
+    it is marked to be rebuilt by finish_master_zip instead.
+
+    :param master_zip: string
+    :param line_zip: string
+    :param folder: string, folder within the master zip
+    :return: whether the line was added
+    :rtype: bool
+    """
+    arcname = folder + "/" + os.path.basename(line_zip)
+    with master_zip_lock(master_zip):
+        if os.path.exists(master_zip + STALE_SUFFIX):
+            return False
+        try:
+            with zipfile.ZipFile(master_zip, 'a', zipfile.ZIP_STORED, allowZip64=True) as zip:
+                if arcname in zip.namelist():
+                    logger.info("{} is already in {}, it will be rebuilt".format(arcname, master_zip))
+                    _mark_stale(master_zip)
+                    return False
+                zip.write(line_zip, arcname)
+        except zipfile.BadZipfile as e:
+            logger.warning("{} could not be appended to, it will be rebuilt: {}".format(master_zip, e))
+            _mark_stale(master_zip)
+            return False
+    logger.info("added " + line_zip + " to " + master_zip)
+    return True
+
+def _matches(master_zip, expected):
+    """
+    Returns the arcnames of expected missing from master_zip, or None if it
+    holds anything else and needs rebuilding
+    """
+    if os.path.exists(master_zip + STALE_SUFFIX):
+        return None
+    if not os.path.exists(master_zip):
+        return sorted(expected)
+    try:
+        with zipfile.ZipFile(master_zip, 'r') as zip:
+            infos = zip.infolist()
+    except zipfile.BadZipfile:
+        return None
+    held = {}
+    for info in infos:
+        if info.filename in held or expected.get(info.filename, (None, -1))[1] != info.file_size:
+            return None
+        held[info.filename] = info.file_size
+    return sorted([arcname for arcname in expected if arcname not in held])
+
+def finish_master_zip(master_zip, line_zips, folder):
+    """
+    Makes sure master_zip holds exactly line_zips under folder, adding any
+    that are missing, or rebuilding it if it was marked stale or holds
+    anything else.
+
+    :param master_zip: string
+    :param line_zips: list of strings
+    :param folder: string, folder within the master zip
+    :return: None
+    """
+    expected = dict([(folder + "/" + os.path.basename(line_zip), (line_zip, os.path.getsize(line_zip)))
+                     for line_zip in line_zips])
+    with master_zip_lock(master_zip):
+        missing = _matches(master_zip, expected)
+        if missing is None:
+            logger.info("rebuilding " + master_zip)
+            with zipfile.ZipFile(master_zip + ".tmp", 'w', zipfile.ZIP_STORED, allowZip64=True) as zip:
+                for arcname in sorted(expected):
+                    zip.write(expected[arcname][0], arcname)
+            os.rename(master_zip + ".tmp", master_zip)
+            if os.path.exists(master_zip + STALE_SUFFIX):
+                os.remove(master_zip + STALE_SUFFIX)
+        elif len(missing) > 0:
+            with zipfile.ZipFile(master_zip, 'a', zipfile.ZIP_STORED, allowZip64=True) as zip:
+                for arcname in missing:
+                    logger.info("zipping " + expected[arcname][0])
+                    zip.write(expected[arcname][0], arcname)
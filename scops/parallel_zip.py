@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Writes zip files with the deflate compression of each file spread across
+several threads, for the multi GB mapped files which take as long to zip in a
+single thread as they do to map.
+
+Files are split in to CHUNK_BYTES chunks which are deflated side by side, each
+primed with the end of the chunk before so the compression is close to that
+of a single stream. All but the last chunk end on a byte aligned sync flush so
+the compressed chunks join up in to one ordinary deflate stream, and the
+archive is a standard zip64 file which any unzip tool can read.
+
+Available functions
+ParallelZipFile: a zip file being written, with files added by write
+"""
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from scops import scops_common
+from scops import line_executor
+
+#bytes of a file deflated in each task
+CHUNK_BYTES = 4 * 1024 * 1024
+
+#bytes of the previous chunk a chunk is primed with, the deflate window size
+DICTIONARY_BYTES = 32 * 1024
+
+#priming a compressor with a dictionary needs python 3.3, without it each
+#chunk starts afresh
+PRIME_CHUNKS = sys.version_info >= (3, 3)
+
+#zip record signatures and field values
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+ZIP64_END_SIGNATURE = 0x06064b50
+ZIP64_LOCATOR_SIGNATURE = 0x07064b50
+END_SIGNATURE = 0x06054b50
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_VERSION = 45
+DEFLATED = 8
+UNIX_MADE_BY = 3 << 8
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+
+def _deflate_chunk(data, dictionary, level, last):
+    """
+    Deflates one chunk as raw deflate data, primed with dictionary
+    """
+    if dictionary is not None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _dos_time(timestamp):
+    """
+    Returns the (time, date) of timestamp as stored in zip headers
+    """
+    local = time.localtime(timestamp)
+    year = max(local.tm_year, 1980)
+    return ((local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2),
+            ((year - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday)
+
+class ParallelZipFile(object):
+    """
+    A zip file being written, files are added with write and the archive is
+    finished by close. Can be used as a context manager like zipfile.ZipFile.
+
+    level is the deflate level (0-9), defaults to
+    scops_common.ZIP_COMPRESSION_LEVEL, and threads the number of chunks
+    deflated at once, defaults to scops_common.ZIP_THREADS or the cores each
+    product has if that is 0.
+    """
+
+    def __init__(self, filename, level=None, threads=None):
+        if level is None:
+            level = scops_common.ZIP_COMPRESSION_LEVEL
+        if threads is None:
+            threads = scops_common.ZIP_THREADS
+        self.level = int(level)
+        self.threads = int(threads)
+        if self.threads <= 0:
+            self.threads = line_executor.cores_per_product()
+        self.filename = filename
+        self.output = open(filename, 'wb')
+        self.entries = []
+        self.pool = None
+
+    def _deflate(self, source):
+        """
+        Writes the deflated contents of source to the archive, returning
+        (crc, compressed size, size)
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        pending = deque()
+        dictionary = None
+        chunk = source.read(CHUNK_BYTES)
+        while True:
+            next_chunk = source.read(CHUNK_BYTES)
+            last = len(next_chunk) == 0
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            pending.append(self.pool.apply_async(_deflate_chunk, (chunk, dictionary, self.level, last)))
+            #only keep a few chunks in memory per thread, writing them out in order
+            while len(pending) > 2 * self.threads or (last and len(pending) > 0):
+                data = pending.popleft().get()
+                self.output.write(data)
+                compressed_size += len(data)
+            if last:
+                break
+            if PRIME_CHUNKS:
+                dictionary = chunk[-DICTIONARY_BYTES:]
+            chunk = next_chunk
+        return crc & MAX_32, compressed_size, size
+
+    def write(self, filename, arcname=None):
+        """
+        Adds filename to the archive as arcname, deflating it across threads
+        """
+        if arcname is None:
+            arcname = os.path.basename(filename)
+        name = arcname.encode("utf-8")
+        mod_time, mod_date = _dos_time(os.path.getmtime(filename))
+        offset = self.output.tell()
+        #sizes go in the zip64 extra field and are filled in once they are known
+        self.output.write(struct.pack("<IHHHHHIIIHH", LOCAL_HEADER_SIGNATURE, ZIP64_VERSION, 0, DEFLATED,
+                                      mod_time, mod_date, 0, MAX_32, MAX_32, len(name), 20))
+        self.output.write(name)
+        self.output.write(struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, 0, 0))
+        with open(filename, 'rb') as source:
+            crc, compressed_size, size = self._deflate(source)
+        end = self.output.tell()
+        self.output.seek(offset + 14)
+        self.output.write(struct.pack("<I", crc))
+        self.output.seek(offset + 30 + len(name) + 4)
+        self.output.write(struct.pack("<QQ", size, compressed_size))
+        self.output.seek(end)
+        self.entries.append((name, mod_time, mod_date, crc, compressed_size, size, offset))
+
+    def close(self):
+        """
+        Writes the central directory and closes the archive
+        """
+        if self.output is None:
+            return
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        central_offset = self.output.tell()
+        for name, mod_time, mod_date, crc, compressed_size, size, offset in self.entries:
+            self.output.write(struct.pack("<IHHHHHHIIIHHHHHII", CENTRAL_HEADER_SIGNATURE,
+                                          UNIX_MADE_BY | ZIP64_VERSION, ZIP64_VERSION, 0, DEFLATED,
+                                          mod_time, mod_date, crc, MAX_32, MAX_32, len(name), 28, 0,
+                                          0, 0, 0o100644 << 16, MAX_32))
+            self.output.write(name)
+            self.output.write(struct.pack("<HHQQQ", ZIP64_EXTRA_ID, 24, size, compressed_size, offset))
+        central_size = self.output.tell() - central_offset
+        zip64_end_offset = self.output.tell()
+        self.output.write(struct.pack("<IQHHIIQQQQ", ZIP64_END_SIGNATURE, 44, UNIX_MADE_BY | ZIP64_VERSION,
+                                      ZIP64_VERSION, 0, 0, len(self.entries), len(self.entries),
+                                      central_size, central_offset))
+        self.output.write(struct.pack("<IIQI", ZIP64_LOCATOR_SIGNATURE, 0, zip64_end_offset, 1))
+        self.output.write(struct.pack("<IHHHHIIH", END_SIGNATURE, 0, 0,
+                                      min(len(self.entries), MAX_16), min(len(self.entries), MAX_16),
+                                      min(central_size, MAX_32), min(central_offset, MAX_32), 0))
+        self.output.close()
+        self.output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
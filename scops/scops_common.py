@@ -98,6 +98,9 @@ DOWNLOAD_LINK = SERVER_BASE + '/processor/downloads/{}?&project={}'
 #line link - used for individual line downloads
 LINE_LINK = SERVER_BASE + '/processor/downloads/{}/{}?&project={}'
 
+#folder link - used for orders delivered as GeoTIFFs, which have no master zip
+GEOTIFF_LINK = SERVER_BASE + '/processor/downloads/{}/' + WEB_MAPPED_OUTPUT + '?&project={}'
+
 #http location to access the status page
 STATUS_LINK = SERVER_BASE +'/processor/status/{}?&project={}'
 
@@ -145,9 +148,13 @@ BCC_EMAIL = "nerc-arf-code@pml.ac.uk"
 #address errors will be sent to
 ERROR_EMAIL = "nerc-arf-code@pml.ac.uk"
 
-#directory for temporary files
+#directory for temporary files, several can be given separated by colons and
+#each line goes in the one with most room
 TEMP_PROCESSING_DIR = "/tmp"
 
+#hours after which scratch folders no running line holds are removed
+SCRATCH_ORPHAN_HOURS = 48
+
 #whether to process on local file system of gridnodes
 TEMP_PROCESSING = True
 
@@ -156,8 +163,75 @@ DEBUG_FILE_WRITEBACK = False
 
 DB_LOCATION = os.path.join(os.path.dirname(__file__), "scops_status_db.db")
 
+#seconds between checks of the progress of a job's products
+PROGRESS_INTERVAL = 1
+
+#fewest seconds between progress writes for a product while its stage is unchanged
+PROGRESS_MIN_WRITE_SECONDS = 5
+
 USE_DB = True
 
+#number of scan lines read, evaluated and written at a time by scops_bandmath
+BANDMATH_BLOCK_ROWS = 512
+
+#number of threads numexpr uses for band math, 0 leaves it at the numexpr default
+BANDMATH_THREADS = 0
+
+#number of row blocks scops_bandmath reads ahead of and writes behind the one
+#being evaluated, 0 reads, evaluates and writes each block in turn
+BANDMATH_QUEUE_BLOCKS = 2
+
+#folder for the cache of level1b derived products shared between orders,
+#defaults to derived_cache under WEB_OUTPUT, set to an empty string to turn it off
+DERIVED_CACHE_DIR = None
+
+#size in gigabytes the derived product cache is trimmed to
+DERIVED_CACHE_SIZE_GB = 200
+
+#number of products of a line (main line, band math and plugin outputs) run
+#through APL at once, 0 works it out from the cores and memory of the job
+PRODUCT_WORKERS = 0
+
+#memory in gigabytes allocated to a job, 0 uses the job's cgroup limit or the
+#memory it asked the queue system for, or the memory of the machine without either
+JOB_MEMORY_GB = 0
+
+#memory in gigabytes to allow for each product running through APL at once
+PRODUCT_MEMORY_GB = 4
+
+#number of aplmap processes each product's bands are split between, 0 works
+#it out from the cores left to each product of the line running at once
+APLMAP_BAND_CHUNKS = 0
+
+#scan lines in each along track segment long lines are split in to, so the
+#segments can be masked and mapped side by side, 0 maps every line whole
+LINE_SEGMENT_ROWS = 0
+
+#number of products of an order zipped at once, their copies back from
+#temporary space run in the background
+ZIP_SLOTS = 1
+
+#deflate level (0-9) of the mapped product zips and GeoTIFFs
+ZIP_COMPRESSION_LEVEL = 6
+
+#threads each product zip or GeoTIFF is deflated across, 0 uses the cores left to each
+#product running at once
+ZIP_THREADS = 0
+
+#format mapped products are delivered in when the order's config doesn't give
+#a delivery_format, "zip" or "geotiff"
+DELIVERY_FORMAT = "zip"
+
+#threads copying outputs back from temporary space while the next stage runs
+WRITEBACK_THREADS = 2
+
+#whether copies back from temporary space are checksummed as well as sized
+WRITEBACK_VERIFY = True
+
+#whether band math equations using only bands in the main line's band_range are
+#run on its mapped output instead of being mapped from level1b themselves
+MAPPED_BANDMATH = True
+
 STAGES = ['Waiting to process','aplmask','aplcorr','apltran','aplmap','zipping', 'complete']
 
 # Now go through all variables and check if they should be overwritten
@@ -187,3 +261,15 @@ if TEMP_PROCESSING_DIR == "":
 if DB_LOCATION == "":
     #whether to append outputs to a database
     USE_DB = False
+
+if str(MAPPED_BANDMATH).lower() in ["false", "0", ""]:
+    MAPPED_BANDMATH = False
+
+if str(WRITEBACK_VERIFY).lower() in ["false", "0", ""]:
+    WRITEBACK_VERIFY = False
+
+if DERIVED_CACHE_DIR is None:
+    DERIVED_CACHE_DIR = os.path.join(WEB_OUTPUT, "derived_cache")
+
+#whether to reuse level1b derived products between orders
+USE_DERIVED_CACHE = DERIVED_CACHE_DIR != ""
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Chooses where lines are processed in temporary space. TEMP_PROCESSING_DIR
+can list several scratch roots separated by colons, each line goes in the
+root with the most room once the space other lines have reserved but not yet
+used is taken off, and only if its predicted output fits. The choice is made
+under a lock on the root so lines starting together don't all pick the same
+space.
+
+Each scratch folder holds a lock on its reservation file while the line runs.
+Folders left behind by lines which died without cleaning up have no lock, so
+are removed once they are older than scops_common.SCRATCH_ORPHAN_HOURS.
+
+Available functions
+scratch_roots: scratch roots given by TEMP_PROCESSING_DIR
+predicted_bytes: predicted temporary space needed to process a line
+scratch_usage: free, reserved and used space of a scratch root
+log_usage: logs the usage of every scratch root
+reap_orphans: removes scratch folders left by lines which have died
+ScratchSpace: a scratch folder with space reserved for it
+allocate: makes a scratch folder in the root with most room
+"""
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from scops import scops_common
+from scops import aplmap_chunks
+from scops import envi_reader
+
+logger = logging.getLogger()
+
+#folder in each scratch root holding the reservations
+RESERVATION_DIR = ".arf_scratch"
+
+#suffix of reservation files, named after the scratch folder they are for
+RESERVATION_SUFFIX = ".reserve"
+
+#name of the lock file held while choosing a root
+ROOT_LOCK = "lock"
+
+#prefix of the scratch folders made for lines
+SCRATCH_PREFIX = "ARF_WEB_"
+
+#how much larger a mapped file is than the level1b pixels it holds, the
+#mapped grid has to cover a swath which usually runs at an angle to it
+MAP_EXPANSION = 2.0
+
+def scratch_roots():
+    """
+    Returns the scratch roots listed in scops_common.TEMP_PROCESSING_DIR
+
+    :return: roots
+    :rtype: list
+    """
+    return [root for root in scops_common.TEMP_PROCESSING_DIR.split(os.pathsep) if root != ""]
+
+def predicted_bytes(lev1file, band_list, data_type, masked=True):
+    """
+    Predicts the temporary space needed to process lev1file: the masked copy
+    of it if masked is set, and the mapped file of the bands in band_list and
+    its zip, which is at worst the same size.
+
+    :param lev1file: string
+    :param band_list: string, aplmap band list
+    :param data_type: string, aplmap output data type
+    :param masked: bool
+    :return: bytes
+    :rtype: int
+    """
+    reader = envi_reader.open_image(lev1file)
+    try:
+        pixels = reader.rows * reader.cols
+        bands = len(aplmap_chunks.band_range_numbers(band_list, reader.band_count))
+        lev1_bytes = pixels * reader.band_count * reader.dtype.itemsize
+    finally:
+        reader.close()
+    mapped_bytes = int(pixels * bands * numpy.dtype(data_type).itemsize * MAP_EXPANSION)
+    return (lev1_bytes if masked else 0) + 2 * mapped_bytes
+
+def _folder_bytes(folder):
+    """
+    Returns the space used by the files in folder
+    """
+    used = 0
+    for path, _, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                used += os.lstat(os.path.join(path, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return used
+
+def _reservation_dir(root):
+    reservation_dir = os.path.join(root, RESERVATION_DIR)
+    if not os.path.isdir(reservation_dir):
+        try:
+            os.makedirs(reservation_dir)
+        except OSError:
+            if not os.path.isdir(reservation_dir):
+                raise
+    return reservation_dir
+
+def _held(reservation_file):
+    """
+    Returns whether a running line holds the lock on reservation_file
+    """
+    try:
+        with open(reservation_file, 'r') as reservation:
+            try:
+                fcntl.flock(reservation.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            fcntl.flock(reservation.fileno(), fcntl.LOCK_UN)
+    except IOError:
+        pass
+    return False
+
+def scratch_usage(root):
+    """
+    Returns the space of a scratch root, the space reserved by running lines
+    which they haven't used yet, and the space their folders use
+
+    :param root: string
+    :return: (free bytes, outstanding reserved bytes, used bytes)
+    :rtype: tuple
+    """
+    stats = os.statvfs(root)
+    free = stats.f_bavail * stats.f_frsize
+    reserved = 0
+    used = 0
+    reservation_dir = os.path.join(root, RESERVATION_DIR)
+    if os.path.isdir(reservation_dir):
+        for reservation_name in os.listdir(reservation_dir):
+            if not reservation_name.endswith(RESERVATION_SUFFIX):
+                continue
+            reservation_file = os.path.join(reservation_dir, reservation_name)
+            if not _held(reservation_file):
+                continue
+            try:
+                with open(reservation_file, 'r') as reservation:
+                    reserved_bytes = int(reservation.read().strip() or 0)
+            except (IOError, ValueError):
+                continue
+            folder_bytes = _folder_bytes(os.path.join(root, reservation_name[:-len(RESERVATION_SUFFIX)]))
+            used += folder_bytes
+            reserved += max(0, reserved_bytes - folder_bytes)
+    return free, reserved, used
+
+def log_usage(roots=None):
+    """
+    Logs the free, reserved and used space of each scratch root
+
+    :param roots: list of strings, defaults to scratch_roots()
+    :return: None
+    """
+    if roots is None:
+        roots = scratch_roots()
+    for root in roots:
+        try:
+            free, reserved, used = scratch_usage(root)
+        except OSError as e:
+            logger.warning("couldn't read scratch usage of {}: {}".format(root, e))
+            continue
+        logger.info("scratch {}: {:.1f} GB free, {:.1f} GB reserved, {:.1f} GB used by running lines".format(
+            root, free / 1024.0 ** 3, reserved / 1024.0 ** 3, used / 1024.0 ** 3))
+
+def reap_orphans(root, max_age_hours=None):
+    """
+    Removes scratch folders in root older than max_age_hours which no
+    running line holds, along with their reservations
+
+    :param root: string
+    :param max_age_hours: float, defaults to scops_common.SCRATCH_ORPHAN_HOURS
+    :return: folders removed
+    :rtype: list
+    """
+    if max_age_hours is None:
+        max_age_hours = scops_common.SCRATCH_ORPHAN_HOURS
+    oldest = time.time() - float(max_age_hours) * 3600
+    reservation_dir = os.path.join(root, RESERVATION_DIR)
+    removed = []
+    for folder_name in os.listdir(root):
+        folder = os.path.join(root, folder_name)
+        if not folder_name.startswith(SCRATCH_PREFIX) or not os.path.isdir(folder):
+            continue
+        reservation_file = os.path.join(reservation_dir, folder_name + RESERVATION_SUFFIX)
+        try:
+            if os.path.getmtime(folder) > oldest or _held(reservation_file):
+                continue
+        except OSError:
+            continue
+        logger.info("removing orphaned scratch folder " + folder)
+        shutil.rmtree(folder, ignore_errors=True)
+        if os.path.exists(reservation_file):
+            os.remove(reservation_file)
+        removed.append(folder)
+    return removed
+
+class ScratchSpace(object):
+    """
+    A scratch folder with space reserved for it, the reservation is held until
+    release is called or the process exits.
+    """
+
+    def __init__(self, root, path, reservation_file, reserved):
+        self.root = root
+        self.path = path
+        self.reservation_file = reservation_file
+        self.reserved = reserved
+        self.reservation = open(reservation_file, 'w')
+        fcntl.flock(self.reservation.fileno(), fcntl.LOCK_EX)
+        self.reservation.write(str(int(reserved)))
+        self.reservation.flush()
+
+    def release(self):
+        """
+        Gives up the reservation, the folder itself is left for the caller
+        """
+        if self.reservation is None:
+            return
+        if os.path.exists(self.reservation_file):
+            os.remove(self.reservation_file)
+        fcntl.flock(self.reservation.fileno(), fcntl.LOCK_UN)
+        self.reservation.close()
+        self.reservation = None
+
+def allocate(needed, prefix=SCRATCH_PREFIX, roots=None):
+    """
+    Makes a scratch folder with needed bytes reserved in the root with the
+    most room, clearing out orphaned folders first. Returns None if no root
+    has room, the caller should then work in the workspace instead.
+
+    :param needed: int, bytes
+    :param prefix: string, prefix of the folder name
+    :param roots: list of strings, defaults to scratch_roots()
+    :return: scratch space
+    :rtype: ScratchSpace
+    """
+    if roots is None:
+        roots = scratch_roots()
+    room = []
+    for root in roots:
+        try:
+            reap_orphans(root)
+            free, reserved, _ = scratch_usage(root)
+        except OSError as e:
+            logger.warning("skipping scratch root {}: {}".format(root, e))
+            continue
+        room.append((free - reserved, root))
+
+    #try the roomiest first, checking again under the root's lock in case another line got there first
+    for _, root in sorted(room, reverse=True):
+        reservation_dir = _reservation_dir(root)
+        with open(os.path.join(reservation_dir, ROOT_LOCK), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                free, reserved, _ = scratch_usage(root)
+                if free - reserved < needed:
+                    continue
+                path = tempfile.mkdtemp(prefix=prefix, dir=root)
+                reservation_file = os.path.join(reservation_dir, os.path.basename(path) + RESERVATION_SUFFIX)
+                scratch = ScratchSpace(root, path, reservation_file, needed)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        logger.info("reserved {:.1f} GB of scratch in {}".format(needed / 1024.0 ** 3, path))
+        return scratch
+    logger.warning("no scratch root has {:.1f} GB free".format(needed / 1024.0 ** 3))
+    log_usage(roots)
+    return None
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Copies the outputs of a line processed in temporary space back to the
+workspace in the background, each one as soon as the stage making it
+finishes, so the copy runs alongside the next stage rather than all at once
+at the end.
+
+Files are copied to a .part file which is checked against the source (size,
+and a CRC32 of what was read against one of what was written when
+scops_common.WRITEBACK_VERIFY is set) and renamed in to place, then the
+source is removed to free the temporary space.
+
+Available functions
+copy_verified: copies a file, checking the copy before renaming it in to place
+WritebackService: copies files back in background threads
+"""
+import logging
+import os
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from scops import scops_common
+
+logger = logging.getLogger()
+
+#bytes read and written at a time
+COPY_BLOCK_BYTES = 16 * 1024 * 1024
+
+#suffix of copies which haven't been checked yet
+PART_SUFFIX = ".part"
+
+def _file_crc(filename):
+    crc = 0
+    with open(filename, 'rb') as input_file:
+        block = input_file.read(COPY_BLOCK_BYTES)
+        while len(block) > 0:
+            crc = zlib.crc32(block, crc)
+            block = input_file.read(COPY_BLOCK_BYTES)
+    return crc & 0xFFFFFFFF
+
+def copy_verified(source, destination, verify=True, remove=True):
+    """
+    Copies source to destination via destination.part, checking the size of
+    the copy and, if verify is set, its CRC32 against the source. The source
+    is removed afterwards if remove is set.
+
+    :param source: string
+    :param destination: string
+    :param verify: bool
+    :param remove: bool
+    :return: None
+    """
+    destination_folder = os.path.dirname(destination)
+    if destination_folder != "" and not os.path.isdir(destination_folder):
+        try:
+            os.makedirs(destination_folder)
+        except OSError:
+            if not os.path.isdir(destination_folder):
+                raise
+    part_file = destination + PART_SUFFIX
+    crc = 0
+    size = 0
+    try:
+        with open(source, 'rb') as input_file:
+            with open(part_file, 'wb') as output_file:
+                block = input_file.read(COPY_BLOCK_BYTES)
+                while len(block) > 0:
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    output_file.write(block)
+                    block = input_file.read(COPY_BLOCK_BYTES)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+        if os.path.getsize(part_file) != size:
+            raise Exception("copy of {} is {} bytes, expected {}".format(source, os.path.getsize(part_file), size))
+        if verify and _file_crc(part_file) != crc & 0xFFFFFFFF:
+            raise Exception("copy of {} doesn't match its checksum".format(source))
+        os.rename(part_file, destination)
+    except:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+    if remove:
+        os.remove(source)
+    logger.info("wrote back {} to {}".format(source, destination))
+
+class WritebackService(object):
+    """
+    Copies files back with copy_verified in background threads. submit queues
+    a copy and returns straight away, wait blocks until copies have finished
+    and raises if any failed.
+
+    threads defaults to scops_common.WRITEBACK_THREADS and verify to
+    scops_common.WRITEBACK_VERIFY.
+    """
+
+    def __init__(self, threads=None, verify=None):
+        if threads is None:
+            threads = scops_common.WRITEBACK_THREADS
+        if verify is None:
+            verify = scops_common.WRITEBACK_VERIFY
+        self.threads = max(1, int(threads))
+        self.verify = verify
+        self.pool = None
+        self.pending = {}
+
+    def submit(self, source, destination, remove=True):
+        """
+        Starts copying source to destination in the background, removing
+        source once it is copied if remove is set
+
+        :param source: string
+        :param destination: string
+        :param remove: bool
+        :return: None
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        logger.info("writing back {} to {}".format(source, destination))
+        self.pending[source] = self.pool.apply_async(copy_verified, (source, destination, self.verify, remove))
+
+    def wait(self, sources=None):
+        """
+        Waits for the copies of sources, or all submitted copies if None,
+        raising if any of them failed
+
+        :param sources: list of strings
+        :return: None
+        """
+        if sources is None:
+            sources = list(self.pending.keys())
+        failed = []
+        for source in sources:
+            if source not in self.pending:
+                continue
+            try:
+                self.pending.pop(source).get()
+            except Exception as e:
+                logger.error("writeback of {} failed: {}".format(source, e))
+                failed.append(source)
+        if len(failed) > 0:
+            raise Exception("writeback failed for {}".format(", ".join(failed)))
+
+    def close(self):
+        """
+        Waits for any copies still going and stops the threads, failures are
+        logged rather than raised
+        """
+        try:
+            self.wait()
+        except Exception as e:
+            logger.error(e)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+###########################################################
+# This file has been created by the NERC-ARF Data Analysis Node and
+# is licensed under the GPL v3 Licence. A copy of this
+# licence is available to download with this file.
+###########################################################
+"""
+Limits how many products of an order are zipped at once.
+
+Each order has scops_common.ZIP_SLOTS slot files, a product zips while it
+holds an exclusive lock on one of them. Products waiting for a slot queue on
+another lock file, only the one at the front of the queue looks for a free
+slot (blocking on it if there is only one slot, otherwise checking every
+POLL_SECONDS) so waiting uses no CPU to speak of. Locks are freed by the
+system if the process holding them dies.
+
+Available functions
+ZipSlot: a slot to zip in, used as a context manager
+"""
+import fcntl
+import logging
+import os
+import time
+
+from scops import scops_common
+
+logger = logging.getLogger()
+
+#folder in an order's output location holding the slot files
+SLOT_DIR = ".zip_slots"
+
+#name of the lock file waiting products queue on
+QUEUE_FILE = "queue"
+
+#seconds between checks for a free slot when there are several
+POLL_SECONDS = 2
+
+class ZipSlot(object):
+    """
+    One of the zip slots of an order, acquire blocks until a slot is free.
+
+    with ZipSlot(output_location):
+        #zip
+    """
+
+    def __init__(self, output_location, slots=None):
+        if slots is None:
+            slots = scops_common.ZIP_SLOTS
+        self.slots = max(1, int(slots))
+        self.slot_dir = os.path.join(output_location, SLOT_DIR)
+        self.slot_file = None
+
+    def _open_slot(self, slot):
+        return open(os.path.join(self.slot_dir, "slot{}".format(slot)), 'a')
+
+    def _try_slots(self):
+        """
+        Takes the first free slot without waiting, returns whether it got one
+        """
+        for slot in range(self.slots):
+            slot_file = self._open_slot(slot)
+            try:
+                fcntl.flock(slot_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                slot_file.close()
+                continue
+            self.slot_file = slot_file
+            return True
+        return False
+
+    def acquire(self):
+        """
+        Takes a free slot, waiting in the queue for one if they are all in use
+        """
+        if not os.path.isdir(self.slot_dir):
+            try:
+                os.makedirs(self.slot_dir)
+            except OSError:
+                #another product may have made it in the meantime
+                if not os.path.isdir(self.slot_dir):
+                    raise
+        if self._try_slots():
+            return
+        logger.info("waiting for one of {} zip slots".format(self.slots))
+        with open(os.path.join(self.slot_dir, QUEUE_FILE), 'a') as queue_file:
+            fcntl.flock(queue_file.fileno(), fcntl.LOCK_EX)
+            try:
+                if self.slots == 1:
+                    self.slot_file = self._open_slot(0)
+                    fcntl.flock(self.slot_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    while not self._try_slots():
+                        time.sleep(POLL_SECONDS)
+            finally:
+                fcntl.flock(queue_file.fileno(), fcntl.LOCK_UN)
+
+    def release(self):
+        if self.slot_file is not None:
+            fcntl.flock(self.slot_file.fileno(), fcntl.LOCK_UN)
+            self.slot_file.close()
+            self.slot_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
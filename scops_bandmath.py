@@ -12,7 +12,16 @@ Author: Stephen Goult
 
 Available functions
 bandmath: runs a given equation on a gdal compatible file and optionally
-generates a maskfile to be used in apl
+generates a maskfile to be used in apl, working through the file in blocks of
+rows
+bandmath_multi: runs several equations on a gdal compatible file in a single
+pass, generating outputs and maskfiles for all of them
+BandmathPlugin: block plugin running several equations, so band math can share
+a pass over the file with other plugins
+bandmath_mapped: runs several equations on a file already mapped by aplmap
+MappedBandmathPlugin: block plugin running equations on a mapped file
+mapped_bands_available: checks an equation's bands are all in a mapped file
+row_blocks: splits a number of rows into blocks for streaming
 """
 from __future__ import print_function
 
@@ -21,95 +30,442 @@ import numpy
 import numexpr
 import os
 import argparse
-import re
-
-def bandmath_mask_gen(maskfile, output_name, bands, layers, rows, cols):
-    maskbil = gdal.Open(maskfile)
-    if layers == 1:
-        #if it's one we need to combine it down
-        maskarrays=[]
-        basemask=numpy.zeros((rows, cols), dtype=float)
-        for band in bands:
-            numpy.add(maskbil.GetRasterBand(int(band)).ReadAsArray(), basemask)
-        maskarray=basemask
-    if layers > 1:
-        maskarray = maskbil.ReadAsArray()
-    destination = gdal.GetDriverByName('ENVI').Create(output_name,
-                                              cols,
-                                              rows,
-                                              layers,
-                                              gdal.GDT_Byte,
-                                              ["INTERLEAVE=BIL"])
-    for i in range(layers):
-        outband = destination.GetRasterBand(i+1)
-        if layers == 1:
-            outband.WriteArray(maskarray)
-        else:
-            outband.WriteArray(maskarray[i])
-    outband = None
-    destination = None
 
-def bandmath(bilfile, equation, outputfolder, bands, eqname=None, maskfile=None, badpix_mask=None):
+from scops import scops_common
+from scops import envi_reader
+from scops import band_expressions
+from scops import block_pipeline
+from scops import block_plugins
+from scops import derived_cache
+from scops import aplmap_chunks
+
+#suffixes of the masks made alongside each output from the level1b mask files
+MASK_SUFFIX = "_mask.bil"
+BADPIX_MASK_SUFFIX = "_mask-badpixelmethod.bil"
+
+def row_blocks(rows, blocksize=None):
     """
-    Function to run a string equation, hand in a bilfile and a list of bands
-    required.
+    Generator giving (first_row, number_of_rows) tuples covering a file of
+    rows scan lines in blocks of at most blocksize lines.
+    """
+    if blocksize is None:
+        blocksize = scops_common.BANDMATH_BLOCK_ROWS
+    blocksize = max(1, int(blocksize))
+    for first_row in range(0, rows, blocksize):
+        yield first_row, min(blocksize, rows - first_row)
 
-    Bands in the equation must be in the format "bandx" where x is the number
-    (e.g. band1, band147, band650) if this standard is not kept numexpr will
-    throw an exception
-    """
-    bil = gdal.Open(bilfile)
-    banddict = {}
-    #we need to build a dictionary of band variables to hand in to numexpr
-    print(bands)
-    for band in bands:
-        print(band)
-        banddict["band{}".format(band)] = \
-                  bil.GetRasterBand(int(band)).ReadAsArray().astype(numpy.float32)
-    #local dict becomes the variable list
-    print(banddict)
-    result = numexpr.evaluate(equation,
-                              local_dict=banddict)
+def bandmath_output_name(bilfile, outputfolder, equation, eqname=None):
+    """
+    Returns the filename bandmath will write the result of equation to
+    """
     #need to come up with something sernsible to use as the name
     if eqname is None:
         equation_clean = equation.replace("*", "x").replace("/", '').replace(" ", "_")
     else:
         equation_clean = eqname
-    #see if there is more than one band output from numexp
-    try:
-        layers, rows, cols = numpy.shape(result)
-    except:
-        #if not we only have one band to deal with
-        rows, cols = numpy.shape(result)
-        layers = 1
 
     #build a clever output name
-    output_name = os.path.join(outputfolder,
-                               os.path.basename(bilfile).replace(".bil", "") +
-                               "_{}.bil".format(equation_clean))
-    #need to have a destination dataset before gdal will let us write out
-    destination = gdal.GetDriverByName('ENVI').Create(output_name,
-                                                    cols,
-                                                    rows,
-                                                    1,
-                                                    gdal.GDT_Float32,
-                                                    ["INTERLEAVE=BIL"])
-    for i in range(layers):
+    return os.path.join(outputfolder,
+                        os.path.basename(bilfile).replace(".bil", "") +
+                        "_{}.bil".format(equation_clean))
+
+def combine_mask_block(maskblock):
+    """
+    Combines a (bands, rows, cols) block of an APL mask down to a single
+    (rows, cols) uint8 layer. Mask values are bit flags so a pixel keeps every
+    reason it was masked in any of the bands.
+    """
+    return numpy.bitwise_or.reduce(numpy.asarray(maskblock, dtype=numpy.uint8), axis=0)
+
+def create_envi_output(output_name, cols, rows, layers, data_type):
+    """
+    Creates a BIL interleaved ENVI file to write the blocks out to
+    """
+    return gdal.GetDriverByName('ENVI').Create(output_name,
+                                               cols,
+                                               rows,
+                                               layers,
+                                               data_type,
+                                               ["INTERLEAVE=BIL"])
+
+def write_block(destination, result, first_row):
+    """
+    Writes a (rows, cols) or (layers, rows, cols) result in to destination
+    starting at first_row
+    """
+    if numpy.ndim(result) == 2:
+        result = [result]
+    for i, layer in enumerate(result):
         outband = destination.GetRasterBand(i+1)
+        outband.WriteArray(layer, 0, first_row)
+    outband = None
+
+def bandmath_mask_gen(maskfile, output_name, bands, layers, rows, cols, blocksize=None):
+    """
+    Generates a mask for a band math output from maskfile, combining the mask
+    of each of bands for single layer outputs
+    """
+    maskbil = envi_reader.open_image(maskfile)
+    destination = create_envi_output(output_name, cols, rows, layers, gdal.GDT_Byte)
+    #work through the mask in blocks of rows so memory doesn't scale with line length
+    for first_row, nrows in row_blocks(rows, blocksize):
         if layers == 1:
-            outband.WriteArray(result)
+            #if it's one we need to combine it down
+            maskarray = combine_mask_block(maskbil.read_block(first_row, nrows, [int(band) for band in bands]))
         else:
-            outband.WriteArray(result[i])
-    outband = None
+            maskarray = maskbil.read_block(first_row, nrows)
+        write_block(destination, maskarray, first_row)
     destination = None
+    maskbil.close()
+
+def bandmath_multi(bilfile, equations, outputfolder, maskfile=None, badpix_mask=None, blocksize=None, threads=None, queue_blocks=None, cache=None):
+    """
+    Runs a set of string equations on a bilfile in a single pass. The union of
+    the bands referenced by all the equations is read once per block of rows
+    and every equation is evaluated on it, so the cost of reading the file is
+    shared between them. The same blocks of maskfile and badpix_mask are read
+    alongside and combined for each output, so every input is only read once.
+
+    equations is a list of (eqname, equation, bands) tuples, if bands is None
+    they are taken from the "bandx" variables in the equation. Equations are
+    checked against the number of bands in bilfile before any data is read and
+    raise a ValueError if they can't be run on it.
+
+    Reading, evaluating and writing are overlapped, up to queue_blocks blocks
+    are read ahead in one thread and written behind in another while numexpr
+    evaluates the current block with threads threads. These default to
+    scops_common.BANDMATH_QUEUE_BLOCKS and scops_common.BANDMATH_THREADS, a
+    queue_blocks of 0 runs each step one after another.
+
+    If a derived_cache.DerivedCache is given as cache, outputs already made
+    from the same inputs are linked in from it and only the rest are run.
+
+    Returns a list of (output_name, layers) in the same order as equations.
+    """
+    if cache is not None:
+        return cached_bandmath_multi(bilfile, equations, outputfolder, cache,
+                                     maskfile=maskfile, badpix_mask=badpix_mask,
+                                     blocksize=blocksize, threads=threads,
+                                     queue_blocks=queue_blocks)
+
+    plugin = BandmathPlugin(bilfile, equations, outputfolder, maskfile=maskfile,
+                            badpix_mask=badpix_mask, threads=threads,
+                            queue_blocks=queue_blocks)
+    return block_plugins.run_block_plugins(bilfile, [plugin], blocksize=blocksize,
+                                           queue_blocks=queue_blocks)[0]
+
+class BandmathPlugin(block_plugins.BlockPlugin):
+    """
+    Block plugin evaluating a set of equations, with the same arguments as
+    bandmath_multi. This lets band math share a pass over the level1b file
+    with other block plugins, finish returns a list of (output_name, layers)
+    in the same order as equations.
+    """
+
+    def __init__(self, bilfile, equations, outputfolder, maskfile=None, badpix_mask=None, threads=None, queue_blocks=None):
+        self.bilfile = bilfile
+        self.equations = equations
+        self.maskfile = maskfile
+        self.badpix_mask = badpix_mask
+        if threads is None:
+            threads = scops_common.BANDMATH_THREADS
+        if queue_blocks is None:
+            queue_blocks = scops_common.BANDMATH_QUEUE_BLOCKS
+        self.threads = int(threads)
+        self.queue_blocks = queue_blocks
+
+        self.expressions = [band_expressions.parse_equation(equation) for _, equation, _ in equations]
+        self.equation_bands = []
+        for expression, (eqname, equation, bands) in zip(self.expressions, equations):
+            if bands is None:
+                bands = expression.bands
+            self.equation_bands.append(bands)
+        #variable names must match those in the equations, so key on those
+        self.all_bands = sorted(set([band for bands in self.equation_bands for band in bands]), key=int)
+        self.band_index = dict([(band, i) for i, band in enumerate(self.all_bands)])
+        self.output_names = [bandmath_output_name(bilfile, outputfolder, equation, eqname)
+                             for eqname, equation, _ in equations]
+        self.layers = [1] * len(equations)
+        self.destinations = [None] * len(equations)
+        self.mask_destinations = [None] * len(equations)
+        self.mask_readers = []
+        #outputs this run has created, removed again if it is aborted
+        self.created = []
+        self.writer = None
+        self.previous_threads = None
+
+    def bands(self):
+        return self.all_bands
+
+    def start(self, reader):
+        self.rows = reader.rows
+        self.cols = reader.cols
+        #check the equations against the file before anything is read or written
+        self.validate(reader)
+        #terms repeated between equations are evaluated once per block
+        self.shared, self.evaluated = band_expressions.shared_subexpressions(self.expressions)
+
+        #masks to generate alongside each output, as (suffix, reader)
+        if self.maskfile is not None:
+            self.mask_readers.append((MASK_SUFFIX, envi_reader.open_image(self.maskfile)))
+        if self.badpix_mask is not None:
+            self.mask_readers.append((BADPIX_MASK_SUFFIX, envi_reader.open_image(self.badpix_mask)))
+
+        if self.threads > 0:
+            self.previous_threads = numexpr.set_num_threads(self.threads)
+        #the last blocks are written behind while the next are evaluated
+        self.writer = block_pipeline.BlockWriter(self.queue_blocks)
 
-    if maskfile is not None:
-        bandmath_mask_gen(maskfile, output_name.replace(".bil", "_mask.bil"), bands, layers, rows, cols)
+    def validate(self, reader):
+        """
+        Raises a ValueError if the equations can't be run on the file
+        """
+        band_expressions.validate_bands(self.expressions, reader.band_count, self.bilfile)
 
-    if badpix_mask is not None:
-        bandmath_mask_gen(badpix_mask, output_name.replace(".bil","_mask-badpixelmethod.bil"), bands, layers, rows, cols)
+    def create_output(self, output_name, layers, data_type):
+        """
+        Creates the file an output or its mask is written to
+        """
+        return create_envi_output(output_name, self.cols, self.rows, layers, data_type)
 
-    return output_name, layers
+    def read_extra(self, first_row, nrows):
+        #the same blocks of the mask files, read ahead with the level1b block
+        return [numpy.array(reader.read_block(first_row, nrows, [int(band) for band in self.all_bands]))
+                for _, reader in self.mask_readers]
+
+    def process_block(self, first_row, block, mask_blocks):
+        results = self.evaluate_block(block)
+        self.writer.write(self.write_outputs, first_row, numpy.shape(block)[1], results, mask_blocks)
+
+    def evaluate_block(self, block):
+        """
+        Returns the result of each equation for a (bands, rows, cols) block
+        """
+        #we need to build a dictionary of band variables to hand in to numexpr
+        banddict = {}
+        for band, band_data in zip(self.all_bands, block):
+            banddict["band{}".format(band)] = band_data.astype(numpy.float32)
+        for name, expression in self.shared:
+            banddict[name] = expression.evaluate(banddict)
+        #local dict becomes the variable list
+        return [expression.evaluate(banddict) for expression in self.evaluated]
+
+    def write_outputs(self, first_row, nrows, results, mask_blocks):
+        """
+        Writes the results and masks for a block, run in the writer thread
+        """
+        for index, result in enumerate(results):
+            if self.destinations[index] is None:
+                #every band is a (rows, cols) array so each equation gives a single layer
+                #need to have a destination dataset before gdal will let us write out
+                self.destinations[index] = self.create_output(self.output_names[index], self.layers[index], gdal.GDT_Float32)
+                self.mask_destinations[index] = [self.create_output(self.output_names[index].replace(".bil", suffix), self.layers[index], gdal.GDT_Byte)
+                                                 for suffix, _ in self.mask_readers]
+                self.created.extend([self.output_names[index]] + [self.output_names[index].replace(".bil", suffix)
+                                                                  for suffix, _ in self.mask_readers])
+            write_block(self.destinations[index], result, first_row)
+
+            for mask_block, mask_destination in zip(mask_blocks, self.mask_destinations[index]):
+                #combine the mask bands the equation uses, read ahead with the block, down to one layer
+                maskarray = combine_mask_block(mask_block[[self.band_index[band] for band in self.equation_bands[index]]])
+                write_block(mask_destination, maskarray, first_row)
+
+    def finish(self):
+        try:
+            self.writer.close()
+        finally:
+            self._release()
+        return list(zip(self.output_names, self.layers))
+
+    def _release(self):
+        """
+        Restores the numexpr threads and closes the outputs and mask readers
+        """
+        if self.previous_threads is not None:
+            numexpr.set_num_threads(self.previous_threads)
+            self.previous_threads = None
+        #gdal only finishes writing once the datasets are released
+        self.destinations = [None] * len(self.equations)
+        self.mask_destinations = [None] * len(self.equations)
+        for _, reader in self.mask_readers:
+            reader.close()
+        self.mask_readers = []
+
+    def abort(self):
+        """
+        Stops the writer and removes the partly written outputs and masks
+        """
+        try:
+            if self.writer is not None:
+                try:
+                    self.writer.close()
+                except Exception:
+                    #the failure which led here is raised by run_block_plugins
+                    pass
+        finally:
+            self._release()
+        for output_name in self.created:
+            for filename in derived_cache.companion_files(output_name):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+        self.created = []
+
+def mapped_bands_available(bands, band_range):
+    """
+    Returns True if every one of bands (level1b band numbers) is in a file
+    mapped with band_range, so an equation on them can be run on it
+    """
+    numbers = aplmap_chunks.band_range_numbers(band_range)
+    return numbers is None or set([int(band) for band in bands]) <= set(numbers)
+
+def bandmath_mapped(mappedfile, equations, outputfolder, band_range, nodata=0, blocksize=None, threads=None, queue_blocks=None):
+    """
+    Runs a set of string equations on a file already mapped by aplmap, rather
+    than mapping each band math output from level1b. Equations use level1b
+    band numbers, which are looked up in the mapped file from the band_range
+    it was mapped with, and only the bands needed are read a block of rows at
+    a time. Outputs are georeferenced as the mapped file and hold nodata where
+    any band an equation uses is nodata, i.e. outside the swath or masked.
+
+    equations is a list of (eqname, equation, bands) tuples as for
+    bandmath_multi, the outputs are float32 and no masks are made.
+
+    Returns a list of (output_name, layers) in the same order as equations.
+    """
+    plugin = MappedBandmathPlugin(mappedfile, equations, outputfolder, band_range,
+                                  nodata=nodata, threads=threads, queue_blocks=queue_blocks)
+    return block_plugins.run_block_plugins(mappedfile, [plugin], blocksize=blocksize,
+                                           queue_blocks=queue_blocks)[0]
+
+class MappedBandmathPlugin(BandmathPlugin):
+    """
+    Block plugin evaluating a set of equations on a mapped file, with the same
+    arguments as bandmath_mapped.
+    """
+
+    def __init__(self, mappedfile, equations, outputfolder, band_range, nodata=0, threads=None, queue_blocks=None):
+        BandmathPlugin.__init__(self, mappedfile, equations, outputfolder,
+                                threads=threads, queue_blocks=queue_blocks)
+        self.band_range = band_range
+        self.nodata = nodata
+        self.positions = None
+
+    def validate(self, reader):
+        #positions of the level1b bands in the mapped file, counting from 1
+        numbers = aplmap_chunks.band_range_numbers(self.band_range, reader.band_count)
+        if len(numbers) != reader.band_count:
+            raise ValueError("{} has {} bands but band range {} gives {}".format(self.bilfile, reader.band_count, self.band_range, len(numbers)))
+        self.positions = dict([(str(number), position + 1) for position, number in enumerate(numbers)])
+        for expression in self.expressions:
+            unknown = [name for name in expression.variables if band_expressions.BAND_VARIABLE.match(name) is None]
+            if len(unknown) > 0:
+                raise ValueError("Equation '{}' uses {} which are not in the form bandx".format(expression.equation, ", ".join(unknown)))
+            missing = [band for band in expression.bands if str(int(band)) not in self.positions]
+            if len(missing) > 0:
+                raise ValueError("Equation '{}' uses band(s) {} which are not in {}".format(expression.equation, ", ".join(missing), self.bilfile))
+        mapped = gdal.Open(self.bilfile)
+        self.geotransform = mapped.GetGeoTransform()
+        self.projection = mapped.GetProjection()
+        mapped = None
+
+    def bands(self):
+        return [self.positions[str(int(band))] for band in self.all_bands]
+
+    def create_output(self, output_name, layers, data_type):
+        destination = BandmathPlugin.create_output(self, output_name, layers, data_type)
+        destination.SetGeoTransform(self.geotransform)
+        destination.SetProjection(self.projection)
+        for layer in range(layers):
+            destination.GetRasterBand(layer + 1).SetNoDataValue(self.nodata)
+        return destination
+
+    def evaluate_block(self, block):
+        results = BandmathPlugin.evaluate_block(self, block)
+        for index, result in enumerate(results):
+            #pixels outside the swath or masked out before mapping have no result
+            nodata = numpy.any(block[[self.band_index[band] for band in self.equation_bands[index]]] == self.nodata, axis=0)
+            result = numpy.array(result, dtype=numpy.float32)
+            result[..., nodata] = self.nodata
+            results[index] = result
+        return results
+
+def bandmath_cache_lookup(bilfile, equations, outputfolder, cache, maskfile=None, badpix_mask=None):
+    """
+    Looks each of equations up in a derived_cache.DerivedCache, on the
+    identity of the input files, its normalised form and the bands its mask is
+    made from. Hits are linked in to outputfolder.
+
+    Returns (outputs, keys, missing) where outputs holds (output_name, layers)
+    for the hits and None for the misses, keys the cache key of every
+    equation and missing the indices of the equations that still need running.
+    """
+    outputs = [None] * len(equations)
+    keys = []
+    missing = []
+    for index, (eqname, equation, bands) in enumerate(equations):
+        expression = band_expressions.parse_equation(equation)
+        if bands is None:
+            bands = expression.bands
+        keys.append(derived_cache.cache_key([bilfile, maskfile, badpix_mask], "bandmath",
+                                            {"equation": expression.normalised,
+                                             "bands": [int(band) for band in bands]}))
+        output_name = bandmath_output_name(bilfile, outputfolder, equation, eqname)
+        stem = os.path.splitext(os.path.basename(output_name))[0]
+        details = cache.fetch(keys[index], outputfolder, stem=stem)
+        if details is None:
+            missing.append(index)
+        else:
+            outputs[index] = (output_name, details["layers"])
+    return outputs, keys, missing
+
+def bandmath_cache_store(cache, key, output, maskfile=None, badpix_mask=None):
+    """
+    Adds a band math output, given as (output_name, layers), and its masks to
+    a derived_cache.DerivedCache under key.
+    """
+    output_name, layers = output
+    files = derived_cache.companion_files(output_name)
+    for mask_input, suffix in [(maskfile, MASK_SUFFIX), (badpix_mask, BADPIX_MASK_SUFFIX)]:
+        if mask_input is not None:
+            files.extend(derived_cache.companion_files(output_name.replace(".bil", suffix)))
+    cache.store(key, files, layers=layers,
+                stem=os.path.splitext(os.path.basename(output_name))[0])
+
+def cached_bandmath_multi(bilfile, equations, outputfolder, cache, maskfile=None, badpix_mask=None, **kwargs):
+    """
+    bandmath_multi backed by a derived_cache.DerivedCache. Hits are linked in
+    to outputfolder and the misses are run together in one pass then added to
+    the cache.
+
+    Takes the same arguments and returns the same as bandmath_multi.
+    """
+    outputs, keys, missing = bandmath_cache_lookup(bilfile, equations, outputfolder, cache,
+                                                   maskfile=maskfile, badpix_mask=badpix_mask)
+    if len(missing) > 0:
+        made = bandmath_multi(bilfile, [equations[index] for index in missing], outputfolder,
+                              maskfile=maskfile, badpix_mask=badpix_mask, **kwargs)
+        for index, output in zip(missing, made):
+            outputs[index] = output
+            bandmath_cache_store(cache, keys[index], output, maskfile=maskfile, badpix_mask=badpix_mask)
+    return outputs
+
+def bandmath(bilfile, equation, outputfolder, bands, eqname=None, maskfile=None, badpix_mask=None, blocksize=None, threads=None, queue_blocks=None):
+    """
+    Function to run a string equation, hand in a bilfile and a list of bands
+    required.
+
+    Bands in the equation must be in the format "bandx" where x is the number
+    (e.g. band1, band147, band650) if this standard is not kept a ValueError
+    is raised before the file is read
+
+    The equation is evaluated in blocks of blocksize rows (defaults to
+    scops_common.BANDMATH_BLOCK_ROWS) so peak memory is independent of the
+    length of the line.
+    """
+    return bandmath_multi(bilfile, [(eqname, equation, bands)], outputfolder,
+                          maskfile=maskfile, badpix_mask=badpix_mask,
+                          blocksize=blocksize, threads=threads,
+                          queue_blocks=queue_blocks)[0]
 
 
 
@@ -135,13 +491,28 @@ if __name__ == '__main__':
                         help='equation name to append to file, defaults to input equation',
                         default=None,
                         metavar="ename")
+    parser.add_argument('--blocksize',
+                        help='number of rows to process at a time',
+                        type=int,
+                        default=scops_common.BANDMATH_BLOCK_ROWS,
+                        metavar="<rows>")
+    parser.add_argument('--threads',
+                        help='number of threads to evaluate the equation with, 0 for the numexpr default',
+                        type=int,
+                        default=scops_common.BANDMATH_THREADS,
+                        metavar="<threads>")
+    parser.add_argument('--queue_blocks',
+                        help='number of blocks to read ahead and write behind the one being evaluated, 0 to run in series',
+                        type=int,
+                        default=scops_common.BANDMATH_QUEUE_BLOCKS,
+                        metavar="<blocks>")
     parser.add_argument('bilfile',
                         help='bil file to run on',
                         default=None,
                         metavar="bilfile")
     args = parser.parse_args()
 
-    bands = re.findall(r'band(\d{3})', args.equation)
+    bands = band_expressions.parse_equation(args.equation).bands
 
     if args.output_folder is None:
         output = os.getcwd()
@@ -150,5 +521,8 @@ if __name__ == '__main__':
     print("Will perform {} on bands {}".format(args.equation, ", ".join(bands)))
     output_name, layers = bandmath(args.bilfile, args.equation, output,
                                    bands, eqname=args.ename,
-                                   maskfile=args.maskfile)
+                                   maskfile=args.maskfile,
+                                   blocksize=args.blocksize,
+                                   threads=args.threads,
+                                   queue_blocks=args.queue_blocks)
     print("Wrote to: {}".format(output_name))
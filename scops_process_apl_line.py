@@ -19,7 +19,10 @@ Available functions
 email_error: will send an email to the set address on failure of processing
 email_PI: will email the PI on completion of processing and zipping with a download_link
 status_update: updates status file with current stage
+product_failed: marks a product failed outside process_web_hyper_line
 process_web_hyper_line: main function, take a config, line name and output folder to run apl in and zip finished files.
+process_line_with_mapped_bandmath: processes the main line then runs band math on its mapped output
+generate_derived_products: makes all the band math and plugin outputs for a line in one pass over the level1b file
 """
 
 import argparse
@@ -30,10 +33,8 @@ if sys.version_info[0] < 3:
 else:
     import configparser as ConfigParser
 import glob
-import zipfile
 import pipes
 import logging
-import re
 import smtplib
 from email.mime.text import MIMEText
 import platform
@@ -43,11 +44,27 @@ import atexit
 
 import threading
 import time
+import multiprocessing
 
 import status_db
 
 import scops_bandmath
 from scops import scops_common
+from scops import band_expressions
+from scops import derived_cache
+from scops import block_plugins
+from scops import line_executor
+from scops import line_geometry
+from scops import aplmap_chunks
+from scops import envi_reader
+from scops import line_segments
+from scops import zip_coordinator
+from scops import parallel_zip
+from scops import master_zip
+from scops import delivery
+from scops import writeback_service
+from scops import scratch_space
+from scops import log_tailer
 
 from arsf_dem import dem_common_functions
 import importlib
@@ -55,6 +72,9 @@ import importlib
 #set up logging
 logger = logging.getLogger()
 
+#marks that a process has taken on making the master zip for an order
+MASTER_ZIP_CLAIM = ".master_zip_claimed"
+
 def sensor_folder_lookup(sensor_letter):
     """
     Give a sensor letter prefix will return a folder descriptor for delivery folder lookup
@@ -168,67 +188,179 @@ def send_email(message, receive, subject, sender, no_bcc=False, no_error=True):
         logger.error(str(e))
         raise Exception(e)
 
-def progress_detail_updater_spinner(processing_id, output_folder, logfile, line):
+class ProgressMonitor(object):
+    """
+    Keeps the progress details in the database up to date for every product
+    of a job from a single thread, reading the stages of all the job's lines
+    in one query each scops_common.PROGRESS_INTERVAL seconds. A product's
+    details are only written when they change, at most every
+    scops_common.PROGRESS_MIN_WRITE_SECONDS unless its stage has moved on,
+    and it stops being watched once complete or in error. stop writes
+    anything outstanding.
+
+    Products run in worker processes forked after the monitor was made are
+    passed back to it down a pipe by watch.
+    """
+
+    def __init__(self, interval=None, min_write_interval=None):
+        if interval is None:
+            interval = scops_common.PROGRESS_INTERVAL
+        if min_write_interval is None:
+            min_write_interval = scops_common.PROGRESS_MIN_WRITE_SECONDS
+        self.interval = float(interval)
+        self.min_write_interval = float(min_write_interval)
+        self.owner = os.getpid()
+        self.receiver, self.sender = multiprocessing.Pipe(duplex=False)
+        self.send_lock = multiprocessing.Lock()
+        self.products = {}
+        self.products_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def watch(self, processing_id, output_folder, logfile, line):
+        """
+        Starts watching a product, from the job's process or a worker
+
+        :param processing_id: string
+        :param output_folder: string
+        :param logfile: string
+        :param line: string
+        """
+        if os.getpid() != self.owner:
+            with self.send_lock:
+                self.sender.send((processing_id, output_folder, logfile, line))
+            return
+        self._add(processing_id, output_folder, logfile, line)
+        self.start()
+
+    def start(self):
+        """
+        Starts the monitor thread, which also picks up the products workers
+        send down the pipe, so must run in the job's process before they fork
+        """
+        if os.getpid() != self.owner or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _add(self, processing_id, output_folder, logfile, line):
+        with self.products_lock:
+            self.products[(processing_id, line)] = {"output_folder": output_folder,
+                                                    "logfile": logfile,
+                                                    "tailer": log_tailer.LogTailer(logfile),
+                                                    "status": None,
+                                                    "written": None,
+                                                    "written_at": 0}
+
+    def poll(self, final=False):
+        """
+        Writes the details of every watched product that have changed and are
+        due, or all that have changed if final is set
+        """
+        while self.receiver.poll():
+            self._add(*self.receiver.recv())
+        with self.products_lock:
+            products = dict(self.products)
+        for processing_id in set([key[0] for key in products]):
+            try:
+                stages = dict([(row[2], row[3]) for row in status_db.get_lines_from_db(processing_id)])
+            except Exception as e:
+                logger.error(e)
+                continue
+            for (product_id, line), product in products.items():
+                status = stages.get(line)
+                if product_id != processing_id or status is None:
+                    continue
+                try:
+                    details = progress_details(product["output_folder"], product["logfile"], line, status, tailer=product["tailer"])
+                    finished = status == "complete" or "ERROR" in status
+                    due = final or finished or status != product["status"] or time.time() - product["written_at"] >= self.min_write_interval
+                    if details != product["written"] and due:
+                        status_db.update_progress_details(processing_id, line, *details)
+                        product["written"] = details
+                        product["written_at"] = time.time()
+                    product["status"] = status
+                except Exception as e:
+                    #If we fail we shouldn't panic as the system will still work, but should say something about it
+                    logger.error(e)
+                    continue
+                if finished:
+                    with self.products_lock:
+                        self.products.pop((processing_id, line), None)
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        """
+        Stops the monitor thread and writes anything it hadn't yet
+        """
+        if os.getpid() != self.owner:
+            return
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.poll(final=True)
+
+_job_monitor = None
+
+def job_monitor():
+    """
+    Returns the progress monitor of this job, making one if there isn't one
+    yet. Worker processes share the monitor of the job that forked them.
+
+    :return: monitor
+    :rtype: ProgressMonitor
+    """
+    global _job_monitor
+    if _job_monitor is None:
+        _job_monitor = ProgressMonitor()
+        #running from the start so products in workers are updated while they run
+        _job_monitor.start()
+        atexit.register(_job_monitor.stop)
+    return _job_monitor
+
+def progress_detail_updater(processing_id, output_folder, logfile, line, status, tailer=None):
     """
-    Updates the database with the current status/progress of our processing by interpretting the logs every second.
-    Should be run in a seperate thread.
+    Updates the database with the progress details of a line worked out by progress_details.
 
     :param processing_id: string
     :param output_folder: string
     :param logfile: string
     :param line: string
+    :param status: string
+    :param tailer: LogTailer following logfile between calls, one is made if not given
+    :return: None
     """
-    complete = False
-    iter = 0
-    while not complete:
-        #find out our current status
-        status = status_db.get_line_status_from_db(processing_id, line)
-        try:
-            #try to update the status database with progress
-            progress_detail_updater(processing_id, output_folder, logfile, line, status)
-        except Exception as e:
-            #If we fail we shouldn't panic as the system will still work, but should say something about it
-            logger.error(e)
-        if status == "complete":
-            complete = True
-        if "ERROR" in status:
-            #time for this to stop running
-            complete = True
-        iter += 1
-        #give it some time to see if anything changes
-        time.sleep(1)
-
-def progress_detail_updater(processing_id, output_folder, logfile, line, status):
+    status_db.update_progress_details(processing_id, line, *progress_details(output_folder, logfile, line, status, tailer=tailer))
+
+def progress_details(output_folder, logfile, line, status, tailer=None):
     """
     A big switch to work out what the log means at any point, vital for the updating of the database.
 
-    :param processing_id: string
     :param output_folder: string
     :param logfile: string
     :param line: string
     :param status: string
-    :return: None
+    :param tailer: LogTailer following logfile between calls, one is made if not given
+    :return: (total progress, filesize, bytesize, zipsize, zipbyte)
+    :rtype: tuple
     """
     zipfile_name = os.path.join(output_folder, 'mapped', os.path.basename(line) + "3b_mapped.bil.zip")
+    geotiff_name = os.path.join(output_folder, 'mapped', os.path.basename(line) + "3b_mapped.tif")
+    if not os.path.exists(zipfile_name) and os.path.exists(geotiff_name):
+        #orders delivered as GeoTIFFs report the size of those instead
+        zipfile_name = geotiff_name
 
     zipbyte="MB"
-    bytesize="MB"
-    progress = 0
     zipsize=0
-    try:
-        approx_percents = list(open(logfile, 'r'))[-6:]
-    except IndexError as e:
-        approx_percent = "0"
-        progress = 0
-
-    for approx_percent in approx_percents:
-        if "Approximate percent complete:" in approx_percent:
-            progress = [int(s) for s in approx_percent[-10:].split() if s.isdigit()][0]
-            #if it's greater than 100 we picked up the wrong bit of the message
-            if progress > 100:
-                progress = [int(s) for s in approx_percent[-16:].split() if s.isdigit()][0]
-        else:
-            progress = 0
+    if tailer is None:
+        tailer = log_tailer.LogTailer(logfile)
+    #only reads what has been logged since the last update
+    tailer.update()
+    progress = tailer.progress()
 
     if os.path.exists(zipfile_name):
         #take it up to megabytes
@@ -239,15 +371,7 @@ def progress_detail_updater(processing_id, output_folder, logfile, line, status)
         zipsize = round(zipsize, 2)
         progress = 0
 
-    filesize=0
-
-    for l in open(logfile):
-        if "megabytes" in l:
-            logline = l.split()
-            filesize = float(logline[logline.index("megabytes") - 1])
-            if filesize > 500:
-                filesize = round((filesize / 1024), 2)
-                bytesize="GB"
+    filesize, bytesize = tailer.filesize()
 
     weight = 0
     stageprogress=0
@@ -289,7 +413,7 @@ def progress_detail_updater(processing_id, output_folder, logfile, line, status)
     else:
         total_progress = 100
 
-    status_db.update_progress_details(processing_id, line, total_progress, filesize, bytesize, zipsize, zipbyte)
+    return total_progress, filesize, bytesize, zipsize, zipbyte
 
 
 def masklookup(mask_string):
@@ -345,17 +469,24 @@ def email_error(stage, line, error, processing_folder):
     send_email(message, scops_common.ERROR_EMAIL, processing_folder + " ERROR", scops_common.SEND_EMAIL)
 
 
-def email_PI(pi_email, output_location, project):
+def email_PI(pi_email, output_location, project, delivery_format=delivery.ZIP):
     """
-    Send an email to the PI telling them where they can download their data
+    Send an email to the PI telling them where they can download their data,
+    the master zip or for GeoTIFF orders the folder holding the GeoTIFFs
 
     :param pi_email:
     :param output_location:
     :param project:
+    :param delivery_format: one of delivery.FORMATS
     :return:
     """
     folder_name = os.path.basename(os.path.normpath(output_location))
-    download_link = scops_common.DOWNLOAD_LINK.format(folder_name, project)
+    if delivery_format == delivery.GEOTIFF:
+        download_link = scops_common.GEOTIFF_LINK.format(folder_name, project)
+        geotiffs = sorted([os.path.basename(f) for f in glob.glob(os.path.join(output_location, scops_common.WEB_MAPPED_OUTPUT, "*.tif"))])
+        download_link = download_link + '\n\nwhich holds a GeoTIFF for each line:\n' + '\n'.join(geotiffs)
+    else:
+        download_link = scops_common.DOWNLOAD_LINK.format(folder_name, project)
 
     message = 'Processing is complete for your order request {}, you can now download the data from the following location:\n\n' \
               '{}\n\n' \
@@ -413,6 +544,23 @@ def email_preprocessing_error(pi_email, output_location, project, reason):
     send_email(message, pi_email, output_location + ' processing error', scops_common.SEND_EMAIL)
 
 
+def claim_master_zip(output_location):
+    """
+    Claims the job of making the master zip for an order, returns True for the
+    first process to ask and False for any others. web_qsub clears the claim
+    when the order is (re)submitted.
+
+    :param output_location:
+    :return: claimed
+    :rtype: bool
+    """
+    claim_file = os.path.join(output_location, scops_common.WEB_MAPPED_OUTPUT, MASTER_ZIP_CLAIM)
+    try:
+        os.close(os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return False
+    return True
+
 def status_update(processing_folder, status_file, newstage, line):
     """
     Updates the status files with a new stage or completion.
@@ -439,6 +587,31 @@ def status_update(processing_folder, status_file, newstage, line):
 
     open(status_file, 'w').write("{} = {}".format(line, newstage))
 
+def product_failed(config, line_name, lev1file, output_location, eq_name, stage, error):
+    """
+    Marks the eq_name product of a line as failed at stage, for products which
+    fail before process_web_hyper_line runs for them (e.g. band math run on
+    the mapped main line), and adds error to its log.
+
+    :param config:
+    :param line_name:
+    :param lev1file:
+    :param output_location:
+    :param eq_name: name of the equation or plugin, as used in the product name
+    :param stage: string
+    :param error: exception
+    :return: None
+    """
+    output_line_name, _, _ = os.path.basename(lev1file).replace(".","").replace("bil", "").rpartition("1b")
+    logstat_name = output_line_name + "_" + eq_name
+    processing_id = os.path.basename(config.get(line_name, "output_folder"))
+    try:
+        with open(os.path.join(output_location, scops_common.LOG_DIR, logstat_name + "_log.txt"), 'a') as product_log:
+            product_log.write("ERROR - {}: {}\n".format(stage, error))
+    except IOError:
+        pass
+    status_update(processing_id, scops_common.STATUS_FILE.format(output_location, logstat_name), "ERROR - " + stage, logstat_name)
+
 
 def line_handler(config_file, line_name, output_location, process_main_line, process_band_ratio, resume=False):
     """
@@ -487,69 +660,281 @@ def line_handler(config_file, line_name, output_location, process_main_line, pro
     maskfile = lev1file.replace(".bil", "_mask.bil")
     badpix_mask =  lev1file.replace(".bil", "_mask-badpixelmethod.bil")
     band_list = config.get(line_name, 'band_range')
+    #equations only using bands the main line is mapped with are run on its mapped output,
+    #saving a trip through aplmask, aplcorr, apltran and aplmap for each
+    mapped_equations = []
+    #equations which can't be run at all, checked before the main line is so they can't fail it
+    failed_names = []
+    if process_main_line and process_band_ratio and scops_common.MAPPED_BANDMATH:
+        lev1_reader = envi_reader.open_image(lev1file)
+        band_count = lev1_reader.band_count
+        lev1_reader.close()
+        for eq_name in [x for x in dict(config.items(line_name)) if "eq_" in x]:
+            if config.get(line_name, eq_name) in "True":
+                equation = config.get('DEFAULT', eq_name)
+                try:
+                    expression = band_expressions.parse_equation(equation)
+                    band_expressions.validate_bands([expression], band_count, lev1file)
+                except ValueError as e:
+                    logger.error([e, eq_name])
+                    product_failed(config, line_name, lev1file, output_location, eq_name.replace("eq_", ""), "bandmath", e)
+                    failed_names.append(eq_name)
+                    continue
+                if scops_bandmath.mapped_bands_available(expression.bands, band_list):
+                    mapped_equations.append((eq_name, equation, expression.bands))
+    mapped_names = [eq_name for eq_name, _, _ in mapped_equations]
+
+    #products are run through APL side by side where the job has the cores and memory,
+    #then whichever finishes last makes the master zip so every one checks
+    products = 1 if process_main_line else 0
+    if process_band_ratio:
+        products += len([x for x in dict(config.items(line_name))
+                         if ("eq_" in x and x not in mapped_names + failed_names or "plugin_" in x) and config.get(line_name, x) in "True"])
+    executor = line_executor.LineExecutor(products=products)
+    #made before any products are forked so they all report their progress through it
+    monitor = job_monitor()
+
     last_process=True
     if process_main_line:
-        if process_band_ratio:
+        if process_band_ratio and not executor.concurrent:
             last_process = False
-        process_web_hyper_line(config, line_name, os.path.basename(lev1file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=None, data_type="uint16", last_process=last_process, tmp=tmp_process, resume=resume)
+        if len(mapped_equations) > 0:
+            executor.submit(line_name, process_line_with_mapped_bandmath, config, line_name, lev1file, band_list, output_location, hyper_delivery, mapped_equations, last_process=last_process, tmp=tmp_process, resume=resume)
+        else:
+            executor.submit(line_name, process_web_hyper_line, config, line_name, os.path.basename(lev1file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=None, data_type="uint16", last_process=last_process, tmp=tmp_process, resume=resume)
 
     if process_band_ratio:
-        equations = [x for x in dict(config.items(line_name)) if "eq_" in x]
+        equations = [x for x in dict(config.items(line_name)) if "eq_" in x and x not in mapped_names + failed_names]
         plugins = [x for x in dict(config.items(line_name)) if "plugin_" in x]
-        #process the equations from the band math
+        enabled_equations = [eq_name for eq_name in equations if config.get(line_name, eq_name) in "True"]
+        #run all the band math for the line in one pass over the level1b file
+        bandmath_equations = []
+        for eq_name in enabled_equations:
+            equation = config.get('DEFAULT', eq_name)
+            band_numbers = band_expressions.parse_equation(equation).bands
+            bandmath_equations.append((eq_name.replace("eq_", ""), equation, band_numbers))
+        output_location_updated = output_location + "/level1b"
+        #make every band math and plugin output in one pass over the level1b file
+        sys.path.append(config.get('DEFAULT','plugin_directory'))
+        enabled_plugins = [plugin_name for plugin_name in plugins if config.get(line_name, plugin_name) in "True"]
+        derived_log = []
+        bandmath_results, plugin_results = generate_derived_products(lev1file, bandmath_equations, enabled_plugins, output_location_updated, maskfile=maskfile, badpix_mask=badpix_mask, cache_messages=derived_log)
+        bandmath_outputs = dict(zip(enabled_equations, bandmath_results))
+        plugin_outputs = dict(zip(enabled_plugins, plugin_results))
+
+        #process the equations from the band math which weren't run on the mapped main line
         for enum, eq_name in enumerate(equations):
             last_process=False
             if config.get(line_name, eq_name) in "True":
-                equation = config.get('DEFAULT', eq_name)
-                band_numbers = re.findall(r'band(\d{1,3})', equation)
-                output_location_updated = output_location + "/level1b"
-                bm_file, bands = scops_bandmath.bandmath(lev1file, equation, output_location_updated, band_numbers, eqname=eq_name.replace("eq_", ""), maskfile=maskfile, badpix_mask=badpix_mask)
+                bm_file, bands = bandmath_outputs[eq_name]
                 if bands > 1:
                     band_list = config.get(line_name, 'band_range')
                 else:
                     band_list = "1"
                 bandmath_maskfile = bm_file.replace(".bil", "_mask.bil")
                 polite_eq_name = eq_name.replace("eq_", "")
-                if enum == len(equations)-1:
+                if enum == len(equations)-1 or executor.concurrent:
                     last_process = True
-                process_web_hyper_line(config, line_name, os.path.basename(bm_file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=bm_file, maskfile=bandmath_maskfile, eq_name=polite_eq_name, last_process=last_process, tmp=tmp_process, resume=resume)
+                executor.submit(line_name + "_" + polite_eq_name, process_web_hyper_line, config, line_name, os.path.basename(bm_file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=bm_file, maskfile=bandmath_maskfile, eq_name=polite_eq_name, last_process=last_process, tmp=tmp_process, resume=resume, log_messages=derived_log)
 
         #process the plugins - these are all for level1b running
-        sys.path.append(config.get('DEFAULT','plugin_directory'))
         for enum, plugin_name in enumerate(plugins):
             last_process=False
             if config.get(line_name, plugin_name) in "True":
-                equation = config.get('DEFAULT', plugin_name)
-                output_location_updated = output_location + "/level1b"
-                #import plugin_name
                 polite_plugin_name = plugin_name.replace("plugin_", "")
-                plugin_module_name=polite_plugin_name.replace(".py","")
-                plugin_module=importlib.import_module(plugin_module_name)
-                #run plugin
-                plugin_args={'output_folder' : output_location_updated,
-                             'hsi_filename' : lev1file,
-                             }
-                processed_file=plugin_module.run(**plugin_args)
+                processed_file = plugin_outputs[plugin_name]
                 #always do all bands
                 band_list="ALL"
                 #do not do masking as the mask does not match this file anymore. Potentially should apply mask first before running the plugin
                 skip_stages=['aplmask']
-                if enum == len(plugins)-1:
+                if enum == len(plugins)-1 or executor.concurrent:
                     last_process = True
-                process_web_hyper_line(config, line_name, os.path.basename(processed_file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=processed_file, skip_stages=skip_stages,maskfile=None, eq_name=polite_plugin_name, last_process=last_process, tmp=tmp_process, resume=False)
+                executor.submit(line_name + "_" + polite_plugin_name, process_web_hyper_line, config, line_name, os.path.basename(processed_file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=processed_file, skip_stages=skip_stages,maskfile=None, eq_name=polite_plugin_name, last_process=last_process, tmp=tmp_process, resume=False, log_messages=derived_log)
+
+    try:
+        executor.join()
+    finally:
+        #a last update for each product once they have all finished
+        monitor.stop()
+
+def process_line_with_mapped_bandmath(config, line_name, lev1file, band_list, output_location, hyper_delivery, mapped_equations, last_process=False, tmp=False, resume=True):
+    """
+    Processes the main line, running mapped_equations on its mapped output
+    before it is zipped, then zips each band math output as a product of its
+    own. The equations must only use bands in band_list.
+
+    An equation failing doesn't stop the main line, the equation's product is
+    marked as failed and the rest carry on. If the main line fails, the
+    equations which hadn't run are marked as failed with it.
 
+    :param config:
+    :param line_name:
+    :param lev1file:
+    :param band_list: band range the main line is mapped with
+    :param output_location:
+    :param hyper_delivery:
+    :param mapped_equations: list of (eq_name, equation, bands)
+    :param last_process: whether the main line may make the master zip
+    :return: None
+    """
+    scratch = None
+    if tmp:
+        try:
+            needed = len(mapped_equations) * scratch_space.predicted_bytes(lev1file, "1", "float32", masked=False)
+        except Exception as e:
+            logger.warning("couldn't predict the scratch space needed: {}".format(e))
+            needed = 0
+        scratch = scratch_space.allocate(needed)
+    if scratch is not None:
+        work_folder = scratch.path
+    else:
+        work_folder = tempfile.mkdtemp(prefix=".bandmath_", dir=os.path.join(output_location, scops_common.WEB_MAPPED_OUTPUT))
+    #output of each equation that ran, keyed on its config option
+    mapped_outputs = {}
+    hook_run = []
+
+    def run_mapped_bandmath(mapname):
+        hook_run.append(mapname)
+        names = [eq_name for eq_name, _, _ in mapped_equations]
+        equations = [(eq_name.replace("eq_", ""), equation, bands) for eq_name, equation, bands in mapped_equations]
+        try:
+            mapped_outputs.update(zip(names, scops_bandmath.bandmath_mapped(mapname, equations, work_folder, band_list)))
+            return
+        except Exception as e:
+            logger.error(["mapped band math failed, running each equation on its own", e])
+        #find which equations fail, the rest can still be delivered
+        for eq_name, equation in zip(names, equations):
+            try:
+                mapped_outputs[eq_name] = scops_bandmath.bandmath_mapped(mapname, [equation], work_folder, band_list)[0]
+            except Exception as e:
+                logger.error([e, eq_name])
+                product_failed(config, line_name, lev1file, output_location, equation[0], "bandmath", e)
+
+    try:
+        main_error = None
+        try:
+            process_web_hyper_line(config, line_name, os.path.basename(lev1file), band_list, output_location, lev1file, hyper_delivery, input_lev1_file=None, data_type="uint16", last_process=last_process, tmp=tmp, resume=resume, mapped_hook=run_mapped_bandmath)
+        except Exception as e:
+            main_error = e
+            if len(hook_run) == 0:
+                #the equations were waiting on the main line's mapped file
+                for eq_name, _, _ in mapped_equations:
+                    product_failed(config, line_name, lev1file, output_location, eq_name.replace("eq_", ""), "main line", e)
+        #equations which were made are delivered even if the main line failed after making them
+        for eq_name, _, _ in mapped_equations:
+            if eq_name not in mapped_outputs:
+                continue
+            mapped_file, _ = mapped_outputs[eq_name]
+            #these come last so any of them could be the one to make the master zip
+            process_web_hyper_line(config, line_name, os.path.basename(lev1file), "1", output_location, lev1file, hyper_delivery, input_lev1_file=mapped_file, skip_stages=['aplmask'], maskfile=None, eq_name=eq_name.replace("eq_", ""), last_process=True, tmp=tmp, resume=False, mapped_file=mapped_file)
+        if main_error is not None:
+            raise Exception(main_error)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+        if scratch is not None:
+            scratch.release()
+
+def generate_derived_products(lev1file, bandmath_equations, plugin_names, output_folder, maskfile=None, badpix_mask=None, cache_messages=None):
+    """
+    Makes the band math and plugin outputs for a line. Anything already in the
+    derived product cache is linked in from it, the rest are all fed from a
+    single pass over the level1b file. Plugins with a block_plugin function
+    take part in the pass, plugins with only run are called after it.
 
+    This runs before the products' logs are set up, so what the cache did is
+    added to cache_messages (if given) for them to log.
 
-def process_web_hyper_line(config, base_line_name, output_line_name, band_list, output_location, lev1file, hyper_delivery, input_lev1_file=None, skip_stages=[], maskfile=None, data_type="float32", eq_name=None, last_process=False, tmp=False, resume=True):
+    :param lev1file: string
+    :param bandmath_equations: list of (eqname, equation, bands) as for scops_bandmath.bandmath_multi
+    :param plugin_names: list of plugin config options (plugin_<module>.py)
+    :param output_folder: string
+    :param maskfile: string
+    :param badpix_mask: string
+    :param cache_messages: list
+    :return: bandmath_outputs, list of (output_name, layers) for each equation
+    :rtype: list
+    :return: plugin_outputs, list of output filenames for each plugin
+    :rtype: list
+    """
+    #reuse level1b products made by earlier runs of the same inputs
+    cache = derived_cache.open_cache()
+    pass_plugins = []
+
+    bandmath_outputs = [None] * len(bandmath_equations)
+    bandmath_keys = []
+    bandmath_missing = list(range(len(bandmath_equations)))
+    if cache is not None and len(bandmath_equations) > 0:
+        bandmath_outputs, bandmath_keys, bandmath_missing = scops_bandmath.bandmath_cache_lookup(lev1file, bandmath_equations, output_folder, cache, maskfile=maskfile, badpix_mask=badpix_mask)
+    if len(bandmath_missing) > 0:
+        pass_plugins.append(scops_bandmath.BandmathPlugin(lev1file, [bandmath_equations[index] for index in bandmath_missing], output_folder, maskfile=maskfile, badpix_mask=badpix_mask))
+
+    plugin_outputs = [None] * len(plugin_names)
+    plugin_keys = [None] * len(plugin_names)
+    plugin_missing = []
+    for index, plugin_name in enumerate(plugin_names):
+        #import plugin_name
+        plugin_module_name = plugin_name.replace("plugin_", "").replace(".py","")
+        plugin_module = importlib.import_module(plugin_module_name)
+        plugin_args={'output_folder' : output_folder,
+                     'hsi_filename' : lev1file,
+                     }
+        plugin = block_plugins.plugin_for_module(plugin_module, plugin_args)
+        cached = None
+        if cache is not None:
+            #key on the plugin source and the data and settings it uses as well so changes to them aren't hidden
+            input_files, settings = plugin.cache_inputs()
+            arguments = dict([(key, value) for key, value in plugin_args.items()
+                              if key not in ['output_folder', 'hsi_filename']])
+            arguments.update(settings)
+            plugin_keys[index] = derived_cache.cache_key([lev1file, plugin_module.__file__.replace(".pyc", ".py")] + list(input_files),
+                                                         "plugin_" + plugin_module_name, arguments)
+            cached = cache.fetch(plugin_keys[index], output_folder)
+        if cached is not None:
+            plugin_outputs[index] = os.path.join(output_folder, cached["files"][0])
+        else:
+            plugin_missing.append(index)
+            pass_plugins.append(plugin)
+
+    results = []
+    if len(pass_plugins) > 0:
+        results = block_plugins.run_block_plugins(lev1file, pass_plugins)
+
+    if len(bandmath_missing) > 0:
+        for index, output in zip(bandmath_missing, results.pop(0)):
+            bandmath_outputs[index] = output
+            if cache is not None:
+                scops_bandmath.bandmath_cache_store(cache, bandmath_keys[index], output, maskfile=maskfile, badpix_mask=badpix_mask)
+    for index, processed_file in zip(plugin_missing, results):
+        plugin_outputs[index] = processed_file
+        if cache is not None:
+            cache.store(plugin_keys[index], derived_cache.companion_files(processed_file))
+
+    if cache is not None:
+        cache.log_stats()
+        if cache_messages is not None:
+            cache_messages.extend(cache.messages)
+    return bandmath_outputs, plugin_outputs
+
+
+def process_web_hyper_line(config, base_line_name, output_line_name, band_list, output_location, lev1file, hyper_delivery, input_lev1_file=None, skip_stages=[], maskfile=None, data_type="float32", eq_name=None, last_process=False, tmp=False, resume=True, mapped_file=None, mapped_hook=None, log_messages=None):
     """
     Main function, takes a line and processes it through APL, generates a log file for each line with the output from APL
 
     This will stop if a file is not produced by APL for whatever reason.
 
+    If mapped_file is given it has already been mapped (e.g. band math run on
+    the mapped main line) so is moved in and zipped without running aplmap.
+    mapped_hook is called with the mapped file once aplmap has made it, before
+    it is zipped. log_messages are added to the start of the log, for work
+    done for the product before its log was set up.
+
     :param config_file:
     :param base_line_name:
     :param output_line_name:
     :param output_location:
+    :param mapped_file:
+    :param mapped_hook:
+    :param log_messages:
     :return:
     """
 
@@ -569,6 +954,8 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
     logger.handlers = []
     logger.addHandler(file_handler)
     logger.setLevel(logging.DEBUG)
+    for message in log_messages or []:
+        logger.info(message)
 
     #ouput host details - may be useful for debugging
     nameinfo=platform.uname()
@@ -596,9 +983,7 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
         status_update(processing_id, status_file, "Waiting to process", output_line_name)
     try:
         #if we fail then the webpage won't be able to update - this is less than ideal but we can always resubmit the job
-        progress_thread = threading.Thread(target=progress_detail_updater_spinner, args=(processing_id, output_location, logfile, output_line_name))
-        progress_thread.daemon = True
-        progress_thread.start()
+        job_monitor().watch(processing_id, output_location, logfile, output_line_name)
     except Exception as e:
         logger.error(e)
     
@@ -660,44 +1045,85 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
         status_update(processing_id, status_file, "ERROR - projection not identified", output_line_name)
         raise Exception("Unable to identify projection")
 
+    #the format the mapped file is delivered in, a zip unless the order asks for something else
+    try:
+        delivery_format = delivery.delivery_format(config, base_line_name)
+    except Exception as e:
+        status_update(processing_id, status_file, "ERROR - delivery format", output_line_name)
+        logger.error([e, output_line_name])
+        raise Exception(e)
+
+    #reserve room in the scratch root with most space, processing in the workspace if none has enough
+    scratch = None
+    if tmp:
+        try:
+            needed = scratch_space.predicted_bytes(input_lev1_file, band_list, data_type, masked="aplmask" not in skip_stages)
+        except Exception as e:
+            logger.warning("couldn't predict the scratch space needed: {}".format(e))
+            needed = 0
+        scratch = scratch_space.allocate(needed)
+        if scratch is None:
+            logger.warning("processing {} in the workspace as temporary space is short".format(output_line_name))
+            tmp = False
+        else:
+            #registered before the writeback so runs after it
+            atexit.register(scratch.release)
+
     #set up file locations and tmp folder if we need it
     if tmp:
-        tempdir = tempfile.mkdtemp(prefix="ARF_WEB_", dir=scops_common.TEMP_PROCESSING_DIR)
+        tempdir = scratch.path
         masked_file = os.path.join(tempdir, output_line_name.replace(".bil","") + "_masked.bil")
-        igm_file = os.path.join(tempdir, base_line_name + ".igm")
         mapname = os.path.join(tempdir, output_line_name + "3b_mapped.bil")
-        igm_file_transformed = igm_file.replace(".igm", "_{}.igm").format(projection.replace(' ', '_'))
         final_masked_file = os.path.join(output_location, scops_common.WEB_MASK_OUTPUT, output_line_name.replace(".bil","") + "_masked.bil")
-        final_igm_file = os.path.join(output_location, scops_common.WEB_IGM_OUTPUT, base_line_name + ".igm")
-        final_igm_file_transformed = final_igm_file.replace(".igm", "_{}.igm").format(projection.replace(' ', '_'))
         final_mapname = os.path.join(output_location, scops_common.WEB_MAPPED_OUTPUT, output_line_name + "3b_mapped.bil")
     else:
         masked_file = os.path.join(output_location, scops_common.WEB_MASK_OUTPUT, output_line_name.replace(".bil","") + "_masked.bil")
-        igm_file = os.path.join(output_location, scops_common.WEB_IGM_OUTPUT, base_line_name + ".igm")
         mapname = os.path.join(output_location, scops_common.WEB_MAPPED_OUTPUT, output_line_name + "3b_mapped.bil")
+        tempdir = None
 
-    line_processing_details = line_proc_details(tempdir,output_location,output_line_name,projection,is_tmp=tmp)
+    line_processing_details = line_proc_details(tempdir if tmp else output_location,output_location,output_line_name,projection,is_tmp=tmp)
 
     atexit.register(writeback, line_processing_details)
+
+    #outputs in temporary space are copied back in the background as each stage finishes
+    background_writeback = writeback_service.WritebackService()
+    #registered last so runs first, leaving writeback only what wasn't copied
+    atexit.register(background_writeback.close)
     
+    #the aplmask arguments other than the input and outputs, None if we aren't masking
+    aplmask_flags = None
+    badpix_mask = maskfile.replace('mask.bil', 'mask-badpixelmethod.bil')
+    if "aplmask" not in skip_stages and not 'none' in line_details['masking']:
+        aplmask_flags = []
+        if not 'all' in line_details['masking']:
+            mask_list, ccd_list = masklookup(line_details['masking'])
+            aplmask_flags.extend(["-flags"])
+            aplmask_flags.extend(mask_list)
+            if len(ccd_list) > 0:
+                if os.path.isfile(badpix_mask):
+                    aplmask_flags.extend(["-onlymaskmethods", badpix_mask])
+                    aplmask_flags.extend(ccd_list)
+
+    #long lines can be split along track and the segments masked and mapped side by side
+    segments = 1
+    #masked file of the whole line put together from the segments, None if it isn't needed
+    segmented_masked_file = None
+    if mapped_file is None and start_stage <= 1:
+        lev1_reader = envi_reader.open_image(input_lev1_file)
+        segments = line_segments.segment_count(lev1_reader.rows)
+        lev1_reader.close()
+
     if "aplmask" in skip_stages:
         #skip the masking
         masked_file = input_lev1_file
-    elif start_stage <= 1:
+    elif start_stage <= 1 and segments == 1:
         #set new status to masking
         status_update(processing_id, status_file, "aplmask", output_line_name)
-        if not 'none' in line_details['masking']:
+        if aplmask_flags is not None:
             #generate masking command
             aplmask_cmd = ["aplmask"]
             aplmask_cmd.extend(["-lev1", input_lev1_file])
-            if not 'all' in line_details['masking']:
-                mask_list, ccd_list = masklookup(line_details['masking'])
-                aplmask_cmd.extend(["-flags"])
-                aplmask_cmd.extend(mask_list)
-                if len(ccd_list) > 0:
-                    if os.path.isfile(maskfile.replace('mask.bil', 'mask-badpixelmethod.bil')):
-                        aplmask_cmd.extend(["-onlymaskmethods", maskfile.replace('mask.bil', 'mask-badpixelmethod.bil')])
-                        aplmask_cmd.extend(ccd_list)
+            aplmask_cmd.extend(aplmask_flags)
             aplmask_cmd.extend(["-mask", maskfile])
             aplmask_cmd.extend(["-output", masked_file])
 
@@ -710,64 +1136,57 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
                 status_update(processing_id, status_file, "ERROR - aplmask", output_line_name)
                 logger.error([e, output_line_name])
                 raise Exception(e)
+            if tmp:
+                #aplmap still needs the masked file locally so it is only removed once mapped
+                for suffix in ["", ".hdr"]:
+                    if os.path.exists(masked_file + suffix):
+                        background_writeback.submit(masked_file + suffix, final_masked_file + suffix, remove=False)
         else:
             masked_file = input_lev1_file
     else:
+        #segments are masked as they are mapped, then put together in to the line's masked file
+        if start_stage <= 1 and aplmask_flags is not None:
+            segmented_masked_file = masked_file
         masked_file = input_lev1_file
 
-    #aplcorr command
-    if not os.path.exists(igm_file) or start_stage <= 2:
-        status_update(processing_id, status_file, "aplcorr", output_line_name)
-
-        #get the navfile
-        nav_file = glob.glob(hyper_delivery + scops_common.NAVIGATION_FOLDER + base_line_name + "*_nav_post_processed.bil")[0]
+    #aplcorr and apltran only depend on the line, DEM and projection, so are shared by all its products
+    nav_file = glob.glob(hyper_delivery + scops_common.NAVIGATION_FOLDER + base_line_name + "*_nav_post_processed.bil")[0]
 
-        aplcorr_cmd = ["aplcorr"]
-        aplcorr_cmd.extend(["-lev1file", lev1file])
-        aplcorr_cmd.extend(["-navfile", nav_file])
-        aplcorr_cmd.extend(["-vvfile", hyper_delivery + scops_common.VIEW_VECTOR_FILE.format(sensor)])
-        aplcorr_cmd.extend(["-dem", dem])
-        aplcorr_cmd.extend(["-igmfile", igm_file])
+    if "utm" in projection:
+        outproj_args = ["-outproj", "utm_wgs84{}".format(hemisphere), zone]
+    elif "osng" in projection:
+        outproj_args = ["-outproj", "osng", scops_common.OSNG_SEPERATION_FILE]
+    elif projection=="user":
+        outproj_args = ["-outprojstr", line_details["projstring"]]
 
-        try:
-            dem_common_functions.CallSubprocessOn(aplcorr_cmd, redirect=False, logger=logger)
-            if not os.path.exists(igm_file):
-                raise Exception("igm file not output by aplcorr!")
-        except Exception as e:
-            status_update(processing_id, status_file, "ERROR - aplcorr", output_line_name)
-            logger.error([e, output_line_name])
-            raise Exception(e)
+    if tmp:
+        geometry_work_folder = tempdir
+    else:
+        geometry_work_folder = None
 
-    igm_file_transformed = igm_file.replace(".igm", "_{}.igm").format(projection.replace(' ', '_'))
+    try:
+        igm_file, igm_file_transformed = line_geometry.shared_geometry(
+            os.path.join(output_location, scops_common.WEB_IGM_OUTPUT), base_line_name, projection,
+            lev1file, nav_file, hyper_delivery + scops_common.VIEW_VECTOR_FILE.format(sensor), dem, outproj_args,
+            work_folder=geometry_work_folder,
+            status=lambda stage: status_update(processing_id, status_file, stage, output_line_name))
+    except line_geometry.GeometryError as e:
+        status_update(processing_id, status_file, "ERROR - " + e.stage, output_line_name)
+        logger.error([e, output_line_name])
+        raise Exception(e)
 
     if projection in "osng":
         projection = projection + " " + scops_common.OSNG_SEPERATION_FILE
 
-    if start_stage <= 3:
-        status_update(processing_id, status_file, "apltran", output_line_name)
-
-        #build the transformation command, its worth running this just in case
-        apltran_cmd = ["apltran"]
-        apltran_cmd.extend(["-inproj", "latlong", "WGS84"])
-        apltran_cmd.extend(["-igm", igm_file])
-        apltran_cmd.extend(["-output", igm_file_transformed])
-        if "utm" in projection:
-            apltran_cmd.extend(["-outproj", "utm_wgs84{}".format(hemisphere), zone])
-        elif "osng" in projection:
-            apltran_cmd.extend(["-outproj", "osng", scops_common.OSNG_SEPERATION_FILE])
-        elif projection=="user":
-            apltran_cmd.extend(["-outprojstr", line_details["projstring"]])
-
-        try:
-            dem_common_functions.CallSubprocessOn(apltran_cmd, redirect=False, logger=logger)
-            if not os.path.exists(igm_file_transformed):
-                raise Exception("igm file not output by apltran!")
-        except Exception as e:
-            status_update(processing_id, status_file, "ERROR - apltran", output_line_name)
-            logger.error([e,output_line_name])
-            raise Exception(e)
-
-    if start_stage <= 4:
+    if mapped_file is not None:
+        #already mapped, just needs moving in to place to be zipped
+        for source in derived_cache.companion_files(mapped_file):
+            if source.startswith(mapped_file):
+                shutil.move(source, mapname + source[len(mapped_file):])
+            else:
+                #gdal names ENVI headers name.hdr but we zip name.bil.hdr
+                shutil.move(source, mapname + ".hdr")
+    elif start_stage <= 4:
         status_update(processing_id, status_file, "aplmap", output_line_name)
 
         #set pixel size and map name
@@ -775,20 +1194,34 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
 
 
         aplmap_cmd = ["aplmap"]
-        aplmap_cmd.extend(["-igm", igm_file_transformed])
-        aplmap_cmd.extend(["-lev1", masked_file])
         aplmap_cmd.extend(["-pixelsize", pixelx, pixely])
-        aplmap_cmd.extend(["-bandlist", band_list])
         aplmap_cmd.extend(["-interpolation", line_details["interpolation"]])
-        aplmap_cmd.extend(["-mapname", mapname])
-        aplmap_cmd.extend(["-buffersize", str(4096)])
         aplmap_cmd.extend(["-outputlevel", "verbose"])
         aplmap_cmd.extend(["-outputdatatype", data_type])
         if aplmap_ignore_freespace:
             aplmap_cmd.extend(["-ignorediskspace"])
 
+        #bands are mapped independently so can be split between several aplmap processes
+        masked_reader = envi_reader.open_image(masked_file)
+        band_count = masked_reader.band_count
+        masked_reader.close()
+        chunks = aplmap_chunks.chunk_count(band_list, band_count)
+
         try:
-            log = dem_common_functions.CallSubprocessOn(aplmap_cmd, redirect=False, logger=logger)
+            if segments > 1:
+                line_segments.run_segmented_aplmap(input_lev1_file, maskfile, badpix_mask, aplmask_flags, igm_file_transformed, aplmap_cmd, band_list, float(pixelx), float(pixely), mapname, segments,
+                                                   masked_file=segmented_masked_file)
+            elif chunks > 1:
+                aplmap_cmd.extend(["-igm", igm_file_transformed])
+                aplmap_cmd.extend(["-lev1", masked_file])
+                aplmap_chunks.run_chunked_aplmap(aplmap_cmd, band_list, band_count, mapname, chunks)
+            else:
+                aplmap_cmd.extend(["-igm", igm_file_transformed])
+                aplmap_cmd.extend(["-lev1", masked_file])
+                aplmap_cmd.extend(["-bandlist", band_list])
+                aplmap_cmd.extend(["-mapname", mapname])
+                aplmap_cmd.extend(["-buffersize", str(aplmap_chunks.APLMAP_BUFFER_MB)])
+                log = dem_common_functions.CallSubprocessOn(aplmap_cmd, redirect=False, logger=logger)
             if not os.path.exists(mapname):
                 raise Exception("mapped file not output by aplmap!")
         except Exception as e:
@@ -796,50 +1229,97 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
             logger.error([e,output_line_name])
             raise Exception(e)
 
-    status_update(processing_id, status_file, "waiting to zip", output_line_name)
+        if tmp and masked_file != input_lev1_file:
+            #free the temporary space once the masked file is safely written back
+            masked_copies = [masked_file + suffix for suffix in ["", ".hdr"]]
+            try:
+                background_writeback.wait(masked_copies)
+            except Exception as e:
+                status_update(processing_id, status_file, "ERROR - writeback", output_line_name)
+                logger.error([e, output_line_name])
+                raise Exception(e)
+            for masked_copy in masked_copies:
+                if os.path.exists(masked_copy):
+                    os.remove(masked_copy)
 
-    waiting = True
+        if tmp and segmented_masked_file is not None:
+            #aplmap is done with the segments so nothing needs the masked file locally
+            for suffix in ["", ".hdr"]:
+                if os.path.exists(segmented_masked_file + suffix):
+                    background_writeback.submit(segmented_masked_file + suffix, final_masked_file + suffix)
 
-    while waiting:
-        stillwaiting = False
-        for file in os.listdir(output_location + scops_common.STATUS_DIR):
-            f = open(output_location + scops_common.STATUS_DIR + file, 'r')
-            for line in f:
-                if "zipping" in line:
-                    stillwaiting = True
-        if not stillwaiting:
-            waiting = False
+    if mapped_hook is not None:
+        try:
+            mapped_hook(mapname)
+        except Exception as e:
+            status_update(processing_id, status_file, "ERROR - bandmath", output_line_name)
+            logger.error([e,output_line_name])
+            raise Exception(e)
 
-    status_update(processing_id, status_file, "zipping", output_line_name)
+    status_update(processing_id, status_file, "waiting to zip", output_line_name)
 
-    zip_created=False
-    try:
-        with zipfile.ZipFile(mapname + ".zip", 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zip:
-            #compress the mapped file
-            zip.write(mapname, os.path.basename(mapname))
-            zip.write(mapname + ".hdr", os.path.basename(mapname + ".hdr"))
-            zip.close()
-            zip_created = True
-    except Exception as e:
-        logger.error(e)
-        zip_created = False
+    master_zip_folder = line_details["project_code"] + '_' + line_details["year"] + jday
+    master_zip_name = output_location + scops_common.WEB_MAPPED_OUTPUT + master_zip_folder + '.zip'
 
-    if zip_created:
-        #we need to delete the resultant file and hdr to save space
-        os.remove(mapname)
-        os.remove(mapname + ".hdr")
+    #wait for one of the order's zip slots, sleeping until one is free
+    with zip_coordinator.ZipSlot(output_location):
+        status_update(processing_id, status_file, "zipping", output_line_name)
 
-    logger.info("Beginning final zipfile copy")
+        zip_created=False
+        if delivery_format == delivery.GEOTIFF:
+            #written straight to the output location, replacing the zip, its copy back and the master zip
+            delivered_file = delivery.delivered_name(final_mapname if tmp else mapname, delivery_format)
+            try:
+                delivery.write_geotiff(mapname, delivered_file)
+            except Exception as e:
+                status_update(processing_id, status_file, "ERROR - geotiff", output_line_name)
+                logger.error([e, output_line_name])
+                raise Exception(e)
+            os.remove(mapname)
+            os.remove(mapname + ".hdr")
+        else:
+            delivered_file = delivery.delivered_name(final_mapname if tmp else mapname, delivery_format)
+            try:
+                with parallel_zip.ParallelZipFile(mapname + ".zip") as zip:
+                    #compress the mapped file, deflating it across threads
+                    zip.write(mapname, os.path.basename(mapname))
+                    zip.write(mapname + ".hdr", os.path.basename(mapname + ".hdr"))
+                zip_created = True
+            except Exception as e:
+                logger.error(e)
+                zip_created = False
+
+            if zip_created:
+                #we need to delete the resultant file and hdr to save space
+                os.remove(mapname)
+                os.remove(mapname + ".hdr")
+
+            if tmp:
+                #copied back alongside the next product's zipping once this one leaves its slot
+                logger.info("Beginning final zipfile copy")
+                background_writeback.submit(mapname + ".zip", final_mapname + ".zip")
 
     if tmp:
+        try:
+            background_writeback.wait()
+        except Exception as e:
+            status_update(processing_id, status_file, "ERROR - writeback", output_line_name)
+            logger.error([e, output_line_name])
+            raise Exception(e)
         if scops_common.DEBUG_FILE_WRITEBACK:
             logger.info("debug writeback requested, copy time will be increased!")
             writeback(line_processing_details)
-        shutil.move(mapname + ".zip", final_mapname + ".zip")
         shutil.rmtree(tempdir)
+        scratch.release()
 
+    if zip_created:
+        #add the line to the order's master zip now so there's little left to do once every line is complete
+        try:
+            master_zip.append_line_zip(master_zip_name, delivered_file, master_zip_folder)
+        except Exception as e:
+            logger.warning("couldn't add {} to the master zip, it will be added when the order finishes: {}".format(delivered_file, e))
 
-    logger.info(str("zipped " + output_line_name + " to " + mapname + ".zip" + " at " + output_location))
+    logger.info(str("delivered " + output_line_name + " as " + delivered_file + " at " + output_location))
 
     status_update(processing_id, status_file, "complete", output_line_name)
 
@@ -853,22 +1333,22 @@ def process_web_hyper_line(config, base_line_name, output_line_name, band_list,
                         all_check = False
 
         if all_check:
-            #if all are finished we'll use this process to zip all the zipped mapped files into one for download
-            zip_mapped_folder = glob.glob(output_location + scops_common.WEB_MAPPED_OUTPUT + "*.bil.zip")
-            zip_contents_file = open(output_location + scops_common.WEB_MAPPED_OUTPUT + "zip_contents.txt", 'a')
-            for zip_mapped in zip_mapped_folder:
-                zip_contents_file.write(zip_mapped + "\n")
-            zip_contents_file.close()
-            logger.info("outputting master zip")
-            with zipfile.ZipFile(output_location + scops_common.WEB_MAPPED_OUTPUT + line_details["project_code"] + '_' + line_details[
-               "year"] + jday + '.zip', 'a', zipfile.ZIP_STORED, allowZip64=True) as zip:
+            #products finishing together could all see everything complete, only the first makes the zip
+            all_check = claim_master_zip(output_location)
+
+        if all_check:
+            #if all are finished we'll use this process to check the master zip for download holds every zipped mapped file
+            #GeoTIFFs are downloaded line by line so there is no master zip
+            if delivery_format == delivery.ZIP:
+                zip_mapped_folder = glob.glob(output_location + scops_common.WEB_MAPPED_OUTPUT + "*.bil.zip")
+                zip_contents_file = open(output_location + scops_common.WEB_MAPPED_OUTPUT + "zip_contents.txt", 'a')
                 for zip_mapped in zip_mapped_folder:
-                    logger.info("zipping " + zip_mapped)
-                    zip.write(zip_mapped, line_details["project_code"] + '_' + line_details["year"] + jday + "/" + os.path.basename(zip_mapped))
-                #must close the file or it won't have final bits
-                zip.close()
+                    zip_contents_file.write(zip_mapped + "\n")
+                zip_contents_file.close()
+                logger.info("finishing master zip")
+                master_zip.finish_master_zip(master_zip_name, zip_mapped_folder, master_zip_folder)
             #this *shouldn't* trigger until the zip file finishes
-            email_PI(line_details["email"], output_location, line_details["project_code"])
+            email_PI(line_details["email"], output_location, line_details["project_code"], delivery_format)
 
 
 if __name__ == '__main__':
@@ -123,6 +123,11 @@ def web_qsub(config, job_submission_system="local", output=None):
     else:
         output_location = output
 
+    #let the last line of this submission make the master zip again
+    master_zip_claim = os.path.join(output_location, scops_common.WEB_MAPPED_OUTPUT, scops_process_apl_line.MASTER_ZIP_CLAIM)
+    if os.path.exists(master_zip_claim):
+        os.remove(master_zip_claim)
+
     #symlink the config file into the processing folder so that we know the source of any problems that arise
     if not os.path.exists(output_location + '/' + os.path.basename(config)):
         os.symlink(os.path.abspath(config), output_location + '/' + os.path.basename(config))